@@ -1,11 +1,37 @@
 from fileagent import FileAgent
+from fileagent.main import run_workers
+from fileagent.managers.manager_arguments import ManagerArguments
 
 
 def main():
     """
     Main function to run the FileAgent.
     """
+    arguments = ManagerArguments()
+    arguments.set_arguments()
+    args = arguments.parser.parse_args()
+
+    # The worker processes build their own agents, none is needed here
+    if (args.workers or 1) > 1 and args.restore is None and not args.compact:
+        run_workers(args)
+        return
+
     agent = FileAgent()
+
+    if restore := args.restore:
+        print(f"Restored {agent.restore_backup(restore)} as of {restore}")
+        return
+
+    if args.compact:
+        stats = agent.compact_rules_file()
+        print(
+            f"Compacted {agent.rules_file}: {stats['rules_before']} -> {stats['rules_after']} rules, "
+            f"{stats['lines_before']} -> {stats['lines_after']} lines, "
+            f"{stats['bytes_before']} -> {stats['bytes_after']} bytes, "
+            f"parsed in {stats['parse_seconds_before']:.3f} s -> {stats['parse_seconds_after']:.3f} s"
+        )
+        return
+
     agent.run_uvicorn()
 
 
@@ -1,4 +1,7 @@
 from pathlib import Path
+import json
+import os
+import uvicorn
 from fileagent.managers.manager_api import ManagerAPI
 from fileagent.managers.manager_arguments import ManagerArguments
 from fileagent.managers.manager_files import ManagerFiles
@@ -18,6 +21,10 @@ class FileAgent(ManagerAPI, ManagerArguments, ManagerFiles, ManagerSnort):
         # This entails more variables assigned, needed for the envisioned structured of the project
         ManagerFiles.__init__(self, *args, **kwargs)
 
+        # Initialize the ManagerSnort class
+        # This builds the state that is kept next to the rules file, e.g. the rule index
+        ManagerSnort.__init__(self, *args, **kwargs)
+
         # Handle the api
         ManagerAPI.__init__(self, *args, **kwargs)
 
@@ -69,6 +76,49 @@ class FileAgent(ManagerAPI, ManagerArguments, ManagerFiles, ManagerSnort):
             self.directory = self.get_parent()
 
 
+def create_app():
+    """
+    Description:
+        Build the app of a uvicorn worker process, with an agent of its own that has the
+        options the workers were started with (see `run_workers`).
+
+    Returns:
+        FastAPI: The app of the agent.
+    """
+    options = json.loads(os.environ.get(FileAgent.OPTIONS_ENV, "{}"))
+    return FileAgent(**options).app
+
+
+def run_workers(args):
+    """
+    Description:
+        Serve the API with `args.workers` uvicorn worker processes. This process does not
+        build an agent, it only starts the workers, and every worker builds its own from the
+        command line arguments (see `create_app`). The workers share the rules file and the
+        files next to it, which they only change under their file locks.
+
+    Args:
+        args (argparse.Namespace): The parsed command line arguments.
+
+    Raises:
+        ValueError: File name is required
+    """
+    if args.file is None:
+        raise ValueError("File name is required")
+
+    options = {name: value for name, value in vars(args).items() if value is not None}
+    # Resolved here, the call stack of the workers is not the one of this process
+    options["directory"] = str(args.directory or FileAgent.get_parent())
+    os.environ[FileAgent.OPTIONS_ENV] = json.dumps(options)
+    uvicorn.run(
+        "fileagent.main:create_app",
+        factory=True,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+    )
+
+
 if __name__ == "__main__":
 
     agent = FileAgent()
@@ -0,0 +1,450 @@
+from pathlib import Path
+import atexit
+import datetime
+import gzip
+import logging
+import os
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class BackupStore:
+    """
+    Description:
+        Backups of the rules file, kept in the backup directory.
+
+        In `full` mode every backup is a complete copy of the rules file (`.bak`).
+        In `delta` mode only what is appended is recorded, as a journal segment (`.journal`),
+        on top of a periodic full snapshot (`.snapshot`). A new snapshot is taken every
+        `snapshot_every` segments, and whenever the rules file was changed by someone else
+        since the last backup, so the journal always applies cleanly to its snapshot.
+
+        What to back up is decided when `backup` is called, but the files are written by a
+        background worker, so a backup never adds to the latency of a request. Because the
+        agent only appends to the rules file, a copy of "the file as it was" is a copy of
+        its first `size` bytes, which is still valid after the append went through.
+        At most one copy is pending at a time: a copy requested while the previous one is
+        still waiting for the worker replaces it (and in delta mode, the journal segments
+        queued on top of the replaced snapshot are dropped with it), so a burst of appends
+        never keeps more than one open handle on the rules file. A backup that fails is
+        logged, and counted in the `metrics`.
+
+        Backups can be gzip compressed, and thinned out by a retention policy: keep the
+        `keep_last` latest, plus the latest of every hour for `keep_hourly` hours and the
+        latest of every day for `keep_daily` days. Without a policy every backup is kept.
+
+        Any of the backups can be used to rebuild the rules file as it was at a given time.
+    """
+
+    TIMESTAMP = "%Y-%m-%d_%H-%M-%S-%f"
+    KINDS = {"snapshot": 0, "bak": 0, "journal": 1}
+    STOP = object()
+
+    def __init__(
+        self,
+        directory,
+        source,
+        mode: str = "full",
+        snapshot_every: int = 100,
+        compress: bool = False,
+        keep_last: int = None,
+        keep_hourly: int = None,
+        keep_daily: int = None,
+        background: bool = True,
+    ):
+        if mode not in ("full", "delta"):
+            raise ValueError("The backup mode must be 'full' or 'delta'")
+
+        self.directory = Path(directory)
+        self.source = Path(source)
+        self.mode = mode
+        self.snapshot_every = snapshot_every
+        self.compress = compress
+        self.keep_last = keep_last
+        self.keep_hourly = keep_hourly
+        self.keep_daily = keep_daily
+        self.background = background
+
+        self.segments = 0
+        self.expected_size: int | None = None
+        # The copy waiting for the worker, and the chain (snapshot and the journal
+        # segments on top of it) it starts, and the chain of the last copy taken
+        self.pending: dict | None = None
+        self.chain = 0
+        self.copied_chain = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.last_error: str | None = None
+        self.last_failure: float | None = None
+        self.lock = threading.Lock()
+        self.jobs: queue.Queue = queue.Queue()
+        self.worker: threading.Thread | None = None
+        self.registered = False
+
+    def now(self) -> str:
+        return datetime.datetime.now().strftime(self.TIMESTAMP)
+
+    def backup_path(self, stamp: str, kind: str) -> Path:
+        suffix = ".gz" if self.compress else ""
+        return Path(self.directory, f"{self.source.stem}-{stamp}.{kind}{suffix}")
+
+    def backup(self, appended: str = None) -> Path:
+        """
+        Description:
+            Back up the rules file, before `appended` is appended to it.
+
+        Args:
+            appended (str, optional): The text that is about to be appended. Required in delta mode.
+
+        Returns:
+            pathlib.Path: The backup file that is written last.
+        """
+        with self.lock:
+            # The copy is read from the file as it is now, even if it is replaced (e.g. by
+            # another process) before the background worker gets to it
+            try:
+                source = open(self.source, "rb")
+            except FileNotFoundError:
+                source = None
+            size = os.fstat(source.fileno()).st_size if source is not None else 0
+            stamp = self.now()
+            jobs = []
+
+            if self.mode == "full" or appended is None:
+                kind = "bak" if self.mode == "full" else "snapshot"
+                target = self.request_copy(self.backup_path(stamp, kind), size, source, jobs)
+            else:
+                if self.expected_size != size or self.segments >= self.snapshot_every:
+                    self.request_copy(self.backup_path(stamp, "snapshot"), size, source, jobs)
+                    self.segments = 0
+                elif source is not None:
+                    source.close()
+                target = self.backup_path(stamp, "journal")
+                jobs.append((self.write, target, appended, self.chain))
+                self.segments += 1
+                self.expected_size = size + len(appended.encode("utf-8"))
+
+        for job in jobs:
+            self.submit(*job)
+        self.submit(self.prune)
+        return target
+
+    def request_copy(self, target: Path, size: int, source, jobs: list) -> Path:
+        """
+        Description:
+            Start a new chain with a copy of the rules file. If a copy is still waiting for
+            the worker, it is replaced by this one (its handle on the rules file is closed,
+            and the chain it started is dropped), otherwise a job is added for the worker.
+            Called with `lock` held.
+
+        Args:
+            target (Path): The backup file.
+            size (int): The size of the rules file to copy.
+            source (BinaryIO | None): The rules file, opened when the backup was requested.
+            jobs (list): The jobs to submit, the copy job is added to it if needed.
+
+        Returns:
+            pathlib.Path: The backup file.
+        """
+        self.chain += 1
+        copy = {"target": target, "size": size, "source": source, "chain": self.chain}
+        if self.pending is not None:
+            replaced = self.pending
+            if replaced["source"] is not None:
+                replaced["source"].close()
+            self.pending = copy
+            self.coalesced += 1
+            return target
+
+        self.pending = copy
+        jobs.append((self.copy_pending,))
+        return target
+
+    def copy_pending(self):
+        """
+        Description:
+            Write the copy that is waiting for the worker, the latest that was requested.
+        """
+        with self.lock:
+            copy, self.pending = self.pending, None
+            if copy is None:
+                return
+            self.copied_chain = copy["chain"]
+        self.copy(copy["target"], copy["size"], copy["source"])
+
+    def submit(self, func, *args):
+        """
+        Description:
+            Run a piece of backup work on the background worker (or right away, when
+            the store does not run in the background).
+        """
+        if not self.background:
+            try:
+                func(*args)
+            except Exception as exc:
+                self.failed(exc)
+                raise
+            return
+
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(
+                    target=self.run, name="fileagent-backup", daemon=True
+                )
+                self.worker.start()
+                if not self.registered:
+                    # Do not lose the queued backups when the process exits
+                    atexit.register(self.stop)
+                    self.registered = True
+        self.jobs.put((func, args))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is self.STOP:
+                    return
+                func, args = job
+                try:
+                    func(*args)
+                except Exception as exc:
+                    self.failed(exc)
+            finally:
+                self.jobs.task_done()
+
+    def failed(self, exc: Exception):
+        """
+        Description:
+            Log a backup that failed, and count it in the metrics.
+        """
+        logger.error("Backup of %s failed: %s", self.source, exc, exc_info=exc)
+        with self.lock:
+            self.failures += 1
+            self.last_error = str(exc)
+            self.last_failure = datetime.datetime.now().timestamp()
+
+    def metrics(self) -> dict:
+        """
+        Description:
+            Get the metrics of the backups.
+
+        Returns:
+            dict: The rules file and the backup mode, the copies replaced by a later one
+            before they were written, the number of backups that failed, and the error and
+            time of the last failure.
+        """
+        with self.lock:
+            return {
+                "source": str(self.source),
+                "mode": self.mode,
+                "coalesced": self.coalesced,
+                "failures": self.failures,
+                "last_error": self.last_error,
+                "last_failure": self.last_failure,
+            }
+
+    def flush(self):
+        """
+        Description:
+            Wait until every backup that was requested so far is written.
+        """
+        if self.background:
+            self.jobs.join()
+
+    def stop(self):
+        """
+        Description:
+            Write the pending backups and stop the background worker.
+        """
+        with self.lock:
+            worker = self.worker
+            self.worker = None
+        if worker is not None and worker.is_alive():
+            self.jobs.put(self.STOP)
+            worker.join()
+
+    def open(self, path: Path, mode: str):
+        if path.suffix == ".gz":
+            return gzip.open(path, mode)
+        return open(path, mode)
+
+    def copy(self, target: Path, size: int, source=None):
+        """
+        Description:
+            Write a complete copy of the rules file, as it was when it was `size` bytes long.
+
+        Args:
+            target (Path): The backup file.
+            size (int): The size of the rules file to copy.
+            source (BinaryIO, optional): The rules file, opened when the backup was
+                requested, closed once copied (or once the copy failed). Opened now if not
+                given.
+        """
+        if source is None and self.source.exists():
+            source = open(self.source, "rb")
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with self.open(target, "wb") as file:
+                remaining = size if source is not None else 0
+                while remaining > 0 and (chunk := source.read(min(remaining, 1 << 20))):
+                    file.write(chunk)
+                    remaining -= len(chunk)
+        finally:
+            if source is not None:
+                source.close()
+
+    def write(self, target: Path, appended: str, chain: int = None):
+        """
+        Description:
+            Write a journal segment, unless the snapshot of its chain was replaced by a
+            later one before it was written: the segment would not apply to that snapshot.
+        """
+        with self.lock:
+            if chain is not None and chain != self.copied_chain:
+                return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self.open(target, "wb") as file:
+            file.write(appended.encode("utf-8"))
+
+    def backups(self) -> list[tuple[datetime.datetime, str, Path]]:
+        """
+        Description:
+            List the backups of the rules file, oldest first, once the pending ones are written.
+
+        Returns:
+            list[tuple[datetime.datetime, str, Path]]: (time, kind, path) of every backup.
+        """
+        self.flush()
+        return self.scan()
+
+    def scan(self) -> list[tuple[datetime.datetime, str, Path]]:
+        result = []
+        prefix = f"{self.source.stem}-"
+        for path in self.directory.glob(f"{prefix}*"):
+            stamp, _, kind = path.name[len(prefix) :].partition(".")
+            kind = kind.removesuffix(".gz")
+            if kind not in self.KINDS:
+                continue
+            try:
+                when = datetime.datetime.strptime(stamp, self.TIMESTAMP)
+            except ValueError:
+                try:
+                    # Full backups made before the delta mode existed
+                    when = datetime.datetime.strptime(stamp, "%Y-%m-%d_%H-%M-%S")
+                except ValueError:
+                    continue
+            result.append((when, kind, path))
+        return sorted(result, key=lambda item: (item[0], self.KINDS[item[1]]))
+
+    def retained(self, backups: list, now: datetime.datetime) -> set[int]:
+        """
+        Description:
+            Select the backups to keep according to the retention policy.
+            A kept journal segment needs its snapshot and the segments before it, so
+            those are kept as well.
+
+        Args:
+            backups (list): The backups, as returned by `backups`.
+            now (datetime.datetime): The current time.
+
+        Returns:
+            set[int]: The positions of the backups to keep.
+        """
+        if self.keep_last is None and self.keep_hourly is None and self.keep_daily is None:
+            return set(range(len(backups)))
+
+        keep = set(range(max(0, len(backups) - (self.keep_last or 0)), len(backups)))
+        for span, bucket in (
+            (self.keep_hourly and datetime.timedelta(hours=self.keep_hourly), "%Y-%m-%d %H"),
+            (self.keep_daily and datetime.timedelta(days=self.keep_daily), "%Y-%m-%d"),
+        ):
+            if not span:
+                continue
+            # The latest backup of every hour (or day) within the window
+            latest = {}
+            for position, (when, _, _) in enumerate(backups):
+                if now - when <= span:
+                    latest[when.strftime(bucket)] = position
+            keep.update(latest.values())
+
+        # Keep the chain a journal segment depends on
+        chain_start = None
+        for position, (_, kind, _) in enumerate(backups):
+            if kind != "journal":
+                chain_start = position
+            elif position in keep and chain_start is not None:
+                keep.update(range(chain_start, position))
+        return keep
+
+    def prune(self):
+        """
+        Description:
+            Delete the backups that the retention policy does not keep.
+        """
+        if self.keep_last is None and self.keep_hourly is None and self.keep_daily is None:
+            return
+
+        backups = self.scan()
+        keep = self.retained(backups, datetime.datetime.now())
+        for position, (_, _, path) in enumerate(backups):
+            if position not in keep:
+                path.unlink(missing_ok=True)
+
+    def rebuild(self, until: datetime.datetime) -> str:
+        """
+        Description:
+            Rebuild the content of the rules file as it was at the given time, from the
+            latest snapshot (or full backup) before it and the journal segments that follow it.
+
+        Args:
+            until (datetime.datetime): The point in time to rebuild.
+
+        Raises:
+            FileNotFoundError: If there is no snapshot or full backup before that time.
+
+        Returns:
+            str: The content of the rules file at that time.
+        """
+        backups = [item for item in self.backups() if item[0] <= until]
+        snapshots = [i for i, item in enumerate(backups) if item[1] != "journal"]
+        if not snapshots:
+            raise FileNotFoundError(f"No backup of {self.source.name} before {until}")
+
+        start = snapshots[-1]
+        parts = [self.read(backups[start][2])]
+        parts.extend(self.read(path) for _, kind, path in backups[start + 1 :] if kind == "journal")
+        return "".join(parts)
+
+    def read(self, path: Path) -> str:
+        with self.open(path, "rb") as file:
+            return file.read().decode("utf-8")
+
+    def restore(self, until: datetime.datetime, target=None) -> Path:
+        """
+        Description:
+            Restore the rules file as it was at the given time. The file is replaced
+            atomically, so a reader never sees it half written.
+
+        Args:
+            until (datetime.datetime): The point in time to restore.
+            target (str | Path, optional): Where to write the result. Defaults to the rules file.
+
+        Returns:
+            pathlib.Path: The restored file.
+        """
+        target = Path(target) if target else self.source
+        content = self.rebuild(until)
+
+        temp_file = target.with_name(f"{target.name}.tmp")
+        with open(temp_file, "w") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, target)
+
+        with self.lock:
+            # The next delta backup has to start from a new snapshot
+            self.expected_size = None
+        return target
@@ -0,0 +1,417 @@
+from collections import namedtuple
+from pathlib import Path
+import json
+import os
+import re
+import threading
+from fileagent.managers.rule_rewriter import OffsetLog
+
+
+# A rule that matches a domain. A `plain` rule matches all the traffic of the domain (and
+# of its subdomains): it matches the domain with a single content and nothing else narrows it.
+DomainEntry = namedtuple("DomainEntry", "offset sid action protocol port plain")
+
+
+class DomainNode:
+    __slots__ = ("children", "entries")
+
+    def __init__(self):
+        self.children: dict[str, "DomainNode"] = {}
+        self.entries: list[DomainEntry] = []
+
+
+class DomainSuffixIndex:
+    """
+    Description:
+        Index of the domains the rules of the rules file match (the content of the rules
+        of `block_domain` and `alert_domain`, e.g. `content:"|65 78 61 ...|"`), to find the
+        rules that cover a domain.
+
+        It is a suffix trie over the labels of the domains, reversed: `www.example.com`
+        is the node `com` -> `example` -> `www`. The rules of a domain hang off its node,
+        so the rules that match a domain or one of its parents are found by walking its
+        labels once, in O(labels), and the siblings of a domain are the children of its
+        parent. A rule is referred to by the byte offset it starts at in the rules file.
+
+        A content matches anywhere in the payload, so the rule of `example.com` also
+        matches the SNI of `www.example.com`. Domains are compared lowercased.
+
+        Like the prefix index, it is saved to a sidecar file with the state of the reader
+        that indexed the rules file, and follows the rewrites of the rules file through an
+        offset log.
+    """
+
+    SIDECAR_VERSION = 1
+
+    # The options that only describe a rule, and do not narrow what it matches
+    GENERAL_OPTIONS = ("msg", "sid", "rev", "gid", "classtype", "priority", "metadata", "reference")
+
+    # What the rules of `block_domain`/`alert_domain` look at, it does not narrow them either
+    DOMAIN_OPTIONS = ("ssl_state:client_hello", "ssl_state: client_hello")
+
+    LABEL = re.compile(r"^[a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9_])?$")
+
+    def __init__(self):
+        self.root = DomainNode()
+        self.domains = 0
+        self.signature: tuple[int, int] | None = None
+        # The rewrites the offsets of the entries were not moved through yet
+        self.moves = OffsetLog()
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return self.domains
+
+    def clear(self):
+        with self.lock:
+            self.root = DomainNode()
+            self.domains = 0
+            self.moves.clear()
+            self.signature = None
+
+    @classmethod
+    def labels(cls, domain: str) -> list[str]:
+        """
+        Description:
+            Split a domain into its labels, from the top level one down.
+
+        Raises:
+            ValueError: If it is not a domain of two labels or more.
+
+        Returns:
+            list[str]: The labels, e.g. `["com", "example", "www"]` for `www.example.com`.
+        """
+        labels = str(domain).strip().lower().rstrip(".").split(".")
+        if len(labels) < 2 or not all(cls.LABEL.match(label) for label in labels):
+            raise ValueError(f"Invalid domain: {domain}")
+        labels.reverse()
+        return labels
+
+    @staticmethod
+    def content_value(option: str) -> tuple[str, str] | None:
+        """
+        Description:
+            Decode the value of a `content` option, the bytes between `|` are hex.
+
+        Returns:
+            tuple[str, str] | None: The value and the modifiers after it (e.g. `,nocase`),
+            or None if the option is not a content, or is negated.
+        """
+        name, _, value = option.partition(":")
+        if name.strip() != "content":
+            return None
+        value = value.strip()
+        end = value.find('"', 1)
+        if not value.startswith('"') or end < 0:
+            return None
+        value, modifiers = value[1:end], value[end + 1 :].strip()
+        text = []
+        for number, part in enumerate(value.split("|")):
+            if number % 2:
+                try:
+                    text.append(bytes.fromhex(part).decode("ascii"))
+                except (ValueError, UnicodeDecodeError):
+                    return None
+            else:
+                text.append(part)
+        return "".join(text), modifiers
+
+    @classmethod
+    def domain_of(cls, rule) -> tuple[str, bool] | None:
+        """
+        Description:
+            Get the domain a rule matches, if its only content is a domain.
+
+        Args:
+            rule (SnortRule): The parsed rule.
+
+        Returns:
+            tuple[str, bool] | None: The domain, and whether the rule is plain.
+        """
+        contents = [option for option in rule.options if option.startswith("content")]
+        if len(contents) != 1:
+            return None
+        if (content := cls.content_value(contents[0])) is None:
+            return None
+        domain, modifiers = content
+        try:
+            domain = ".".join(reversed(cls.labels(domain)))
+        except ValueError:
+            return None
+
+        plain = (
+            not modifiers
+            and (rule.src_ip, rule.src_port, rule.dst_ip) == ("any", "any", "any")
+            and rule.direction == "->"
+            and all(
+                option.startswith(cls.GENERAL_OPTIONS) or option in cls.DOMAIN_OPTIONS
+                for option in rule.options
+                if option is not contents[0]
+            )
+        )
+        return domain, plain
+
+    def node(self, labels: list[str], create: bool = False) -> DomainNode | None:
+        node = self.root
+        for label in labels:
+            child = node.children.get(label)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[label] = DomainNode()
+            node = child
+        return node
+
+    def insert(self, domain: str, entry: DomainEntry):
+        with self.lock:
+            if self.moves and (entry := self.stored(entry)) is None:
+                return
+            node = self.node(self.labels(domain), create=True)
+            if entry not in node.entries:
+                if not node.entries:
+                    self.domains += 1
+                node.entries.append(entry)
+
+    def add(self, offset: int, rule):
+        """
+        Description:
+            Index the domain of a rule, if it has one.
+
+        Args:
+            offset (int): The byte offset the rule starts at in the rules file.
+            rule (SnortRule): The parsed rule.
+        """
+        if (found := self.domain_of(rule)) is None:
+            return
+        domain, plain = found
+        self.insert(
+            domain, DomainEntry(offset, rule.sid, rule.action, rule.protocol, rule.dst_port, plain)
+        )
+
+    def discard(self, offset: int, rule):
+        """
+        Description:
+            Drop the entries of a rule, e.g. one that is about to be cut out of the rules
+            file. The branch of its domain stays until the offsets are next moved.
+
+        Args:
+            offset (int): The byte offset the rule starts at in the rules file.
+            rule (SnortRule): The parsed rule.
+        """
+        if (found := self.domain_of(rule)) is None:
+            return
+        with self.lock:
+            if (offset := self.moves.base(offset)) is None:
+                return
+            node = self.node(self.labels(found[0]))
+            if node is None or not node.entries:
+                return
+            node.entries = [entry for entry in node.entries if entry.offset != offset]
+            if not node.entries:
+                self.domains -= 1
+
+    def splice(self, shift):
+        """
+        Description:
+            Follow a rewrite of the rules file that cut rules out of it (their entries are
+            dropped beforehand with `discard`): the rewrite goes to the offset log, and the
+            offsets of the entries are moved when they are read.
+
+        Args:
+            shift (OffsetShift): Maps the offsets before the rewrite to the offsets after it.
+        """
+        with self.lock:
+            if self.moves.push(shift):
+                self.apply_moves()
+
+    def apply_moves(self):
+        """
+        Description:
+            Move the offsets of every entry through the offset log, prune the branches left
+            empty, and clear the log.
+        """
+
+        def move_node(node: DomainNode) -> bool:
+            if node.entries:
+                node.entries = [
+                    entry if entry.offset < first else DomainEntry(moved, *entry[1:])
+                    for entry in node.entries
+                    if entry.offset < first or (moved := move(entry.offset)) is not None
+                ]
+                self.domains += bool(node.entries)
+            node.children = {
+                label: child for label, child in node.children.items() if move_node(child)
+            }
+            return bool(node.entries or node.children)
+
+        with self.lock:
+            moves = self.moves
+            if not moves:
+                return
+            first, move = moves.first, moves.composed()
+            self.domains = 0
+            move_node(self.root)
+            moves.clear()
+
+    def stored(self, entry: DomainEntry) -> DomainEntry | None:
+        # The entry with the offset to store for its current offset
+        if (offset := self.moves.base(entry.offset)) is None:
+            return None
+        return DomainEntry(offset, *entry[1:])
+
+    def moved(self, entry: DomainEntry) -> DomainEntry:
+        # The entry with its current offset
+        if not self.moves:
+            return entry
+        return DomainEntry(self.moves(entry.offset), *entry[1:])
+
+    def lookup(self, domain: str) -> list[tuple[str, DomainEntry]]:
+        """
+        Description:
+            Find the rules of the domain and of its parents, in O(labels).
+
+        Raises:
+            ValueError: If `domain` is not a domain.
+
+        Returns:
+            list[tuple[str, DomainEntry]]: The (domain, entry) of every rule, the most
+            specific domains first.
+        """
+        labels = self.labels(domain)
+        matches = []
+        with self.lock:
+            node = self.root
+            for depth, label in enumerate(labels, 1):
+                if (node := node.children.get(label)) is None:
+                    break
+                if node.entries:
+                    suffix = ".".join(reversed(labels[:depth]))
+                    matches.extend((suffix, self.moved(entry)) for entry in node.entries)
+        matches.reverse()
+        return matches
+
+    def exact(self, domain: str) -> list[DomainEntry]:
+        """
+        Description:
+            Get the rules of the domain itself, not of its parents.
+
+        Raises:
+            ValueError: If `domain` is not a domain.
+        """
+        labels = self.labels(domain)
+        with self.lock:
+            node = self.node(labels)
+            return [self.moved(entry) for entry in node.entries] if node is not None else []
+
+    @staticmethod
+    def matches(entry: DomainEntry, action: str, protocol: str, port) -> bool:
+        return (
+            entry.plain
+            and entry.action == action
+            and entry.protocol == protocol
+            and entry.port in (str(port), "any")
+        )
+
+    def covering(self, domain: str, action: str, protocol: str, port):
+        """
+        Description:
+            Find a plain rule that already matches all the traffic a rule for the domain
+            would match: same action, protocol and destination port (or `any`), for the
+            domain itself or one of its parents.
+
+        Returns:
+            DomainEntry | None: The entry of the covering rule, if there is one.
+        """
+        for _, entry in self.lookup(domain):
+            if self.matches(entry, action, protocol, port):
+                return entry
+        return None
+
+    def siblings(self, domain: str, action: str, protocol: str, port) -> int:
+        """
+        Description:
+            Count the subdomains of the parent of a domain that have a plain rule with the
+            same action, protocol and port, the domain itself excluded.
+
+        Returns:
+            int: The number of siblings.
+        """
+        labels = self.labels(domain)
+        with self.lock:
+            parent = self.node(labels[:-1])
+            if parent is None:
+                return 0
+            return sum(
+                any(self.matches(entry, action, protocol, port) for entry in child.entries)
+                for label, child in parent.children.items()
+                if label != labels[-1]
+            )
+
+    def items(self):
+        """
+        Description:
+            Iterate over the domains and their rules, depth first.
+        """
+        stack = [((), self.root)]
+        while stack:
+            labels, node = stack.pop()
+            if node.entries:
+                yield ".".join(reversed(labels)), node.entries
+            stack.extend(((*labels, label), child) for label, child in node.children.items())
+
+    def save(self, sidecar, reader_state: dict):
+        """
+        Description:
+            Save the index to a sidecar file, along with the state of the reader that
+            indexed the rules file: a JSON header line, followed by the domains and their
+            rules as a JSON line.
+
+        Args:
+            sidecar (str | Path): The sidecar file.
+            reader_state (dict): The state of the reader, see `RuleReader.state`.
+        """
+        sidecar = Path(sidecar)
+        with self.lock:
+            header = {
+                "version": self.SIDECAR_VERSION,
+                "signature": self.signature,
+                "reader": reader_state,
+            }
+            self.apply_moves()
+            body = [[domain, entries] for domain, entries in self.items()]
+
+        temp_file = sidecar.with_name(f"{sidecar.name}.tmp")
+        with open(temp_file, "w") as file:
+            file.write(json.dumps(header) + "\n")
+            file.write(json.dumps(body, separators=(",", ":")) + "\n")
+        os.replace(temp_file, sidecar)
+
+    def load(self, sidecar) -> dict | None:
+        """
+        Description:
+            Load the index from a sidecar file written by `save`.
+
+        Args:
+            sidecar (str | Path): The sidecar file.
+
+        Returns:
+            dict | None: The state of the reader to continue from, or None if there is no
+            usable sidecar (missing, from another version or truncated).
+        """
+        try:
+            with open(sidecar, "r") as file:
+                header = json.loads(file.readline())
+                body = json.loads(file.readline())
+        except (FileNotFoundError, json.JSONDecodeError, UnicodeDecodeError):
+            return None
+
+        if not isinstance(header, dict) or header.get("version") != self.SIDECAR_VERSION:
+            return None
+
+        with self.lock:
+            self.clear()
+            for domain, entries in body:
+                for entry in entries:
+                    self.insert(domain, DomainEntry(*entry))
+            self.signature = tuple(header["signature"]) if header["signature"] else None
+        return header["reader"]
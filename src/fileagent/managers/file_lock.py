@@ -0,0 +1,61 @@
+from pathlib import Path
+import fcntl
+import os
+import threading
+
+
+class FileLock:
+    """
+    Description:
+        A lock held by a single thread of a single process at a time, for the state that the
+        processes of one host share through files (e.g. the workers of uvicorn, or several
+        agents on the same rules file).
+
+        It is a reentrant thread lock, and an advisory `fcntl.flock` on a lock file, taken
+        by the outermost acquire of the thread holding it and released by its last release.
+        The lock file is next to the file it protects, not the file itself, as that one is
+        replaced by atomic rewrites, and the lock of a replaced file protects nothing. The
+        lock file is opened on every outermost acquire, so a forked process never shares
+        the lock of its parent.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str | Path): The lock file, created if it does not exist.
+        """
+        self.path = Path(path)
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.fd: int | None = None
+
+    def acquire(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                except BaseException:
+                    os.close(fd)
+                    raise
+            except BaseException:
+                self.lock.release()
+                raise
+            self.fd = fd
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            fd, self.fd = self.fd, None
+            # Closing the lock file releases the lock of the process
+            os.close(fd)
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,273 @@
+from pathlib import Path
+import json
+import os
+import shutil
+from fileagent.managers.file_lock import FileLock
+
+
+class HistoryStore:
+    """
+    Description:
+        Append-only store of the notification history, kept as newline-delimited JSON
+        (one history entry per line).
+
+        Recording an entry is a single append to the end of the log, regardless of how long
+        the history already is, and concurrent writers never lose each other's entries
+        because there is no read-modify-write cycle. The `{"history": [...]}` shape of the
+        old `history.json` is still available through `read`.
+
+        The appends are done under a `FileLock` (on `<log>.lock`), so the batches of the
+        processes that share the log (e.g. the workers of uvicorn) never interleave.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = FileLock(self.path.with_name(f"{self.path.name}.lock"))
+        if not self.path.exists():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.touch()
+
+    def append(self, entries: list[dict]):
+        """
+        Description:
+            Append entries to the end of the log, with a single write.
+
+        Args:
+            entries (list[dict]): The history entries to record, in order.
+        """
+        if not entries:
+            return
+
+        data = "".join(
+            json.dumps(entry, separators=(",", ":")) + "\n" for entry in entries
+        )
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(data)
+
+    def entries(self):
+        """
+        Description:
+            Iterate over the entries of the log, oldest first.
+            A line that can not be decoded (e.g. half written by a crashed process) is skipped.
+
+        Yields:
+            dict: The history entries.
+        """
+        with open(self.path, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def read(self) -> dict:
+        """
+        Description:
+            Read the whole history in the shape of the old `history.json` file.
+
+        Returns:
+            dict: `{"history": [...]}` with every entry of the log, oldest first.
+        """
+        return {"history": list(self.entries())}
+
+    def page(self, cursor: int = None, limit: int = 100, since: str = None):
+        """
+        Description:
+            Read a window of the log without deserializing what comes before it.
+            The cursor is a byte offset in the log, so the window is reached with a seek.
+            When `since` is given, the first entry at or after that time is found with a
+            binary search over the file, relying on entries being appended in time order.
+
+        Args:
+            cursor (int, optional): Byte offset to start from, as returned in a previous page.
+            limit (int, optional): Maximum number of entries to return. Defaults to 100.
+            since (str, optional): Only return entries with a timestamp at or after this one
+                (same `YYYY-MM-DD HH:MM:SS` format as the entries).
+
+        Returns:
+            tuple[list[dict], int]: The entries of the window and the cursor of the next window.
+        """
+        entries = []
+        with open(self.path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            start = self.line_start(file, min(cursor or 0, size))
+            if since:
+                start = self.bisect(file, start, size, since)
+
+            file.seek(start)
+            offset = start
+            while len(entries) < limit:
+                line = file.readline()
+                # Stop at the end, or at a line that is still being written
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return entries, offset
+
+    def last(self) -> dict | None:
+        """
+        Description:
+            Read the most recent entry, by reading the log backwards from its end.
+
+        Returns:
+            dict | None: The last entry of the log, or None if it is empty.
+        """
+        with open(self.path, "rb") as file:
+            end = os.fstat(file.fileno()).st_size
+            chunk = 4096
+            while end > 0:
+                start = max(0, end - chunk)
+                file.seek(start)
+                lines = file.read(end - start).splitlines()
+                # The first line of the chunk may be cut, unless the chunk starts the file
+                for line in reversed(lines if start == 0 else lines[1:]):
+                    try:
+                        return json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                if start == 0:
+                    break
+                chunk *= 2
+        return None
+
+    @staticmethod
+    def line_start(file, offset: int) -> int:
+        """
+        Description:
+            Get the offset of the first line that starts at or after the given offset.
+        """
+        if offset <= 0:
+            return 0
+        file.seek(offset - 1)
+        file.readline()
+        return file.tell()
+
+    def bisect(self, file, start: int, end: int, since: str) -> int:
+        """
+        Description:
+            Binary search for the offset of the first line, between `start` and `end`,
+            with a timestamp at or after `since`.
+
+        Returns:
+            int: The offset of that line, or `end` if there is none.
+        """
+        found = end
+        low, high = start, end
+        while low < high:
+            middle = (low + high) // 2
+            offset = self.line_start(file, middle)
+            if offset >= high:
+                # No line starts in [middle, high), keep looking before it
+                high = middle
+                continue
+
+            file.seek(offset)
+            line = file.readline()
+            try:
+                timestamp = json.loads(line).get("timestamp", "")
+            except (json.JSONDecodeError, AttributeError):
+                timestamp = ""
+
+            if timestamp < since:
+                low = offset + len(line)
+            else:
+                found = offset
+                high = middle
+        return found
+
+    def migrate(self, legacy_file) -> bool:
+        """
+        Description:
+            One-time migration of a `{"history": [...]}` JSON file into the log.
+            The entries of the legacy file are placed before anything already in the log,
+            and the legacy file is renamed to `<name>.migrated` so it is not migrated again.
+            The legacy file can be the log itself (a history file of an older version that
+            is given to the agent): it is then rewritten in place as a log, and a copy of it
+            is kept as `<name>.migrated`. A log is never migrated.
+
+        Args:
+            legacy_file (str | Path): The legacy JSON history file.
+
+        Returns:
+            bool: True if a migration took place.
+        """
+        legacy_file = Path(legacy_file)
+        in_place = legacy_file == self.path
+
+        # Checked under the lock, so that only one of the processes starting together migrates
+        with self.lock:
+            if not legacy_file.is_file():
+                return False
+            legacy = self.legacy_entries(legacy_file)
+            if legacy is None:
+                return False
+
+            temp_file = self.path.with_name(f"{self.path.name}.tmp")
+            with open(temp_file, "w") as file:
+                for entry in legacy:
+                    file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                if not in_place:
+                    with open(self.path, "r") as current:
+                        file.write(current.read())
+                file.flush()
+                os.fsync(file.fileno())
+            migrated = legacy_file.with_name(f"{legacy_file.name}.migrated")
+            if in_place:
+                shutil.copy2(legacy_file, migrated)
+                os.replace(temp_file, self.path)
+            else:
+                os.replace(temp_file, self.path)
+                os.replace(legacy_file, migrated)
+        return True
+
+    @staticmethod
+    def legacy_entries(path: Path) -> list[dict] | None:
+        """
+        Description:
+            Read the entries of a history file in the old `{"history": [...]}` format.
+            Only the first line is read from a log. Entries that were appended to a legacy
+            file as lines (after its document, which has no trailing newline) are kept.
+
+        Args:
+            path (Path): The history file.
+
+        Returns:
+            list[dict] | None: The entries, oldest first, or None if the file is a log
+            (or empty, or not a history file at all).
+        """
+        with open(path, "r") as file:
+            for line in file:
+                if line.strip():
+                    break
+            else:
+                return None
+            try:
+                first = json.loads(line)
+            except json.JSONDecodeError:
+                first = None
+            if isinstance(first, dict) and "history" not in first:
+                return None
+            file.seek(0)
+            text = file.read()
+
+        try:
+            document, end = json.JSONDecoder().raw_decode(text, len(text) - len(text.lstrip()))
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(document, dict) or not isinstance(document.get("history"), list):
+            return None
+
+        entries = list(document["history"])
+        for line in text[end:].splitlines():
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        return entries
@@ -0,0 +1,515 @@
+from abc import ABC, abstractmethod
+from collections import Counter
+from pathlib import Path
+import atexit
+import ipaddress
+import os
+import socket
+import threading
+from fileagent.managers.file_lock import FileLock
+from fileagent.managers.snort_rule import SnortRule
+
+
+class CidrSet:
+    """
+    Description:
+        The smallest set of CIDR prefixes that covers the addresses added to it.
+
+        Prefixes are kept as `(version, network as int, prefix length)` keys, so adding an
+        address is a handful of set lookups: it is dropped if one of its supernets is
+        already in the set (only the prefix lengths that are in use are tried), otherwise
+        it is merged with its sibling prefix for as long as the sibling is in the set (two
+        /32 into a /31, two /31 into a /30 ...). The set is therefore always what
+        `ipaddress.collapse_addresses` would return for the same addresses, without
+        collapsing everything again on every add.
+
+        Removing a network drops the prefixes inside it, and splits the prefix that
+        contains it into the sibling prefixes along the way down to it (removing a /32
+        from a /30 leaves the other /31 and the other /32).
+    """
+
+    BITS = {4: 32, 6: 128}
+    FAMILIES = {4: socket.AF_INET, 6: socket.AF_INET6}
+
+    def __init__(self, networks=()):
+        self.prefixes: set[tuple[int, int, int]] = set()
+        # The number of prefixes of every length, per version
+        self.lengths: dict[int, Counter] = {4: Counter(), 6: Counter()}
+        for network in networks:
+            self.add(network)
+
+    def __len__(self) -> int:
+        return len(self.prefixes)
+
+    def __iter__(self):
+        for key in sorted(self.prefixes):
+            yield self.network(key)
+
+    @staticmethod
+    def network(key: tuple[int, int, int]) -> ipaddress.IPv4Network | ipaddress.IPv6Network:
+        version, start, length = key
+        network = ipaddress.IPv4Network if version == 4 else ipaddress.IPv6Network
+        return network((start, length))
+
+    @classmethod
+    def key(cls, network) -> tuple[int, int, int]:
+        if isinstance(network, str):
+            # Addresses and "address/length" skip the (slower) parsing of ip_network
+            address, slash, length = network.partition("/")
+            if not slash or length.isdigit():
+                version = 6 if ":" in address else 4
+                try:
+                    value = int.from_bytes(socket.inet_pton(cls.FAMILIES[version], address))
+                except OSError:
+                    # Let ipaddress tell what is wrong with it (or parse a scoped address)
+                    parsed = ipaddress.ip_address(address)
+                    version, value = parsed.version, int(parsed)
+                bits = cls.BITS[version]
+                length = int(length) if slash else bits
+                if length > bits:
+                    raise ValueError(f"{network!r} does not appear to be an IPv4 or IPv6 network")
+                return version, value & ~((1 << (bits - length)) - 1), length
+
+        network = ipaddress.ip_network(network, strict=False)
+        return network.version, int(network.network_address), network.prefixlen
+
+    def covers(self, network) -> bool:
+        """
+        Description:
+            Check if the network (or address) is inside one of the prefixes of the set.
+        """
+        return self.covered(self.key(network))
+
+    def covered(self, key: tuple[int, int, int]) -> bool:
+        return self.covering(key) is not None
+
+    def covering(self, key: tuple[int, int, int]) -> tuple[int, int, int] | None:
+        """
+        Description:
+            Find the prefix of the set that contains the given key, if there is one.
+        """
+        version, start, length = key
+        bits = self.BITS[version]
+        prefixes = self.prefixes
+        for prefix in self.lengths[version]:
+            if prefix <= length and (
+                (supernet := (version, start & ~((1 << (bits - prefix)) - 1), prefix)) in prefixes
+            ):
+                return supernet
+        return None
+
+    def insert(self, key: tuple[int, int, int]):
+        self.prefixes.add(key)
+        self.lengths[key[0]][key[2]] += 1
+
+    def drop(self, key: tuple[int, int, int]):
+        self.prefixes.remove(key)
+        lengths = self.lengths[key[0]]
+        lengths[key[2]] -= 1
+        if not lengths[key[2]]:
+            del lengths[key[2]]
+
+    def add(self, network) -> bool:
+        """
+        Description:
+            Add a network (or address) to the set.
+
+        Returns:
+            bool: False if the network was already covered, and the set did not change.
+        """
+        key = self.key(network)
+        if self.covered(key):
+            return False
+
+        version, start, length = key
+        bits = self.BITS[version]
+        # The prefixes inside the new network are now redundant
+        self.drop_inside(key)
+
+        while length > 0:
+            sibling = (version, start ^ (1 << (bits - length)), length)
+            if sibling not in self.prefixes:
+                break
+            self.drop(sibling)
+            length -= 1
+            start &= ~((1 << (bits - length)) - 1)
+        self.insert((version, start, length))
+        return True
+
+    def drop_inside(self, key: tuple[int, int, int]) -> bool:
+        """
+        Description:
+            Drop the prefixes that are inside the given key (not the key itself).
+
+        Returns:
+            bool: True if any prefix was dropped.
+        """
+        version, start, length = key
+        bits = self.BITS[version]
+        if length >= bits:
+            return False
+        mask = ~((1 << (bits - length)) - 1)
+        inside = [
+            prefix
+            for prefix in self.prefixes
+            if prefix[0] == version and prefix[2] > length and prefix[1] & mask == start
+        ]
+        for prefix in inside:
+            self.drop(prefix)
+        return bool(inside)
+
+    def remove(self, network) -> bool:
+        """
+        Description:
+            Remove a network (or address) from the set, so that none of its addresses is
+            covered any more.
+
+        Returns:
+            bool: False if no address of the network was in the set, and the set did not change.
+        """
+        key = self.key(network)
+        if (covering := self.covering(key)) is None:
+            return self.drop_inside(key)
+
+        version, start, length = key
+        bits = self.BITS[version]
+        self.drop(covering)
+        # Keep the halves of the covering prefix that do not hold the network, from the
+        # largest down to the sibling of the network
+        for prefix in range(covering[2] + 1, length + 1):
+            path = start & ~((1 << (bits - prefix)) - 1)
+            self.insert((version, path ^ (1 << (bits - prefix)), prefix))
+        return True
+
+
+class IpLists(ABC):
+    """
+    Description:
+        Base of the files that are generated from the addresses of `block_ip` and
+        `alert_ip` commands. The addresses are kept as CIDR prefixes, one `CidrSet` per
+        action, and the files are regenerated from them.
+
+        The files are rewritten atomically, at most once every `interval` seconds, so a
+        burst of new addresses costs one rewrite. Subclasses tell where their files are
+        (`paths`), read them back (`load`) and render them (`files`).
+
+        The files can be shared by several processes (e.g. the workers of uvicorn): they
+        are rewritten under a `FileLock`, and read back first (`refresh`) when another
+        process rewrote them since. The networks added and removed since the files were
+        last written are applied again on top of what was read, so neither the changes
+        of the other process nor the pending ones are lost.
+    """
+
+    def __init__(self, interval: float = 1.0, lock_file=None):
+        """
+        Args:
+            interval (float, optional): Minimum seconds between two rewrites of the files.
+                With 0 the files are rewritten on every change. Defaults to 1.0.
+            lock_file (str | Path, optional): The lock file of the files, next to them.
+        """
+        self.interval = interval
+        self.sets: dict[str, CidrSet] = {}
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(lock_file)
+        self.dirty = False
+        # The (add, action, network) that changed the lists since they were last written,
+        # with add False for a removal
+        self.pending: list[tuple[bool, str, object]] = []
+        # The networks that changed the lists since they were last written, and what is
+        # told their number once they are (e.g. `SnortReloader.changed`)
+        self.changes = 0
+        self.on_flush = None
+        self.timer: threading.Timer | None = None
+        self.stopping = False
+        self.registered = False
+        # The (inode, mtime, size) of the files when they were last read or written
+        self.seen = self.signatures()
+        self.load()
+
+    @abstractmethod
+    def load(self):
+        """
+        Description:
+            Read the prefixes back from the generated files.
+        """
+
+    @abstractmethod
+    def paths(self) -> list[Path]:
+        """
+        Description:
+            Get the generated files the prefixes are read back from.
+        """
+
+    def signatures(self) -> dict[Path, tuple[int, int, int] | None]:
+        signatures = {}
+        for path in self.paths():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                signatures[path] = None
+                continue
+            signatures[path] = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        return signatures
+
+    def refresh(self):
+        """
+        Description:
+            Read the files back if they were rewritten since they were last read or
+            written, e.g. by another process. The changes that were not written yet are
+            applied again to what was read.
+        """
+        with self.lock:
+            if (signatures := self.signatures()) != self.seen:
+                self.seen = signatures
+                self.sets = {}
+                self.load()
+                for add, action, network in self.pending:
+                    cidrs = self.sets.setdefault(action, CidrSet())
+                    if add:
+                        cidrs.add(network)
+                    else:
+                        cidrs.remove(network)
+
+    @abstractmethod
+    def files(self) -> dict[Path, str]:
+        """
+        Description:
+            Render the generated files.
+
+        Returns:
+            dict[Path, str]: The content of every file.
+        """
+
+    def sids(self) -> list[int]:
+        return []
+
+    def covers(self, action: str, network) -> bool:
+        with self.lock:
+            self.refresh()
+            return action in self.sets and self.sets[action].covers(network)
+
+    def lookup(self, network) -> list[tuple[str, str]]:
+        """
+        Description:
+            Find the lists that contain the network (or address).
+
+        Returns:
+            list[tuple[str, str]]: The action of every list, and its prefix that contains the
+            network, as written in the files.
+        """
+        key = CidrSet.key(network)
+        matches = []
+        with self.lock:
+            for action in sorted(self.sets):
+                if (prefix := self.sets[action].covering(key)) is not None:
+                    matches.append((action, self.prefix_text(CidrSet.network(prefix))))
+        return matches
+
+    def add(self, action: str, networks) -> bool:
+        """
+        Description:
+            Add networks (or addresses) to the lists of an action, and schedule the rewrite
+            of the files if that changed any list.
+
+        Returns:
+            bool: True if any of the networks was not covered yet.
+        """
+        with self.lock:
+            self.refresh()
+            cidrs = self.sets.setdefault(action, CidrSet())
+            changed = False
+            for network in networks:
+                if cidrs.add(network):
+                    changed = True
+                    self.changes += 1
+                    self.pending.append((True, action, network))
+            if changed:
+                self.dirty = True
+                self.schedule()
+            return changed
+
+    def remove(self, network) -> list[str]:
+        """
+        Description:
+            Remove a network (or address) from the lists of every action, splitting the
+            prefixes it was merged into, and schedule the rewrite of the files if that
+            changed any list.
+
+        Returns:
+            list[str]: The actions of the lists the network was removed from.
+        """
+        actions = []
+        with self.lock:
+            self.refresh()
+            for action in sorted(self.sets):
+                if self.sets[action].remove(network):
+                    actions.append(action)
+                    self.changes += 1
+                    self.pending.append((False, action, network))
+            if actions:
+                self.dirty = True
+                self.schedule()
+        return actions
+
+    def schedule(self):
+        if self.interval <= 0 or self.stopping:
+            self.flush()
+        elif self.timer is None:
+            self.timer = threading.Timer(self.interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+            if not self.registered:
+                # Do not lose the changes of the last interval on exit
+                self.registered = True
+                atexit.register(self.stop)
+
+    @staticmethod
+    def prefix_text(network) -> str:
+        # A single address is written without its /32 (/128)
+        if network.prefixlen == network.max_prefixlen:
+            return str(network.network_address)
+        return str(network)
+
+    def prefixes(self, action: str) -> list[str]:
+        """
+        Description:
+            Get the prefixes of an action, sorted, as written in the files.
+        """
+        return [self.prefix_text(network) for network in self.sets.get(action, ())]
+
+    def flush(self):
+        """
+        Description:
+            Rewrite the files, if the lists changed since they were last written. The new
+            content is written to a temporary file that then replaces the file, so Snort
+            never reads a half written list. `on_flush` is then told how many networks
+            changed the lists.
+        """
+        with self.lock:
+            self.timer = None
+            if not self.dirty:
+                return
+            with self.file_lock:
+                # What the other processes wrote meanwhile is written as well
+                self.refresh()
+                for path, content in self.files().items():
+                    temp_file = path.with_name(f"{path.name}.tmp")
+                    with open(temp_file, "w") as file:
+                        file.write(content)
+                        file.flush()
+                        os.fsync(file.fileno())
+                    os.replace(temp_file, path)
+                self.seen = self.signatures()
+            self.dirty = False
+            self.pending = []
+            changes, self.changes = self.changes, 0
+        if self.on_flush is not None:
+            self.on_flush(changes)
+
+    def stop(self):
+        """
+        Description:
+            Write the pending changes now, instead of waiting for the timer.
+        """
+        with self.lock:
+            self.stopping = True
+            if self.timer is not None:
+                self.timer.cancel()
+            self.flush()
+
+
+class IpAggregator(IpLists):
+    """
+    Description:
+        Write the prefixes of every action as a few Snort rules with IP lists
+        (`block ip [10.0.0.0/24,10.0.1.5] any -> any any (...)`), to their own rules file.
+
+        Every rule holds up to `list_size` prefixes, and keeps its sid when the file is
+        regenerated (its rev is bumped when its list changed). The prefixes are read back
+        from the file at startup.
+    """
+
+    SOURCE = "ip_lists"
+
+    def __init__(
+        self,
+        path,
+        build_rule,
+        reserve_sid,
+        list_size: int = 1000,
+        interval: float = 1.0,
+    ):
+        """
+        Args:
+            path (str | Path): The rules file of the IP lists.
+            build_rule (Callable): `build_rule(action, prefixes, number, sid, rev)` returns
+                the text of the rule of one list.
+            reserve_sid (Callable): Returns a free sid for a new list.
+            list_size (int, optional): Maximum number of prefixes per rule. Defaults to 1000.
+            interval (float, optional): Minimum seconds between two rewrites of the file.
+                With 0 the file is rewritten on every change. Defaults to 1.0.
+        """
+        self.path = Path(path)
+        self.build_rule = build_rule
+        self.reserve_sid = reserve_sid
+        self.list_size = list_size
+        # The [sid, rev, prefixes] of every rule of an action, in file order
+        self.lists: dict[str, list[list]] = {}
+        super().__init__(interval, self.path.with_name(f"{self.path.name}.lock"))
+
+    def load(self):
+        """
+        Description:
+            Read the prefixes, sids and revs of the lists back from the rules file.
+        """
+        self.lists = {}
+        try:
+            with open(self.path, "r") as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return
+
+        for line in lines:
+            if not (line := line.strip()) or line.startswith("#"):
+                continue
+            rule = SnortRule.parse(line)
+            prefixes = rule.src_ip.strip("[]").split(",")
+            cidrs = self.sets.setdefault(rule.action, CidrSet())
+            for prefix in prefixes:
+                cidrs.add(prefix)
+            self.lists.setdefault(rule.action, []).append([rule.sid, rule.rev or 1, prefixes])
+
+    def paths(self) -> list[Path]:
+        return [self.path]
+
+    def sids(self) -> list[int]:
+        return [entry[0] for lists in self.lists.values() for entry in lists]
+
+    def rules(self) -> list[str]:
+        """
+        Description:
+            Split the prefixes of every action into lists of `list_size`, and build their rules.
+            A list keeps the sid it had, and gets a new rev if its prefixes changed.
+
+        Returns:
+            list[str]: The rules, in file order.
+        """
+        rules = []
+        for action in sorted(self.sets):
+            prefixes = self.prefixes(action)
+            previous = self.lists.get(action, [])
+            lists = []
+            for number, first in enumerate(range(0, len(prefixes), self.list_size)):
+                chunk = prefixes[first : first + self.list_size]
+                if number < len(previous):
+                    sid, rev, old = previous[number]
+                    rev = rev if old == chunk else rev + 1
+                else:
+                    sid, rev = self.reserve_sid(), 1
+                lists.append([sid, rev, chunk])
+                rules.append(self.build_rule(action, chunk, number + 1, sid, rev))
+            self.lists[action] = lists
+        return rules
+
+    def files(self) -> dict[Path, str]:
+        return {self.path: "".join(f"{rule}\n" for rule in self.rules())}
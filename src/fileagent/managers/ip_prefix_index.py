@@ -0,0 +1,342 @@
+from collections import Counter, namedtuple
+from pathlib import Path
+import json
+import os
+import threading
+from fileagent.managers.ip_aggregator import CidrSet
+from fileagent.managers.rule_rewriter import OffsetLog
+
+
+# A rule that has a prefix in its `field` (src_ip or dst_ip). A `plain` rule matches all the
+# traffic of the prefix: the other side is any/any, and it has no option that narrows it.
+PrefixEntry = namedtuple("PrefixEntry", "offset sid action protocol field plain")
+
+
+class IpPrefixIndex:
+    """
+    Description:
+        Index of the IPv4/IPv6 addresses and CIDR prefixes in the headers (`src_ip` and
+        `dst_ip`) of the rules of the rules file, to find the rules that cover an address.
+
+        It works as a binary prefix trie whose nodes are addressed directly by their
+        `(version, network as int, prefix length)` key, as in `CidrSet`: only the nodes
+        that hold rules exist, and a lookup walks the prefix lengths in use from the
+        longest to the shortest, so it is O(prefix length) without the millions of
+        intermediate nodes of a trie of /32s. A rule is referred to by the byte offset it
+        starts at in the rules file.
+
+        Like the rule index, it is saved to a sidecar file with the state of the reader
+        that indexed the rules file, so a restart does not parse the rules file again, and
+        it follows the rewrites of the rules file through an offset log.
+    """
+
+    SIDECAR_VERSION = 1
+
+    # The options that only describe a rule, and do not narrow what it matches
+    GENERAL_OPTIONS = ("msg", "sid", "rev", "gid", "classtype", "priority", "metadata", "reference")
+
+    def __init__(self):
+        self.prefixes: dict[tuple[int, int, int], list[PrefixEntry]] = {}
+        # The prefixes negated inside a list (`[10.0.0.0/8,!10.1.1.1]`), they are holes
+        # in the prefixes of the same rule and field
+        self.excluded: dict[tuple[int, int, int], list[tuple[int, str]]] = {}
+        self.lengths: dict[int, Counter] = {4: Counter(), 6: Counter()}
+        self.signature: tuple[int, int] | None = None
+        # The rewrites the offsets of the entries were not moved through yet
+        self.moves = OffsetLog()
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.prefixes)
+
+    def clear(self):
+        with self.lock:
+            self.prefixes.clear()
+            self.excluded.clear()
+            self.lengths = {4: Counter(), 6: Counter()}
+            self.moves.clear()
+            self.signature = None
+
+    @staticmethod
+    def addresses(value: str | None) -> list[tuple[str, bool]]:
+        """
+        Description:
+            Get the addresses and prefixes of an address field of a rule header. `any`,
+            variables (`$HOME_NET`) and a negated field match more than the addresses
+            themselves, and are left out.
+
+        Returns:
+            list[tuple[str, bool]]: The addresses, and whether they are negated inside the
+            list, e.g. `[("10.0.0.0/8", False), ("10.1.1.1", True)]` for `[10.0.0.0/8,!10.1.1.1]`.
+        """
+        if not value or value.startswith("!"):
+            return []
+        addresses = []
+        for address in value.replace("[", "").replace("]", "").split(","):
+            negated = address.startswith("!")
+            address = address.removeprefix("!")
+            if address and not address.startswith("$") and address != "any":
+                addresses.append((address, negated))
+        return addresses
+
+    @classmethod
+    def is_plain(cls, rule, field: str) -> bool:
+        if field == "src_ip":
+            other = (rule.src_port, rule.dst_ip, rule.dst_port)
+        else:
+            other = (rule.dst_port, rule.src_ip, rule.src_port)
+        if rule.direction not in ("->", "<>") or any(value != "any" for value in other):
+            return False
+        return all(option.startswith(cls.GENERAL_OPTIONS) for option in rule.options)
+
+    def add(self, offset: int, rule):
+        """
+        Description:
+            Index the addresses of a rule.
+
+        Args:
+            offset (int): The byte offset the rule starts at in the rules file.
+            rule (SnortRule): The parsed rule.
+        """
+        with self.lock:
+            if (offset := self.moves.base(offset)) is None:
+                return
+            for field in ("src_ip", "dst_ip"):
+                for address, negated in self.addresses(getattr(rule, field)):
+                    try:
+                        key = CidrSet.key(address)
+                    except ValueError:
+                        continue
+                    if negated:
+                        self.excluded.setdefault(key, []).append((offset, field))
+                        continue
+                    entry = PrefixEntry(
+                        offset, rule.sid, rule.action, rule.protocol, field, self.is_plain(rule, field)
+                    )
+                    entries = self.prefixes.setdefault(key, [])
+                    if entry not in entries:
+                        if not entries:
+                            self.lengths[key[0]][key[2]] += 1
+                        entries.append(entry)
+
+    def discard(self, offset: int, rule):
+        """
+        Description:
+            Drop the entries of a rule, e.g. one that is about to be cut out of the rules file.
+
+        Args:
+            offset (int): The byte offset the rule starts at in the rules file.
+            rule (SnortRule): The parsed rule.
+        """
+        with self.lock:
+            if (offset := self.moves.base(offset)) is None:
+                return
+            for field in ("src_ip", "dst_ip"):
+                for address, negated in self.addresses(getattr(rule, field)):
+                    try:
+                        key = CidrSet.key(address)
+                    except ValueError:
+                        continue
+                    if negated:
+                        if key in self.excluded:
+                            holes = [hole for hole in self.excluded[key] if hole[0] != offset]
+                            if holes:
+                                self.excluded[key] = holes
+                            else:
+                                del self.excluded[key]
+                        continue
+                    if key not in self.prefixes:
+                        continue
+                    entries = [entry for entry in self.prefixes[key] if entry.offset != offset]
+                    if entries:
+                        self.prefixes[key] = entries
+                    else:
+                        del self.prefixes[key]
+                        self.lengths[key[0]][key[2]] -= 1
+                        if not self.lengths[key[0]][key[2]]:
+                            del self.lengths[key[0]][key[2]]
+
+    def splice(self, shift):
+        """
+        Description:
+            Follow a rewrite of the rules file that cut rules out of it (their entries are
+            dropped beforehand with `discard`): the rewrite goes to the offset log, and the
+            offsets of the entries are moved when they are read.
+
+        Args:
+            shift (OffsetShift): Maps the offsets before the rewrite to the offsets after it.
+        """
+        with self.lock:
+            if self.moves.push(shift):
+                self.apply_moves()
+
+    def apply_moves(self):
+        """
+        Description:
+            Move the offsets of every entry through the offset log, and clear it.
+        """
+        with self.lock:
+            moves = self.moves
+            if not moves:
+                return
+            first, move = moves.first, moves.composed()
+            prefixes = {}
+            lengths = {4: Counter(), 6: Counter()}
+            for key, entries in self.prefixes.items():
+                entries = [
+                    entry if entry.offset < first else PrefixEntry(moved, *entry[1:])
+                    for entry in entries
+                    if entry.offset < first or (moved := move(entry.offset)) is not None
+                ]
+                if entries:
+                    prefixes[key] = entries
+                    lengths[key[0]][key[2]] += 1
+            excluded = {}
+            for key, holes in self.excluded.items():
+                holes = [
+                    (moved, field) for offset, field in holes if (moved := move(offset)) is not None
+                ]
+                if holes:
+                    excluded[key] = holes
+            self.prefixes, self.excluded, self.lengths = prefixes, excluded, lengths
+            moves.clear()
+
+    def moved(self, entry: PrefixEntry) -> PrefixEntry:
+        # The entry with its current offset
+        if not self.moves:
+            return entry
+        return PrefixEntry(self.moves(entry.offset), *entry[1:])
+
+    def lookup(self, network) -> list[tuple[tuple[int, int, int], PrefixEntry]]:
+        """
+        Description:
+            Find the rules with a prefix that contains the network (or address).
+
+        Returns:
+            list[tuple]: The (prefix key, entry) of every rule, the longest prefixes first.
+        """
+        version, start, length = CidrSet.key(network)
+        bits = CidrSet.BITS[version]
+        matches = []
+        with self.lock:
+            for prefix in sorted(self.lengths[version], reverse=True):
+                if prefix > length:
+                    continue
+                key = (version, start & ~((1 << (bits - prefix)) - 1), prefix)
+                matches.extend((key, entry) for entry in self.prefixes.get(key, ()))
+
+            if matches and self.excluded:
+                holes = set()
+                for prefix in range(length, -1, -1):
+                    key = (version, start & ~((1 << (bits - prefix)) - 1), prefix)
+                    holes.update(self.excluded.get(key, ()))
+                matches = [
+                    (key, entry) for key, entry in matches if (entry.offset, entry.field) not in holes
+                ]
+            if self.moves:
+                matches = [(key, self.moved(entry)) for key, entry in matches]
+        return matches
+
+    def exact(self, network) -> list[PrefixEntry]:
+        """
+        Description:
+            Get the rules of the prefix itself, not of the prefixes that contain it.
+        """
+        key = network if isinstance(network, tuple) else CidrSet.key(network)
+        with self.lock:
+            return [self.moved(entry) for entry in self.prefixes.get(key, ())]
+
+    def covering(self, network, action: str, protocol: str, field: str = "src_ip"):
+        """
+        Description:
+            Find a plain rule that already matches all the traffic a rule for the network
+            would match: same action, on the same side, and the same protocol (or `ip`).
+
+        Returns:
+            PrefixEntry | None: The entry of the covering rule, if there is one.
+        """
+        for _, entry in self.lookup(network):
+            if (
+                entry.plain
+                and entry.action == action
+                and entry.field == field
+                and entry.protocol in (protocol, "ip")
+            ):
+                return entry
+        return None
+
+    def save(self, sidecar, reader_state: dict):
+        """
+        Description:
+            Save the index to a sidecar file, along with the state of the reader that
+            indexed the rules file: a JSON header line, followed by the prefixes and their
+            rules as a JSON line.
+
+        Args:
+            sidecar (str | Path): The sidecar file.
+            reader_state (dict): The state of the reader, see `RuleReader.state`.
+        """
+        sidecar = Path(sidecar)
+        with self.lock:
+            self.apply_moves()
+            header = {
+                "version": self.SIDECAR_VERSION,
+                "signature": self.signature,
+                "reader": reader_state,
+            }
+            body = {
+                "prefixes": [[*key, entries] for key, entries in self.prefixes.items()],
+                "excluded": [[*key, holes] for key, holes in self.excluded.items()],
+            }
+
+        temp_file = sidecar.with_name(f"{sidecar.name}.tmp")
+        with open(temp_file, "w") as file:
+            file.write(json.dumps(header) + "\n")
+            file.write(json.dumps(body, separators=(",", ":")) + "\n")
+        os.replace(temp_file, sidecar)
+
+    def load(self, sidecar) -> dict | None:
+        """
+        Description:
+            Load the index from a sidecar file written by `save`.
+
+        Args:
+            sidecar (str | Path): The sidecar file.
+
+        Returns:
+            dict | None: The state of the reader to continue from, or None if there is no
+            usable sidecar (missing, from another version or truncated).
+        """
+        try:
+            with open(sidecar, "r") as file:
+                header = json.loads(file.readline())
+                body = json.loads(file.readline())
+        except (FileNotFoundError, json.JSONDecodeError, UnicodeDecodeError):
+            return None
+
+        if not isinstance(header, dict) or header.get("version") != self.SIDECAR_VERSION:
+            return None
+
+        # The actions, protocols and fields repeat across the entries, they share one string each
+        strings = {}
+        with self.lock:
+            self.clear()
+            for version, start, length, entries in body["prefixes"]:
+                self.prefixes[(version, start, length)] = [
+                    PrefixEntry(
+                        offset,
+                        sid,
+                        strings.setdefault(action, action),
+                        strings.setdefault(protocol, protocol),
+                        strings.setdefault(field, field),
+                        plain,
+                    )
+                    for offset, sid, action, protocol, field, plain in entries
+                ]
+                self.lengths[version][length] += 1
+            for version, start, length, holes in body["excluded"]:
+                self.excluded[(version, start, length)] = [
+                    (offset, strings.setdefault(field, field)) for offset, field in holes
+                ]
+            self.signature = tuple(header["signature"]) if header["signature"] else None
+        return header["reader"]
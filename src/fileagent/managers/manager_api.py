@@ -1,12 +1,18 @@
 from __future__ import annotations
 
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Query
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 from enum import Enum
 from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import functools
 import uvicorn
 import time
+from fileagent.managers.manager_snort import DuplicateRuleError
+from fileagent.managers.sid_allocator import SidRangeExhaustedError
 
 
 # ---------- OpenAPI Models ----------
@@ -45,11 +51,64 @@ class UploadPayload(BaseModel):
         None,
         description="Optional reference label stored with history (not used for translation).",
     )
+    ttl_seconds: Optional[int] = Field(
+        None,
+        gt=0,
+        description=(
+            "Optional lifetime of the rule, in seconds. The rule is removed from the rules "
+            "file once it expires, and the removal is recorded in the history."
+        ),
+    )
+
+
+class IpListEntry(BaseModel):
+    source: str = Field(..., description="The lists: `ip_lists` or `reputation`.")
+    action: str = Field(..., description="The action of the list, e.g. `block`.")
+    prefix: str = Field(..., description="The address or prefix in the list.")
 
 
 class UploadResponse(BaseModel):
     message: str = Field(..., description="Confirmation message.")
-    rule: str = Field(..., description="The Snort rule derived from the payload.")
+    rule: Optional[str] = Field(
+        None,
+        description="The Snort rule derived from the payload, unless it went into the IP lists.",
+    )
+    ip_list: Optional[IpListEntry] = Field(
+        None,
+        description="The entry of the IP lists that holds the target, if it was aggregated into them.",
+    )
+
+
+class BatchItemStatus(str, Enum):
+    """
+    Outcome of a single payload of a batch upload.
+    """
+
+    added = "added"
+    duplicate = "duplicate"
+    failed = "failed"
+
+
+class BatchItemResult(BaseModel):
+    index: int = Field(..., description="Position of the payload in the request.")
+    status: BatchItemStatus = Field(..., description="Outcome for this payload.")
+    rule: Optional[str] = Field(
+        None, description="The Snort rule derived from the payload, if any."
+    )
+    ip_list: Optional[IpListEntry] = Field(
+        None, description="The entry of the IP lists that holds the target, if it was aggregated."
+    )
+    detail: Optional[str] = Field(
+        None, description="Why the payload was not added, if it was not."
+    )
+
+
+class BatchUploadResponse(BaseModel):
+    message: str = Field(..., description="Confirmation message.")
+    added: int = Field(..., description="Number of rules appended to the rules file.")
+    results: List[BatchItemResult] = Field(
+        default_factory=list, description="Per payload results, in request order."
+    )
 
 
 class ErrorResponse(BaseModel):
@@ -71,7 +130,129 @@ class NotificationsResponse(BaseModel):
     )
     timestamp: float = Field(..., description="Unix epoch seconds at response time.")
     notifications: List[Any] = Field(
-        default_factory=list, description="Older history records (may be empty)."
+        default_factory=list,
+        description="History records of the requested window, oldest first (may be empty).",
+    )
+    next_cursor: Optional[int] = Field(
+        None,
+        description="Cursor of the next window. Pass it back as `cursor` to continue, or to poll for new records.",
+    )
+
+
+class LookupMatch(BaseModel):
+    source: str = Field(
+        ...,
+        description="Where the match is: `rules` (the rules file), `ip_lists` or `reputation`.",
+    )
+    prefix: Optional[str] = Field(
+        None, description="The address or prefix that contains the queried address."
+    )
+    domain: Optional[str] = Field(
+        None, description="The domain, the queried one or a parent, the rule matches."
+    )
+    action: str = Field(..., description="The action of the rule or list, e.g. `block`.")
+    protocol: Optional[str] = Field(None, description="The protocol of the rule.")
+    field: Optional[str] = Field(
+        None, description="The header field of the rule with the prefix (`src_ip` or `dst_ip`)."
+    )
+    sid: Optional[int] = Field(None, description="The sid of the rule.")
+    rule: Optional[str] = Field(None, description="The rule.")
+
+
+class LookupResponse(BaseModel):
+    query: str = Field(..., description="The address or domain that was looked up.")
+    matches: List[LookupMatch] = Field(
+        default_factory=list,
+        description="The rules and lists that match it, the most specific rules first.",
+    )
+
+
+class RulePatch(BaseModel):
+    """
+    Body of PATCH /rules/{sid}: either a whole new rule, or a new message for the rule.
+    """
+
+    rule: Optional[str] = Field(
+        None, description="The new Snort rule. It keeps the sid of the rule it replaces."
+    )
+    msg: Optional[str] = Field(None, description="The new message of the rule.")
+
+
+class RuleUpdateResponse(BaseModel):
+    message: str = Field(..., description="Confirmation message.")
+    rule: str = Field(..., description="The rule as it is now, with its `rev` bumped.")
+    previous: str = Field(..., description="The rule as it was.")
+
+
+class RuleDeleteResponse(BaseModel):
+    message: str = Field(..., description="Confirmation message.")
+    deleted: int = Field(
+        ..., description="Number of rules removed from the rules file, and of entries removed from the IP lists."
+    )
+    rules: List[str] = Field(default_factory=list, description="The removed rules.")
+    ip_lists: List[IpListEntry] = Field(
+        default_factory=list, description="The addresses and prefixes removed from the IP lists."
+    )
+
+
+class CompactResponse(BaseModel):
+    message: str = Field(..., description="Confirmation message.")
+    rules_before: int = Field(..., description="Number of rules before the compaction.")
+    rules_after: int = Field(..., description="Number of rules after the compaction.")
+    exact_duplicates: int = Field(..., description="Identical rules that were dropped.")
+    semantic_duplicates: int = Field(
+        ...,
+        description="Rules that only differed by sid, rev, option order or whitespace and were dropped.",
+    )
+    lines_before: int = Field(..., description="Lines of the rules file before.")
+    lines_after: int = Field(..., description="Lines of the rules file after.")
+    bytes_before: int = Field(..., description="Size of the rules file before.")
+    bytes_after: int = Field(..., description="Size of the rules file after.")
+    parse_seconds_before: float = Field(
+        ..., description="Seconds it took to read and parse every rule before."
+    )
+    parse_seconds_after: float = Field(
+        ..., description="Seconds it takes to read and parse every rule after."
+    )
+
+
+class ReloadMetrics(BaseModel):
+    trigger: str = Field(..., description="How Snort is made to reload, e.g. `signal SIGHUP to 1234`.")
+    window: float = Field(..., description="Seconds the changes are collected for before a reload.")
+    reloads: int = Field(..., description="Number of reloads of Snort.")
+    failed_reloads: int = Field(..., description="Number of reloads that failed (and were retried).")
+    changes: int = Field(..., description="Number of rule changes folded into the reloads.")
+    reloaded_elsewhere: int = Field(
+        0, description="Number of rule changes folded into a reload of another process."
+    )
+    pending_changes: int = Field(..., description="Number of rule changes waiting for the next reload.")
+    folded: List[int] = Field(
+        default_factory=list,
+        description="Number of changes folded into each of the last reloads, oldest first.",
+    )
+    mean_folded: Optional[float] = Field(None, description="Mean number of changes per reload.")
+    max_folded: Optional[int] = Field(
+        None, description="Most changes folded into one of the last reloads."
+    )
+    last_reload: Optional[float] = Field(
+        None, description="Unix epoch seconds of the last reload."
+    )
+    last_reload_seconds: Optional[float] = Field(
+        None, description="Seconds the last reload took to trigger."
+    )
+    last_error: Optional[str] = Field(None, description="Why the last reload failed, if it did.")
+
+
+class BackupMetrics(BaseModel):
+    source: str = Field(..., description="The rules file that is backed up.")
+    mode: str = Field(..., description="The backup mode, `full` or `delta`.")
+    coalesced: int = Field(
+        ..., description="Number of copies replaced by a later one before they were written."
+    )
+    failures: int = Field(..., description="Number of backups that failed.")
+    last_error: Optional[str] = Field(None, description="Why the last backup failed, if one did.")
+    last_failure: Optional[float] = Field(
+        None, description="Unix epoch seconds of the last failed backup."
     )
 
 
@@ -83,19 +264,27 @@ class ManagerAPI:
     Notes
     -----
     - The /upload route triggers the pipeline:
-      rule_translator -> rule_exists (duplicate check) -> append_rule -> save_history
+      prepare_rule (translation + duplicate check) -> rule_writer (group commit of append + history)
     - The concrete implementations live on this same instance (mixed-in via ManagerSnort/ManagerFiles).
     """
 
     # Default host/port may be provided by a parent mixin in the user's project.
     host: str = "0.0.0.0"
     port: int = 8000
+    # The environment variable the worker processes get the options of the agent from
+    OPTIONS_ENV = "FILEAGENT_OPTIONS"
 
     def __init__(self, *args, **kwargs):
         # Initialize app with richer OpenAPI/Swagger metadata
         self.port = kwargs.get("port", getattr(self, "port", 8000))
         self.host = kwargs.get("host", getattr(self, "host", "0.0.0.0"))
 
+        # File work is never done on the event loop, but on a bounded pool of threads
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=self.get_option(kwargs, "io_workers", 4),
+            thread_name_prefix="fileagent-io",
+        )
+
         tags = [
             {"name": "Rules", "description": "Create and manage Snort rules."},
             {
@@ -110,16 +299,47 @@ class ManagerAPI:
                 "HTTP interface for translating high‑level security actions into Snort 3 rules "
                 "and appending the result to a rules file.\n\n"
                 "This API is designed to be composed with `ManagerSnort` (for rule building) "
-                "and a file/history mixin that provides `get_file_content`, `append_rule`, "
-                "`save_history`, `file_backup`, and `rules_file`.\n"
+                "and a file/history mixin that provides `append_rule`, "
+                "`save_history`, `read_history`, `file_backup`, and `rules_file`.\n"
             ),
             version="1.0.0",
             openapi_tags=tags,
             contact={"name": "Snort Manager", "url": "https://example.local"},
+            lifespan=self.lifespan,
         )
         self.setup_routes()
         super().__init__(*args, **kwargs)
 
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI):
+        """Startup/shutdown of the background resources of the API."""
+        self.rule_writer.start()
+        yield
+        # Commit the rules that are still queued before letting go of the process
+        await self.run_io(self.rule_writer.stop)
+        for store in self.rule_stores():
+            await self.run_io(store.backup_store.stop)
+        if self.ip_aggregator is not None:
+            await self.run_io(self.ip_aggregator.stop)
+        for store in self.rule_stores():
+            await self.run_io(store.rule_expiry.stop)
+        if self.snort_reloader is not None:
+            await self.run_io(self.snort_reloader.stop)
+        for store in self.rule_stores():
+            await self.run_io(store.save_rule_index)
+            await self.run_io(store.save_target_indexes)
+        self.io_executor.shutdown(wait=True)
+
+    async def run_io(self, func, *args, **kwargs):
+        """
+        Run blocking (file) work on the I/O thread pool, so that a slow disk does not
+        stall the event loop and every other request with it.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.io_executor, functools.partial(func, *args, **kwargs)
+        )
+
     def setup_routes(self) -> None:
         """Register routes on the FastAPI app."""
 
@@ -139,16 +359,19 @@ class ManagerAPI:
                     "model": ErrorResponse,
                     "description": "Internal error while persisting the rule.",
                 },
+                507: {
+                    "model": ErrorResponse,
+                    "description": "No free sids left in the configured sid range.",
+                },
             },
             tags=["Rules"],
             summary="Translate payload to a Snort rule and persist",
             description=(
                 "Accepts a JSON payload and translates it into a Snort rule via `rule_translator`.\n\n"
                 "Pipeline:\n"
-                "1. **Translate** with `rule_translator(payload)`\n"
-                "2. **Duplicate check** with `rule_exists(rule)`\n"
-                "3. **Append** with `append_rule(payload)`\n"
-                "4. **Record** with `save_history(payload)`\n\n"
+                "1. **Translate** and **duplicate check** once with `prepare_rule(payload)`\n"
+                "2. **Append** and **record** through the rules writer, which group commits "
+                "concurrent requests with `commit_rules(contexts)`\n\n"
                 "Accepted commands (from ManagerSnort): `block_ip`, `block_domain`, `alert_ip`, "
                 "`alert_domain`, `block_icmp`, `custom`.\n"
                 "- For `custom`, provide the full Snort rule in `target`.\n"
@@ -207,18 +430,15 @@ class ManagerAPI:
             if not payload:
                 raise HTTPException(status_code=400, detail="Empty JSON payload")
 
-            # Attempt translation if available
-            rule: Optional[str] = None
+            # Translate and check for duplicates, once for the whole request
             try:
-                if hasattr(self, "rule_translator"):
-                    # ManagerSnort.rule_translator expects a dict
-                    rule = self.rule_translator(payload.model_dump())
+                context = await self.run_io(self.prepare_rule, payload.model_dump())
             except HTTPException:
                 raise
             except Exception as exc:
                 raise HTTPException(status_code=400, detail=f"Translation error: {exc}")
 
-            if not rule:
+            if not context.rule:
                 raise HTTPException(
                     status_code=400,
                     detail=(
@@ -227,68 +447,356 @@ class ManagerAPI:
                     ),
                 )
 
-            # Duplicate check
-            try:
-                if hasattr(self, "rule_exists") and self.rule_exists(rule):
-                    raise HTTPException(status_code=409, detail="Duplicate rule")
-            except HTTPException:
-                raise
-            except Exception:
-                # If duplicate check fails for any reason, continue cautiously
-                pass
+            if context.duplicate:
+                raise HTTPException(status_code=409, detail="Duplicate rule")
 
-            # Append and save
+            # Append and save, through the single writer of the rules file
             try:
-                if hasattr(self, "append_rule"):
-                    # Existing implementation expects the original payload dict
-                    self.append_rule(payload.model_dump())
-                if hasattr(self, "save_history"):
-                    self.save_history(payload.model_dump())
+                await asyncio.wrap_future(self.rule_writer.submit([context]))
+            except SidRangeExhaustedError as exc:
+                raise HTTPException(status_code=507, detail=str(exc))
             except Exception as exc:
                 raise HTTPException(
                     status_code=500, detail=f"Failed to persist rule: {exc}"
                 )
 
+            # Another request may have committed the same rule first
+            if context.duplicate:
+                raise HTTPException(status_code=409, detail="Duplicate rule")
+
+            if context.aggregate:
+                return UploadResponse(
+                    message="JSON payload received and added to the IP lists",
+                    ip_list=self.ip_list_entry(context),
+                )
             return UploadResponse(
-                message="JSON payload received and processed", rule=rule
+                message="JSON payload received and processed", rule=context.rule
+            )
+
+        @self.app.post(
+            "/upload/batch",
+            response_model=BatchUploadResponse,
+            responses={
+                400: {"model": ErrorResponse, "description": "Empty batch."},
+                500: {
+                    "model": ErrorResponse,
+                    "description": "Internal error while persisting the rules.",
+                },
+                507: {
+                    "model": ErrorResponse,
+                    "description": "Not enough free sids left in the configured sid range.",
+                },
+            },
+            tags=["Rules"],
+            summary="Translate many payloads to Snort rules and persist them at once",
+            description=(
+                "Accepts a JSON list of payloads, with the same schema as `/upload`.\n\n"
+                "Pipeline:\n"
+                "1. **Translate** every payload with `prepare_rule(payload)`\n"
+                "2. **Duplicate check** against the rules file and the rest of the batch\n"
+                "3. **Append** and **record** all new rules through the rules writer "
+                "(one backup, one write, one history write)\n\n"
+                "The response reports the outcome of each payload, in request order."
+            ),
+        )
+        async def upload_batch(
+            payloads: List[UploadPayload] = Body(...),
+        ) -> BatchUploadResponse:
+            if not payloads:
+                raise HTTPException(status_code=400, detail="Empty batch")
+
+            contexts = await self.run_io(
+                self.prepare_rules, [payload.model_dump() for payload in payloads]
+            )
+
+            try:
+                if pending := [c for c in contexts if c.rule and not c.duplicate]:
+                    await asyncio.wrap_future(self.rule_writer.submit(pending))
+            except SidRangeExhaustedError as exc:
+                raise HTTPException(status_code=507, detail=str(exc))
+            except Exception as exc:
+                raise HTTPException(
+                    status_code=500, detail=f"Failed to persist rules: {exc}"
+                )
+
+            results: List[BatchItemResult] = []
+            for index, context in enumerate(contexts):
+                if context.error:
+                    result = BatchItemResult(
+                        index=index,
+                        status=BatchItemStatus.failed,
+                        detail=f"Translation error: {context.error}",
+                    )
+                elif not context.rule:
+                    result = BatchItemResult(
+                        index=index,
+                        status=BatchItemStatus.failed,
+                        detail="Translation failed or returned no rule.",
+                    )
+                elif context.duplicate:
+                    result = BatchItemResult(
+                        index=index,
+                        status=BatchItemStatus.duplicate,
+                        rule=None if context.aggregate else context.rule,
+                        detail="Duplicate rule",
+                    )
+                elif context.aggregate:
+                    result = BatchItemResult(
+                        index=index,
+                        status=BatchItemStatus.added,
+                        ip_list=self.ip_list_entry(context),
+                    )
+                else:
+                    result = BatchItemResult(
+                        index=index, status=BatchItemStatus.added, rule=context.rule
+                    )
+                results.append(result)
+
+            return BatchUploadResponse(
+                message="JSON batch received and processed",
+                added=sum(r.status == BatchItemStatus.added for r in results),
+                results=results,
             )
 
+        @self.app.get(
+            "/rules/lookup",
+            response_model=LookupResponse,
+            responses={
+                400: {"model": ErrorResponse, "description": "Missing or invalid address or domain."},
+            },
+            tags=["Rules"],
+            summary="Find the rules that match an address or a domain",
+            description=(
+                "Answers \"is this address or domain already blocked or alerted, and by which rule?\".\n\n"
+                "- `ip` is an IPv4/IPv6 address or a CIDR network. The rules with an address or "
+                "prefix that contains it in their `src_ip` or `dst_ip` are returned, the most "
+                "specific first, with the IP lists or reputation lists that contain it.\n"
+                "- `domain` is a domain. The rules of the domain and of its parent domains "
+                "(e.g. `example.com` for `www.example.com`) are returned, the most specific first.\n"
+            ),
+        )
+        async def lookup(
+            ip: Optional[str] = Query(None, description="The address to look up, e.g. `10.1.39.20`."),
+            domain: Optional[str] = Query(
+                None, description="The domain to look up, e.g. `www.example.com`."
+            ),
+        ) -> LookupResponse:
+            if bool(ip) == bool(domain):
+                raise HTTPException(
+                    status_code=400, detail="Provide either an `ip` or a `domain` to look up"
+                )
+            try:
+                if ip:
+                    matches = await self.run_io(self.lookup_ip, ip)
+                else:
+                    matches = await self.run_io(self.lookup_domain, domain)
+            except ValueError as exc:
+                raise HTTPException(status_code=400, detail=str(exc))
+            return LookupResponse(query=ip or domain, matches=matches)
+
+        @self.app.delete(
+            "/rules/{sid}",
+            response_model=RuleDeleteResponse,
+            responses={404: {"model": ErrorResponse, "description": "No rule has the sid."}},
+            tags=["Rules"],
+            summary="Delete a rule by sid",
+            description=(
+                "Removes the rule with the sid from the rules file. The rule is found through "
+                "the rule index and the file is rewritten atomically around it, so the cost "
+                "does not depend on the size of the rules file. The deletion is recorded in "
+                "the history.\n"
+            ),
+        )
+        async def delete_rule(sid: int) -> RuleDeleteResponse:
+            rules, _ = await self.run_io(self.delete_rules, sids=[sid])
+            if not rules:
+                raise HTTPException(status_code=404, detail=f"No rule with sid {sid}")
+            return RuleDeleteResponse(message="Rule deleted", deleted=len(rules), rules=rules)
+
+        @self.app.delete(
+            "/rules",
+            response_model=RuleDeleteResponse,
+            responses={400: {"model": ErrorResponse, "description": "Missing or invalid target."}},
+            tags=["Rules"],
+            summary="Delete the rules of addresses or domains",
+            description=(
+                "Removes the rules of every `target` (repeat the parameter for several) with a "
+                "single rewrite of the rules file:\n"
+                "- for an address or CIDR network, the rules with it in their `src_ip` or "
+                "`dst_ip` (the rules that only have it in a list of addresses are kept)\n"
+                "- for a domain, the rules of the domain (not of its parents or subdomains)\n\n"
+                "Addresses and networks are also removed from the IP lists they were "
+                "aggregated into (`--aggregate-ips`, `--reputation-lists`). A prefix that "
+                "an address was merged into is split, so its other addresses stay listed.\n"
+            ),
+        )
+        async def delete_rules_of_targets(
+            target: List[str] = Query(
+                ..., description="An address, CIDR network or domain, e.g. `10.1.39.20`."
+            ),
+        ) -> RuleDeleteResponse:
+            try:
+                rules, entries = await self.run_io(self.delete_rules, targets=target)
+            except ValueError as exc:
+                raise HTTPException(status_code=400, detail=str(exc))
+            return RuleDeleteResponse(
+                message="Rules deleted",
+                deleted=len(rules) + len(entries),
+                rules=rules,
+                ip_lists=entries,
+            )
+
+        @self.app.patch(
+            "/rules/{sid}",
+            response_model=RuleUpdateResponse,
+            responses={
+                400: {"model": ErrorResponse, "description": "Invalid patch or rule."},
+                404: {"model": ErrorResponse, "description": "No rule has the sid."},
+                409: {
+                    "model": ErrorResponse,
+                    "description": "The new rule is already in the rules file.",
+                },
+            },
+            tags=["Rules"],
+            summary="Update a rule by sid",
+            description=(
+                "Replaces the rule with the sid, in place, by the given `rule` or by the same "
+                "rule with the given `msg`. The rule keeps its sid and its `rev` is bumped. "
+                "Like a deletion, only the rule itself is read and the file is rewritten "
+                "atomically. The update is recorded in the history.\n"
+            ),
+        )
+        async def patch_rule(sid: int, patch: RulePatch = Body(...)) -> RuleUpdateResponse:
+            try:
+                rule, previous = await self.run_io(
+                    self.update_rule, sid, rule=patch.rule, msg=patch.msg
+                )
+            except KeyError:
+                raise HTTPException(status_code=404, detail=f"No rule with sid {sid}")
+            except DuplicateRuleError as exc:
+                raise HTTPException(status_code=409, detail=str(exc))
+            except ValueError as exc:
+                raise HTTPException(status_code=400, detail=str(exc))
+            return RuleUpdateResponse(message="Rule updated", rule=rule, previous=previous)
+
+        @self.app.post(
+            "/rules/compact",
+            response_model=CompactResponse,
+            responses={
+                400: {"model": ErrorResponse, "description": "Unknown shard."},
+                500: {"model": ErrorResponse, "description": "The rules file could not be rewritten."},
+            },
+            tags=["Rules"],
+            summary="Rewrite the rules file in compact form",
+            description=(
+                "Rewrites the rules file atomically (temporary file, fsync, rename) with one line "
+                "per rule, in canonical form, without exact or semantic duplicates (same rule up "
+                "to sid, rev, option order and whitespace), ordered by sid. The comments are kept "
+                "at the top. The rules file is backed up first.\n\n"
+                "With sharded rules the shards are compacted too, or only the one given as `shard` "
+                "(e.g. `block_ip`).\n\n"
+                "The response reports the rules, lines and bytes before and after, and the time "
+                "it takes to parse the file before and after.\n"
+            ),
+        )
+        async def compact_rules(
+            shard: Optional[str] = Query(
+                None, description="The command family of the only shard to compact."
+            ),
+        ) -> CompactResponse:
+            try:
+                stats = await self.run_io(self.compact_rules_file, shard)
+            except ValueError as exc:
+                raise HTTPException(status_code=400, detail=str(exc))
+            except OSError as exc:
+                raise HTTPException(status_code=500, detail=f"Failed to compact the rules file: {exc}")
+            return CompactResponse(message="Rules file compacted", **stats)
+
+        @self.app.get(
+            "/metrics/reload",
+            response_model=ReloadMetrics,
+            responses={404: {"model": ErrorResponse, "description": "No reload trigger is configured."}},
+            tags=["Rules"],
+            summary="Metrics of the Snort reloads",
+            description=(
+                "After the rules change, Snort is made to reload its configuration through the "
+                "configured trigger (a command, a signal to its process or a control socket "
+                "message), at most once per window, so a burst of changes costs a single "
+                "reload. Reports the reloads and how many changes were folded into each.\n"
+            ),
+        )
+        async def reload_metrics() -> ReloadMetrics:
+            if self.snort_reloader is None:
+                raise HTTPException(status_code=404, detail="No reload trigger is configured")
+            return ReloadMetrics(**self.snort_reloader.metrics())
+
+        @self.app.get(
+            "/metrics/backups",
+            response_model=List[BackupMetrics],
+            tags=["Rules"],
+            summary="Metrics of the backups",
+            description=(
+                "The backups of the rules file (and of its shards) are written by a background "
+                "worker. Reports, for every rules file, the copies that were folded into a "
+                "later one and the backups that failed.\n"
+            ),
+        )
+        async def backup_metrics() -> List[BackupMetrics]:
+            return [BackupMetrics(**store.backup_store.metrics()) for store in self.rule_stores()]
+
         @self.app.get(
             "/notifications",
             response_model=NotificationsResponse,
+            responses={400: {"model": ErrorResponse, "description": "Invalid `since` time."}},
             tags=["Notifications"],
             summary="Retrieve processing notifications/history",
             description=(
-                "Returns the stored history/notifications. This endpoint relies on a mixin that provides:\n"
-                "- `get_file_content(history_file, 'json')` to read history\n"
-                "- `history_file` attribute pointing to the history store\n"
+                "Returns a window of the stored history/notifications, oldest first.\n\n"
+                "- `limit` caps the number of records returned\n"
+                "- `cursor` continues from the `next_cursor` of a previous response\n"
+                "- `since` only returns records at or after a time "
+                "(`YYYY-MM-DD HH:MM:SS` or Unix epoch seconds)\n\n"
+                "This endpoint relies on a mixin that provides:\n"
+                "- `read_history_page(cursor, limit, since)` to read a window of the history log\n"
             ),
         )
-        async def notifications() -> NotificationsResponse:
+        async def notifications(
+            limit: int = Query(100, ge=1, le=1000, description="Maximum number of records."),
+            cursor: Optional[int] = Query(
+                None, ge=0, description="`next_cursor` of the previous response."
+            ),
+            since: Optional[str] = Query(
+                None, description="Only records at or after this time."
+            ),
+        ) -> NotificationsResponse:
             # function from manager_files.py (not part of this file)
-            if not hasattr(self, "get_file_content") or not hasattr(
-                self, "history_file"
-            ):
+            if not hasattr(self, "read_history_page"):
                 raise HTTPException(
                     status_code=500,
                     detail="History backend not configured on this instance.",
                 )
 
-            notifications = self.get_file_content(self.history_file, "json")
-            if notifications is None:
-                raise HTTPException(status_code=404, detail="No notifications found")
-
-            history = notifications.get("history")
+            try:
+                history, next_cursor = await self.run_io(
+                    self.read_history_page, cursor=cursor, limit=limit, since=since
+                )
+            except ValueError as exc:
+                raise HTTPException(status_code=400, detail=str(exc))
+            latest = await self.run_io(self.history_store.last)
 
             return NotificationsResponse(
                 message="notifications is ready",
-                latest=(history[-1] if history else None),
+                latest=latest,
                 timestamp=time.time(),
-                notifications=(history[1:] if history and len(history) > 1 else []),
+                notifications=history,
+                next_cursor=next_cursor,
             )
 
     def run_uvicorn(self) -> None:
-        """Start uvicorn with current host/port."""
+        """
+        Start uvicorn with current host/port, in this process. Several worker processes
+        are started without an agent of this process (see `fileagent.main.run_workers`).
+        """
         uvicorn.run(self.app, host=self.host, port=self.port)
 
 
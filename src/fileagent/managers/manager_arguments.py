@@ -40,6 +40,210 @@ class ManagerArguments:
             help="Path to the data directory",
         )
 
+        self.parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Number of uvicorn worker processes serving the API, sharing the rules file (default: 1)",
+        )
+
+        self.parser.add_argument(
+            "--sid-start",
+            type=int,
+            default=None,
+            help="First sid of the range handed out to generated rules",
+        )
+
+        self.parser.add_argument(
+            "--sid-end",
+            type=int,
+            default=None,
+            help="Last sid of the range handed out to generated rules",
+        )
+
+        self.parser.add_argument(
+            "--io-workers",
+            type=int,
+            default=None,
+            help="Number of threads doing the file work of the API",
+        )
+
+        self.parser.add_argument(
+            "--commit-window",
+            type=float,
+            default=None,
+            help="Seconds the rules writer waits to group concurrent appends into one write",
+        )
+
+        self.parser.add_argument(
+            "--backup-mode",
+            choices=["full", "delta"],
+            default=None,
+            help="Back up the whole rules file on every append (full), or only what is appended (delta)",
+        )
+
+        self.parser.add_argument(
+            "--snapshot-every",
+            type=int,
+            default=None,
+            help="Number of delta backups between two full snapshots",
+        )
+
+        self.parser.add_argument(
+            "--backup-compress",
+            action="store_true",
+            default=None,
+            help="Gzip compress the backups",
+        )
+
+        self.parser.add_argument(
+            "--backup-keep-last",
+            type=int,
+            default=None,
+            help="Keep the N latest backups (enables the retention policy)",
+        )
+
+        self.parser.add_argument(
+            "--backup-keep-hourly",
+            type=int,
+            default=None,
+            help="Also keep the latest backup of every hour, for N hours",
+        )
+
+        self.parser.add_argument(
+            "--backup-keep-daily",
+            type=int,
+            default=None,
+            help="Also keep the latest backup of every day, for N days",
+        )
+
+        self.parser.add_argument(
+            "--parse-workers",
+            type=int,
+            default=None,
+            help="Number of processes indexing a large rules file at startup (default: number of CPUs)",
+        )
+
+        self.parser.add_argument(
+            "--aggregate-ips",
+            action="store_true",
+            default=None,
+            help="Merge the addresses of block_ip/alert_ip into CIDR prefixes, written as IP-list rules to <rules file stem>.iplists.rules",
+        )
+
+        self.parser.add_argument(
+            "--reputation-lists",
+            action="store_true",
+            default=None,
+            help="Write the addresses of block_ip/alert_ip to the block/monitor lists of the Snort reputation inspector",
+        )
+
+        self.parser.add_argument(
+            "--reputation-dir",
+            type=str,
+            default=None,
+            help="Directory of the reputation lists, the list_dir of the reputation module (default: <rules directory>/reputation)",
+        )
+
+        self.parser.add_argument(
+            "--ip-list-size",
+            type=int,
+            default=None,
+            help="Maximum number of prefixes in one IP-list rule",
+        )
+
+        self.parser.add_argument(
+            "--aggregate-interval",
+            type=float,
+            default=None,
+            help="Minimum seconds between two rewrites of the IP-list rules file or the reputation lists",
+        )
+
+        self.parser.add_argument(
+            "--reap-window",
+            type=float,
+            default=None,
+            help="Seconds the reaper waits after a rule expires, to remove the rules that expire meanwhile with the same rewrite (default: 1.0)",
+        )
+
+        self.parser.add_argument(
+            "--consolidate-domains",
+            type=int,
+            default=None,
+            help="Write a rule for the parent domain instead, once a domain has this many blocked or alerted siblings (default: 0, off)",
+        )
+
+        self.parser.add_argument(
+            "--reload-command",
+            type=str,
+            default=None,
+            help="Command that makes Snort reload its configuration, run after the rules changed (e.g. 'systemctl reload snort3')",
+        )
+
+        self.parser.add_argument(
+            "--reload-pid",
+            type=str,
+            default=None,
+            help="Pid of the Snort process, or the path of its pid file, to signal after the rules changed",
+        )
+
+        self.parser.add_argument(
+            "--reload-signal",
+            type=str,
+            default=None,
+            help="Signal sent to --reload-pid to make Snort reload (default: HUP)",
+        )
+
+        self.parser.add_argument(
+            "--reload-socket",
+            type=str,
+            default=None,
+            help="Snort control socket (a Unix socket path or host:port) to send the reload command to after the rules changed",
+        )
+
+        self.parser.add_argument(
+            "--reload-message",
+            type=str,
+            default=None,
+            help="Command sent to --reload-socket (default: 'snort.reload_config()')",
+        )
+
+        self.parser.add_argument(
+            "--reload-window",
+            type=float,
+            default=None,
+            help="Seconds the rule changes are collected for before Snort is reloaded, at most one reload per window (default: 1.0)",
+        )
+
+        self.parser.add_argument(
+            "--shard-rules",
+            action="store_true",
+            default=None,
+            help="Write the generated rules to a rules file per command family (block_ip, block_domain, alert, custom), listed in an include manifest for Snort",
+        )
+
+        self.parser.add_argument(
+            "--compact-rules",
+            action="store_true",
+            default=None,
+            help="Write the generated rules on a single line instead of one option per line",
+        )
+
+        self.parser.add_argument(
+            "--compact",
+            action="store_true",
+            default=None,
+            help="Rewrite the rules file in compact form (one line per rule, no duplicates, ordered by sid) and exit",
+        )
+
+        self.parser.add_argument(
+            "--restore",
+            type=str,
+            default=None,
+            metavar="TIMESTAMP",
+            help="Restore the rules file as it was at TIMESTAMP (e.g. '2026-01-01 10:00:00') and exit",
+        )
+
     def assign_attributes(self, attributes):
         """
         Assign attributes dynamically based on provided arguments or defaults.
@@ -54,3 +258,24 @@ class ManagerArguments:
                 attr,
                 provided_value if provided_value is not None else default_value,
             )
+
+    def get_option(self, kwargs: dict, name: str, default=None):
+        """
+        Description:
+            Get the value of an optional setting. The keyword arguments passed to the agent
+            take precedence, then the command line arguments (if they were parsed), and
+            finally the given default.
+
+        Args:
+            kwargs (dict): The keyword arguments passed to the agent.
+            name (str): The name of the setting, e.g. `sid_start`.
+            default (any, optional): The value used when the setting is not provided.
+
+        Returns:
+            any: The value of the setting.
+        """
+        if kwargs.get(name) is not None:
+            return kwargs[name]
+        if (value := getattr(getattr(self, "args", None), name, None)) is not None:
+            return value
+        return default
@@ -2,6 +2,8 @@ from pathlib import Path
 import datetime
 import inspect
 import json
+from fileagent.managers.backup_store import BackupStore
+from fileagent.managers.history_store import HistoryStore
 
 
 class ManagerFiles:
@@ -21,51 +23,86 @@ class ManagerFiles:
             self.data_backup_path.mkdir(parents=True, exist_ok=True)
 
         self.rules_file = Path(self.directory, self.file)
+        self.backup_store = self.build_backup_store(self.rules_file, kwargs)
         self.get_history_file(kwargs.get("history_file", None))
 
-    def file_backup(self):
+    def build_backup_store(self, source, kwargs: dict) -> BackupStore:
+        """
+        Description:
+            Build the store of the backups of a rules file, in the backup directory, with
+            the backup settings of the agent.
+
+        Args:
+            source (Path): The rules file to back up.
+            kwargs (dict): The keyword arguments passed to the agent.
+
+        Returns:
+            BackupStore: The backup store of the rules file.
+        """
+        return BackupStore(
+            self.data_backup_path,
+            source,
+            mode=self.get_option(kwargs, "backup_mode", "full"),
+            snapshot_every=self.get_option(kwargs, "snapshot_every", 100),
+            compress=self.get_option(kwargs, "backup_compress", False),
+            keep_last=self.get_option(kwargs, "backup_keep_last"),
+            keep_hourly=self.get_option(kwargs, "backup_keep_hourly"),
+            keep_daily=self.get_option(kwargs, "backup_keep_daily"),
+        )
+
+    def file_backup(self, appended: str = None):
         """
         Description:
             -----------
 
-            Creates a backup of the rules file in the specified backup directory.
-            This method ensures that the backup directory exists, then creates a backup
-            of the `self.rules_file` by copying its contents to a new file in the backup
-            directory. The backup file is named using the original file's stem and the
-            current timestamp in the format 'YYYY-MM-DD_HH-MM-SS.bak'.
-            Steps:
-            1. Ensures the backup directory (`self.data_backup_path`) exists.
-            2. Constructs the backup file path using the original file's stem and a timestamp.
-            3. Reads the contents of the `self.rules_file`.
-            4. Writes the contents to the newly created backup file.
-            Raises:
-                FileNotFoundError: If `self.rules_file` does not exist.
-                IOError: If there is an issue reading from or writing to the files.
-            Note:
-                - The method assumes `self.rules_file` and `self.data_backup_path` are
-                valid `Path` objects.
-                - The timestamp ensures that each backup file has a unique name.
+            Creates a backup of the rules file in the specified backup directory, before
+            `appended` is appended to it. The backup files are named using the original
+            file's stem and the current timestamp ('YYYY-MM-DD_HH-MM-SS-ffffff').
+
+            In `full` backup mode (the default) the whole `self.rules_file` is copied into
+            a new `.bak` file.
+            In `delta` backup mode only `appended` is recorded, into a `.journal` segment
+            on top of the latest `.snapshot` (a full copy taken every `snapshot_every`
+            segments, or when the rules file was changed outside of the agent). This keeps
+            the disk use and the cost of a backup proportional to what was appended.
+
+            The files are written by a background worker, so the append does not wait
+            for them. They are gzip compressed with `backup_compress`, and thinned out
+            with `backup_keep_last`, `backup_keep_hourly` and `backup_keep_daily`.
+
+        Args:
+            appended (str, optional): The text about to be appended to the rules file.
 
         Raises:
-            FileNotFoundError: If `self.rules_file` does not exist.
             IOError: If there is an issue reading from or writing to the files.
 
         """
 
         print(f"Creating backup in {self.data_backup_path}")
-        # Create the backup file path
-        backup_file = Path(
-            self.data_backup_path,
-            f"{self.rules_file.stem}-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.bak",
-        )
+        return self.backup_store.backup(appended)
 
-        with open(self.rules_file, "r") as file:
-            rules = file.readlines()
+    def restore_backup(self, timestamp: str, target: str = None) -> Path:
+        """
+        Description:
+            Rebuild the rules file as it was at the given time, from the backups.
+            In `delta` mode this is the latest snapshot before that time plus the journal
+            segments that follow it. In `full` mode it is the latest full copy before that
+            time, i.e. the file as it was right before the last append preceding it.
 
-        with open(backup_file, "w") as file:
-            file.writelines(rules)
+        Args:
+            timestamp (str): The point in time, in ISO format (e.g. '2026-01-01 10:00:00').
+            target (str, optional): Where to write the result. Defaults to the rules file.
 
-    def get_parent(self):
+        Returns:
+            pathlib.Path: The restored file.
+        """
+        until = datetime.datetime.fromisoformat(timestamp)
+        # Not while another process (e.g. a running agent) changes the rules file
+        with self.rules_lock:
+            return self.backup_store.restore(until, target)
+
+    @staticmethod
+    def get_parent():
         """
         Description:
             Retrieves the absolute path of the parent directory of the file
@@ -87,34 +124,31 @@ class ManagerFiles:
         """
         Description:
             this function will get path of the file that contains the history of the notifications.
+            The history is kept as an append-only log of JSON lines, in the given file, or
+            in `history.jsonl` in the directory of the agent. A given file that is still in
+            the `{"history": [...]}` format of older versions is rewritten in place as a log,
+            once. Otherwise, the entries of the default history file of older versions
+            (`history.json`) are migrated into `history.jsonl` once.
+
+        Args:
+            filepath (str, optional): The history log, never renamed.
+
         Returns:
-            pathlib.Path: The absolute path of the history directory.
+            pathlib.Path: The absolute path of the history log.
         """
 
         # Doesn't contain any checks for filename or filepath. For now
         if filepath:
             self.history_file = Path(filepath)
+            self.history_store = HistoryStore(self.history_file)
+            self.history_store.migrate(self.history_file)
             return self.history_file
 
-        self.history_file = Path(self.directory, "history.json")
-        if not self.history_file.exists():
-            self.history_file.parent.mkdir(parents=True, exist_ok=True)
-            self.history_file.touch()
-            with open(self.history_file, "w") as file:
-                json.dump({"history": []}, file)
+        self.history_file = Path(self.directory, "history.jsonl")
+        self.history_store = HistoryStore(self.history_file)
+        self.history_store.migrate(Path(self.directory, "history.json"))
         return self.history_file
 
-    def get_file_content(self, filepath, filetype: str = None):
-
-        with open(filepath, "r") as file:
-            content = file.read()
-        if filetype == "json":
-            return json.loads(content)
-        elif filetype == "txt":
-            return content.splitlines()
-        else:
-            return content
-
     def save_file_content(self, filepath, content, filetype: str = None):
         """
         Description:
@@ -139,28 +173,80 @@ class ManagerFiles:
             else:
                 file.write(content)
 
-    def save_file_json(self, filepath, content):
+    def save_history(self, content):
+        self.save_history_batch([content])
+
+    def save_history_batch(self, contents: list):
         """
         Description:
-            Saves the content of a file to the specified filepath in JSON format.
-            This method reads the content from `self.content`, which should be a dictionary,
-            and writes it to the specified file as a JSON string.
+            Record notifications in the history. The entries are appended to the history
+            log with a single write, the existing history is never read or rewritten.
 
         Args:
-            filepath (str): The path where the file should be saved.
+            contents (list): The contents of the notifications, in order.
+        """
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.history_store.append(
+            [{"timestamp": timestamp, "content": content} for content in contents]
+        )
+
+    def read_history(self) -> dict:
+        """
+        Description:
+            Read the whole history, in the `{"history": [...]}` shape of the old history file.
 
         Returns:
-            None
+            dict: The history entries, oldest first, under the `history` key.
         """
+        return self.history_store.read()
 
-        original = self.get_file_content(filepath, "json")
-        original["history"].append(content)
+    def read_history_page(self, cursor: int = None, limit: int = 100, since=None):
+        """
+        Description:
+            Read a window of the history, starting at a cursor and/or a point in time.
 
-        self.save_file_content(filepath, original, "json")
+        Args:
+            cursor (int, optional): The cursor returned with the previous window.
+            limit (int, optional): Maximum number of entries to return. Defaults to 100.
+            since (str, optional): `YYYY-MM-DD HH:MM:SS` or Unix epoch seconds. Only entries
+                recorded at or after that time are returned.
 
-    def save_history(self, content):
-        history = {
-            "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "content": content,
-        }
-        self.save_file_json(self.history_file, history)
+        Raises:
+            ValueError: If `since` is neither a time in that format nor epoch seconds (of a
+                year from 1 to 9999).
+
+        Returns:
+            tuple[list[dict], int]: The entries of the window and the cursor of the next one.
+        """
+        if since is not None:
+            since = self.history_time(since)
+        return self.history_store.page(cursor=cursor, limit=limit, since=since)
+
+    @staticmethod
+    def history_time(value) -> str:
+        """
+        Description:
+            Get a point in time in the `YYYY-MM-DD HH:MM:SS` format of the history entries
+            (local time), the one they are compared in.
+
+        Args:
+            value (str | float): `YYYY-MM-DD HH:MM:SS` or Unix epoch seconds.
+
+        Raises:
+            ValueError: If the value is neither, or out of the range of a date.
+
+        Returns:
+            str: The point in time, in the format of the history entries.
+        """
+        text = str(value).strip()
+        try:
+            when = datetime.datetime.strptime(text, "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            try:
+                when = datetime.datetime.fromtimestamp(float(text))
+            except (ValueError, OverflowError, OSError):
+                raise ValueError(
+                    f"Invalid time {text!r}, expected 'YYYY-MM-DD HH:MM:SS' or Unix epoch seconds"
+                ) from None
+        # Not strftime, which does not pad the years before 1000
+        return when.isoformat(sep=" ", timespec="seconds")
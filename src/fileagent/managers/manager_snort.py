@@ -1,8 +1,277 @@
+import ipaddress
 import json
+import os
 import re
+import time
+from itertools import chain
+from pathlib import Path
+from fileagent.managers.domain_index import DomainSuffixIndex
+from fileagent.managers.file_lock import FileLock
+from fileagent.managers.ip_aggregator import CidrSet, IpAggregator, IpLists
+from fileagent.managers.ip_prefix_index import IpPrefixIndex
+from fileagent.managers.manager_arguments import ManagerArguments
+from fileagent.managers.manager_files import ManagerFiles
+from fileagent.managers.parallel_loader import ParallelRuleLoader
+from fileagent.managers.reputation_lists import ReputationLists
+from fileagent.managers.rule_compactor import RuleCompactor
+from fileagent.managers.rule_index import RuleIndex, option_key, rule_fingerprint
+from fileagent.managers.rule_expiry import RuleExpiry
+from fileagent.managers.rule_reader import RuleParser, RuleReader
+from fileagent.managers.rule_rewriter import RuleRewriter
+from fileagent.managers.rule_writer import RuleWriter
+from fileagent.managers.sid_allocator import SidAllocator
+from fileagent.managers.snort_reloader import (
+    ReloadCommand,
+    ReloadSignal,
+    ReloadSocket,
+    SnortReloader,
+)
+from fileagent.managers.snort_rule import SnortRule
+
+
+class RuleContext:
+    """
+    Description:
+        Request-scoped state of a payload going through the upload pipeline.
+        Everything that is derived from the payload (the rule, its fingerprint, the
+        duplicate check) is computed once, by `ManagerSnort.prepare_rule`, and then
+        reused by every later step of the same request.
+        `aggregate` is the (action, network) of a payload that goes into the IP lists
+        instead of the rules file, `shard` the `RuleShard` whose rules file the rule goes
+        to instead of the rules file. `reserve_sid` is set for a generated rule, which is
+        built without a sid and only gets one once it is committed.
+    """
+
+    __slots__ = (
+        "payload",
+        "rule",
+        "fingerprint",
+        "duplicate",
+        "error",
+        "aggregate",
+        "shard",
+        "reserve_sid",
+    )
+
+    def __init__(self, payload: dict):
+        self.payload = payload
+        self.rule: str | None = None
+        self.fingerprint: str | None = None
+        self.duplicate = False
+        self.error: str | None = None
+        self.aggregate: tuple[str, ipaddress.IPv4Network | ipaddress.IPv6Network] | None = None
+        self.shard: RuleShard | None = None
+        self.reserve_sid = False
+
+
+class DuplicateRuleError(ValueError):
+    """
+    Raised when a change would write a rule that is already in the rules file.
+    """
 
 
 class ManagerSnort:
+    # The commands that can be aggregated into IP lists, and the action of their rules
+    AGGREGATED_COMMANDS = {"block_ip": "block", "alert_ip": "alert"}
+    # The commands whose rule is redundant under a rule for a larger prefix, and the
+    # action and protocol of their rules
+    SUBSUMED_COMMANDS = {
+        "block_ip": ("block", "ip"),
+        "alert_ip": ("alert", "ip"),
+        "block_icmp": ("block", "icmp"),
+    }
+    # The commands whose rule is redundant under a rule for a parent domain, and the
+    # action, protocol and destination port of their rules
+    DOMAIN_COMMANDS = {
+        "block_domain": ("block", "ssl", 443),
+        "alert_domain": ("alert", "ssl", 443),
+    }
+    # The family of every command, whose rules go to the same shard with `shard_rules`
+    SHARD_FAMILIES = {
+        "block_ip": "block_ip",
+        "block_icmp": "block_ip",
+        "block_domain": "block_domain",
+        "alert_ip": "alert",
+        "alert_domain": "alert",
+        "custom": "custom",
+    }
+
+    def __init__(self, *args, **kwargs):
+        """
+        Description:
+            Initialize the in-memory state that is kept next to the rules file, and the
+            background work on it (the group-commit writer, the IP lists, the expiry of
+            rules and the reload of Snort), from the options of the agent.
+
+        Args:
+            kwargs (dict): The options of the agent, read with `get_option`.
+        """
+        # The generated rules are written with one option per line, or on a single line
+        # with `compact_rules`
+        self.pretty_rules = not self.get_option(kwargs, "compact_rules", False)
+        self.consolidate_domains = self.get_option(kwargs, "consolidate_domains", 0)
+        self.rule_writer = RuleWriter(
+            self.commit_rules, window=self.get_option(kwargs, "commit_window", 0.005)
+        )
+        self.sid_allocator = SidAllocator(
+            Path(self.rules_file.parent, f"{self.rules_file.name}.sid"),
+            start=self.get_option(kwargs, "sid_start", 10000),
+            end=self.get_option(kwargs, "sid_end", 20000),
+        )
+        self.init_rules_file(kwargs)
+
+        self.ip_aggregator = None
+        if self.get_option(kwargs, "reputation_lists", False):
+            self.ip_aggregator = ReputationLists(
+                self.get_option(
+                    kwargs, "reputation_dir", Path(self.rules_file.parent, "reputation")
+                ),
+                interval=self.get_option(kwargs, "aggregate_interval", 1.0),
+            )
+        elif self.get_option(kwargs, "aggregate_ips", False):
+            self.ip_aggregator = IpAggregator(
+                self.get_option(
+                    kwargs,
+                    "ip_lists_file",
+                    Path(self.rules_file.parent, f"{self.rules_file.stem}.iplists.rules"),
+                ),
+                self.building_rule_ip_list,
+                self.get_current_sid,
+                list_size=self.get_option(kwargs, "ip_list_size", 1000),
+                interval=self.get_option(kwargs, "aggregate_interval", 1.0),
+            )
+            self.sid_allocator.warm_up(self.ip_aggregator.sids())
+
+        # With a reload trigger, Snort reloads its configuration after the rules (or the IP
+        # lists) changed, at most once every `reload_window` seconds
+        self.snort_reloader = None
+        trigger = None
+        if command := self.get_option(kwargs, "reload_command", None):
+            trigger = ReloadCommand(command)
+        elif pid := self.get_option(kwargs, "reload_pid", None):
+            trigger = ReloadSignal.from_name(pid, self.get_option(kwargs, "reload_signal", "HUP"))
+        elif address := self.get_option(kwargs, "reload_socket", None):
+            trigger = ReloadSocket(
+                address, self.get_option(kwargs, "reload_message", ReloadSocket.MESSAGE)
+            )
+        if trigger is not None:
+            self.snort_reloader = SnortReloader(
+                trigger,
+                window=self.get_option(kwargs, "reload_window", 1.0),
+                state_file=Path(self.rules_file.parent, f"{self.rules_file.name}.reload"),
+            )
+            if self.ip_aggregator is not None:
+                self.ip_aggregator.on_flush = self.snort_reloader.changed
+
+        self.rule_shards: dict[str, RuleShard] | None = None
+        self.manifest_file = Path(self.rules_file.parent, f"{self.rules_file.stem}.include.rules")
+        if self.get_option(kwargs, "shard_rules", False):
+            self.rule_shards = {
+                family: RuleShard(self, family, kwargs)
+                for family in dict.fromkeys(self.SHARD_FAMILIES.values())
+            }
+            self.write_manifest()
+
+        # Rules that expired while the agent was down are removed right away
+        for store in self.rule_stores():
+            if len(store.rule_expiry):
+                store.rule_expiry.start()
+
+    def init_rules_file(self, kwargs: dict):
+        """
+        Description:
+            Build the state that is kept next to a rules file (`self.rules_file`): its
+            lock, readers, rewriter, the rule index, the prefix and domain indexes and the
+            expiry of its rules. The indexes are loaded from their sidecar files, or built.
+            A rules file of `parallel_parse_bytes` or more without an index is parsed by a
+            pool of `parse_workers` processes.
+            The lock is a `FileLock` (`<rules file>.lock`), so the processes that share the
+            rules file (e.g. the workers of uvicorn) take turns at writing it.
+
+        Args:
+            kwargs (dict): The keyword arguments passed to the agent.
+        """
+        self.rules_lock = FileLock(Path(self.rules_file.parent, f"{self.rules_file.name}.lock"))
+        self.rule_index = RuleIndex(self.rules_file)
+        self.rule_reader = RuleReader(self.rules_file)
+        self.index_reader = RuleReader(self.rules_file, keep_rules=False)
+        self.index_file = Path(self.rules_file.parent, f"{self.rules_file.name}.idx")
+        self.ip_index = IpPrefixIndex()
+        self.ip_index_reader = RuleReader(self.rules_file, keep_rules=False)
+        self.ip_index_file = Path(self.rules_file.parent, f"{self.rules_file.name}.ipidx")
+        self.domain_index = DomainSuffixIndex()
+        self.domain_index.lock = self.ip_index.lock
+        self.domain_index_file = Path(self.rules_file.parent, f"{self.rules_file.name}.dnidx")
+        self.rule_rewriter = RuleRewriter(self.rules_file)
+        self.rule_expiry = RuleExpiry(
+            Path(self.rules_file.parent, f"{self.rules_file.name}.ttl"),
+            self.expire_rules,
+            window=self.get_option(kwargs, "reap_window", 1.0),
+        )
+        self.parse_workers = self.get_option(kwargs, "parse_workers", os.cpu_count() or 1)
+        self.parallel_parse_bytes = self.get_option(kwargs, "parallel_parse_bytes", 64 << 20)
+
+        loaded = self.load_rule_index()
+        if not loaded and self.parse_workers > 1 and self.rules_size() >= self.parallel_parse_bytes:
+            ParallelRuleLoader(self.rules_file, self.parse_workers).load(
+                self.rule_index, self.index_reader
+            )
+        if not loaded or self.rule_index.is_stale():
+            self.save_rule_index()
+        if not self.load_target_indexes():
+            self.save_target_indexes()
+
+    def rule_stores(self) -> list:
+        """
+        Description:
+            Get everything that keeps rules files: the agent itself, for the rules file,
+            and its shards, if the rules are sharded.
+        """
+        return [self, *(self.rule_shards or {}).values()]
+
+    def rule_shard_of(self, data: dict):
+        """
+        Description:
+            Get the shard the rule of a payload goes to, by the family of its command.
+
+        Returns:
+            RuleShard | None: The shard, or None if the rules are not sharded.
+        """
+        if self.rule_shards is None:
+            return None
+        return self.rule_shards.get(self.SHARD_FAMILIES.get(data.get("command")))
+
+    def write_manifest(self):
+        """
+        Description:
+            Write the include manifest of the shards: an `include` of the rules file and
+            of every shard (and of the IP-list rules file), for the Snort configuration to
+            load instead of the rules file. The names are relative, as the manifest is next
+            to the files. The manifest is only replaced when it changed.
+        """
+        files = [store.rules_file for store in self.rule_stores()]
+        if isinstance(self.ip_aggregator, IpAggregator):
+            files.append(self.ip_aggregator.path)
+        content = (
+            f"# The rules of {self.rules_file.name}, and of its shards by command family.\n"
+            "# Generated by the agent, include this file in the Snort configuration.\n"
+            + "".join(
+                f"include {path.name if path.parent == self.rules_file.parent else path}\n"
+                for path in files
+            )
+        )
+        with self.rules_lock:
+            try:
+                if self.manifest_file.read_text() == content:
+                    return
+            except FileNotFoundError:
+                pass
+            temp_file = self.manifest_file.with_name(f"{self.manifest_file.name}.tmp")
+            with open(temp_file, "w") as file:
+                file.write(content)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_file, self.manifest_file)
 
     def ip_matches(self, data: str) -> str:
         """
@@ -74,13 +343,17 @@ class ManagerSnort:
             rule = tranlator_book[command](data.get("target"))
         return rule
 
-    def building_rule_block(self, target: str, msg: str = None, verbose=False) -> str:
+    def building_rule_block(
+        self, target: str, msg: str = None, sid: int = None, verbose=False
+    ) -> str:
         """
         Builds a Snort rule to block HTTP traffic from a specific target.
 
         Args:
             target (str): The target IP address or domain.
             msg (str, optional): Custom message for the rule. Defaults to None.
+            sid (int, optional): The sid of the rule. Defaults to None, for a rule without
+                a sid, which gets one when it is committed (see `assign_sids`).
             verbose (bool, optional): If True, prints the rule. Defaults to False.
 
         Returns:
@@ -94,17 +367,17 @@ class ManagerSnort:
             direction="->",
             dst_ip="any",
             dst_port="any",
-            sid=self.get_current_sid(),
+            sid=sid,
             msg=msg or f"Block traffic From IP {target}",
         )
 
-        rule = self.build_formatter(parts, opts, pretty=True)
+        rule = self.build_formatter(parts, opts, pretty=self.pretty_rules)
         if verbose:
             print(rule)
         return rule
 
     def building_rule_block_icmp(
-        self, target: str, msg: str = None, verbose=False
+        self, target: str, msg: str = None, sid: int = None, verbose=False
     ) -> str:
         """
         Builds a Snort rule to block ICMP traffic from a specific target.
@@ -112,6 +385,8 @@ class ManagerSnort:
         Args:
             target (str): The target IP address.
             msg (str, optional): Custom message for the rule. Defaults to None.
+            sid (int, optional): The sid of the rule. Defaults to None, for a rule without
+                a sid, which gets one when it is committed (see `assign_sids`).
             verbose (bool, optional): If True, prints the rule. Defaults to False.
 
         Returns:
@@ -125,11 +400,11 @@ class ManagerSnort:
             direction="->",
             dst_ip="any",
             dst_port="any",
-            sid=self.get_current_sid(),
+            sid=sid,
             msg=msg or f"Block ICMP From IP {target}",
         )
 
-        rule = self.build_formatter(parts, opts, pretty=True)
+        rule = self.build_formatter(parts, opts, pretty=self.pretty_rules)
         if verbose:
             print(rule)
         return rule
@@ -145,7 +420,7 @@ class ManagerSnort:
         return rule
 
     def building_rule_alert_icmp(
-        self, target: str, msg: str = None, verbose=False
+        self, target: str, msg: str = None, sid: int = None, verbose=False
     ) -> str:
         """
         Builds a Snort rule to alert on ICMP traffic from a specific target.
@@ -153,6 +428,8 @@ class ManagerSnort:
         Args:
             target (str): The target IP address.
             msg (str, optional): Custom message for the rule. Defaults to None.
+            sid (int, optional): The sid of the rule. Defaults to None, for a rule without
+                a sid, which gets one when it is committed (see `assign_sids`).
             verbose (bool, optional): If True, prints the rule. Defaults to False.
 
         Returns:
@@ -166,18 +443,18 @@ class ManagerSnort:
             direction="->",
             dst_ip="any",
             dst_port="any",
-            sid=self.get_current_sid(),
+            sid=sid,
             msg=msg or f"Alert ICMP From IP {target}",
         )
 
-        rule = self.build_formatter(parts, opts, pretty=True)
+        rule = self.build_formatter(parts, opts, pretty=self.pretty_rules)
 
         if verbose:
             print(rule)
         return rule
 
     def building_rule_block_domain(
-        self, domain: str, msg: str = None, verbose=False
+        self, domain: str, msg: str = None, sid: int = None, verbose=False
     ) -> str:
         """
         Builds a Snort rule to block traffic to a specific domain.
@@ -185,6 +462,8 @@ class ManagerSnort:
         Args:
             domain (str): The target domain to block.
             msg (str, optional): Custom message for the rule. Defaults to None.
+            sid (int, optional): The sid of the rule. Defaults to None, for a rule without
+                a sid, which gets one when it is committed (see `assign_sids`).
             verbose (bool, optional): If True, prints the rule. Defaults to False.
 
         Returns:
@@ -199,20 +478,20 @@ class ManagerSnort:
             direction="->",
             dst_ip="any",
             dst_port=443,
-            sid=self.get_current_sid(),
+            sid=sid,
             ssl_state="client_hello",
             msg=msg or f"Block domain with SNI {domain}",
             content=[{"value": f"|{self.to_hex(domain)}|"}],
         )
 
-        rule = self.build_formatter(parts, opts, pretty=True)
+        rule = self.build_formatter(parts, opts, pretty=self.pretty_rules)
 
         if verbose:
             print(rule)
         return rule
 
     def building_rule_alert_domain(
-        self, domain: str, msg: str = None, verbose=False
+        self, domain: str, msg: str = None, sid: int = None, verbose=False
     ) -> str:
         """
         Builds a Snort rule to alert traffic to a specific domain.
@@ -220,6 +499,8 @@ class ManagerSnort:
         Args:
             domain (str): The target domain to alert.
             msg (str, optional): Custom message for the rule. Defaults to None.
+            sid (int, optional): The sid of the rule. Defaults to None, for a rule without
+                a sid, which gets one when it is committed (see `assign_sids`).
             verbose (bool, optional): If True, prints the rule. Defaults to False.
 
         Returns:
@@ -234,25 +515,29 @@ class ManagerSnort:
             direction="->",
             dst_ip="any",
             dst_port=443,
-            sid=self.get_current_sid(),
+            sid=sid,
             ssl_state="client_hello",
             msg=msg or f"alert domain with SNI {domain}",
             content=[{"value": f"|{self.to_hex(domain)}|"}],
         )
 
-        rule = self.build_formatter(parts, opts, pretty=True)
+        rule = self.build_formatter(parts, opts, pretty=self.pretty_rules)
 
         if verbose:
             print(rule)
         return rule
 
-    def building_rule_alert(self, target: str, msg: str = None, verbose=False) -> str:
+    def building_rule_alert(
+        self, target: str, msg: str = None, sid: int = None, verbose=False
+    ) -> str:
         """
         Builds a Snort rule to alert on IP traffic from a specific target.
 
         Args:
             target (str): The target IP address.
             msg (str, optional): Custom message for the rule. Defaults to None.
+            sid (int, optional): The sid of the rule. Defaults to None, for a rule without
+                a sid, which gets one when it is committed (see `assign_sids`).
             verbose (bool, optional): If True, prints the rule. Defaults to False.
 
         Returns:
@@ -268,16 +553,71 @@ class ManagerSnort:
             dst_port="any",
             msg=msg or f"IP Alert Incoming From IP {target}",
             classtype="tcp-connection",
-            sid=self.get_current_sid(),
+            sid=sid,
             rev=1,
         )
 
-        rule = self.build_formatter(parts, opts, pretty=True)
+        rule = self.build_formatter(parts, opts, pretty=self.pretty_rules)
         if verbose:
             print(rule)
 
         return rule
 
+    def building_rule_ip(self, action: str, target: str) -> str:
+        """
+        Description:
+            Builds the rule of `block_ip` (action `block`) or `alert_ip` (action `alert`),
+            for an address that goes into the IP lists. It is never written, only checked
+            against the rules written before the addresses were aggregated.
+
+        Args:
+            action (str): `block` or `alert`.
+            target (str): The target IP address or network.
+
+        Returns:
+            str: The formatted Snort rule string.
+        """
+        if action == "alert":
+            return self.building_rule_alert(target)
+        return self.building_rule_block(target)
+
+    def building_rule_ip_list(
+        self, action: str, prefixes: list[str], number: int, sid: int, rev: int
+    ) -> str:
+        """
+        Description:
+            Builds the rule of one IP list of the IP aggregator, on a single line.
+
+        Args:
+            action (str): `block` or `alert`.
+            prefixes (list[str]): The addresses and CIDR prefixes of the list.
+            number (int): The number of the list, among the lists of the action.
+            sid (int): The sid of the list.
+            rev (int): The revision of the list.
+
+        Returns:
+            str: The formatted Snort rule string.
+        """
+        options = {"msg": f"Block traffic From IP list {number}"}
+        if action == "alert":
+            options = {
+                "msg": f"IP Alert Incoming From IP list {number}",
+                "classtype": "tcp-connection",
+            }
+        parts, opts = self.builder(
+            action=action,
+            protocol="ip",
+            src_ip=f"[{','.join(prefixes)}]",
+            src_port="any",
+            direction="->",
+            dst_ip="any",
+            dst_port="any",
+            sid=sid,
+            rev=rev,
+            **options,
+        )
+        return self.build_formatter(parts, opts)
+
     def builder(
         self,
         action: str = None,
@@ -496,18 +836,20 @@ class ManagerSnort:
     def build_formatter(
         self, parts: list[str], opts: list[str], pretty: bool = False
     ) -> str:
-        # print(parts)
-        header = " ".join(
-            list(map(lambda x: x if isinstance(x, str) else str(x), parts))
-        )
+        """
+        Description:
+            Compile the parts and options returned by `builder` into the text of the rule,
+            through the `SnortRule` model.
 
-        # compile rule
-        if pretty:
-            body = "\n    ".join(opts)
-            return f"{header} (\n    {body}\n)"
-        else:
-            body = " ".join(opts)
-            return f"{header} ({body})"
+        Args:
+            parts (list[str]): The header parts of the rule.
+            opts (list[str]): The options of the rule.
+            pretty (bool, optional): One option per line. Defaults to False.
+
+        Returns:
+            str: The Snort rule.
+        """
+        return SnortRule.from_parts(parts, opts).format(pretty=pretty)
 
     def to_hex(self, domain: str) -> str:
         """
@@ -522,6 +864,847 @@ class ManagerSnort:
         """
         return " ".join(f"{ord(c):02x}" for c in domain)
 
+    def prepare_rule(self, data: dict) -> RuleContext:
+        """
+        Description:
+            First step of the upload pipeline. Translate the payload into a rule and check
+            it against the rule index, exactly once per request. With sharded rules, the
+            shard of the command does that, against its own rules file.
+
+        Args:
+            data (dict): Data from the post request to be translated into a rule
+
+        Returns:
+            RuleContext: The context of the request. `rule` is None if the translation failed.
+        """
+        context = RuleContext(data)
+        if covering := self.covering_rule(data):
+            # A rule for a larger prefix already matches the target
+            context.rule = covering
+            context.duplicate = True
+            return context
+
+        # A temporary rule can only expire as a rule of its own, it is not aggregated
+        if (
+            self.ip_aggregator is not None
+            and not data.get("ttl_seconds")
+            and (aggregate := self.ip_aggregate(data))
+        ):
+            action, network = aggregate
+            context.aggregate = aggregate
+            context.rule = self.building_rule_ip(action, data.get("target"))
+            context.fingerprint = rule_fingerprint(context.rule)
+            # Covered by a list, or by a rule written before the aggregation was enabled
+            context.duplicate = self.ip_aggregator.covers(
+                action, network
+            ) or self.get_rule_index().has_fingerprint(context.fingerprint)
+            return context
+
+        if (shard := self.rule_shard_of(data)) is not None:
+            context = shard.prepare_rule(data)
+            context.shard = shard
+            # Or a rule the rules file had before the rules were sharded
+            if context.fingerprint is not None and not context.duplicate:
+                context.duplicate = self.get_rule_index().has_fingerprint(context.fingerprint)
+            return context
+
+        if parent := self.consolidated_domain(data):
+            data = {**data, "target": parent}
+        if not (rule := self.rule_translator(data)):
+            return context
+
+        context.rule = rule
+        context.fingerprint = rule_fingerprint(rule)
+        # A custom rule is written as it was given
+        context.reserve_sid = data.get("command") != "custom"
+        context.duplicate = self.get_rule_index().has_fingerprint(context.fingerprint)
+        if context.duplicate:
+            self.renew_expiry(context)
+        return context
+
+    def expires_at(self, data: dict) -> float | None:
+        """
+        Description:
+            Get the Unix time the rule of a payload expires at, from its `ttl_seconds`.
+
+        Returns:
+            float | None: The expiry time, or None for a rule that does not expire.
+        """
+        if ttl := data.get("ttl_seconds"):
+            return time.time() + float(ttl)
+        return None
+
+    def renew_expiry(self, context: RuleContext):
+        """
+        Description:
+            A payload for a temporary rule that is already in the rules file extends its
+            life: it no longer expires if the payload has no `ttl_seconds`, or expires
+            later if the payload's expires later.
+        """
+        if (current := self.rule_expiry.expires.get(context.fingerprint)) is None:
+            return
+        if (expires := self.expires_at(context.payload)) is None:
+            self.rule_expiry.cancel([context.fingerprint])
+        elif expires > current:
+            self.rule_expiry.schedule([(context.fingerprint, expires, context.payload)])
+
+    def schedule_expiry(self, contexts: list[RuleContext]):
+        """
+        Description:
+            Schedule the expiry of the rules of the committed contexts that have a `ttl_seconds`.
+            Their expiry times are kept in `<rules file>.ttl`, and the reaper of `rule_expiry`
+            removes them from the rules file once they expire (see `expire_rules`).
+        """
+        self.rule_expiry.schedule(
+            [
+                (context.fingerprint, expires, context.payload)
+                for context in contexts
+                if not context.aggregate and (expires := self.expires_at(context.payload))
+            ]
+        )
+
+    def expire_rules(self, expired: list[tuple[str, dict]]):
+        """
+        Description:
+            Remove expired rules from the rules file, with a single rewrite, and record
+            every removal in the history. Called by the reaper of `rule_expiry`.
+
+        Args:
+            expired (list[tuple[str, dict]]): The fingerprint of each expired rule, and the
+                payload it came from.
+        """
+        with self.rules_lock:
+            index = self.get_rule_index()
+            payloads = {}
+            for fingerprint, payload in expired:
+                if (offset := index.offset_of(fingerprint)) is not None:
+                    payloads[offset] = (fingerprint, payload)
+
+            removed = self.remove_rules_at(
+                payloads,
+                accept=lambda offset, rule: rule_fingerprint(rule) == payloads[offset][0],
+            )
+            # The rules that are no longer in the rules file are forgotten as well
+            self.rule_expiry.cancel([fingerprint for fingerprint, _ in expired])
+            self.save_history_batch(
+                [
+                    {"event": "expired", "rule": rule, "payload": payloads[offset][1]}
+                    for offset, rule in removed.items()
+                ]
+            )
+
+    def remove_rules_at(self, offsets, accept=None) -> dict[int, str]:
+        """
+        Description:
+            Remove the rules that start at the given byte offsets from the rules file, in
+            a single atomic rewrite, see `rewrite_rules`.
+
+        Args:
+            offsets (Iterable[int]): The offsets of the rules, e.g. from the rule index.
+            accept (Callable[[int, str], bool], optional): Called with the offset and the rule
+                found there, only the rules it accepts are removed.
+
+        Returns:
+            dict[int, str]: The removed rules, by the offset they started at.
+        """
+        removed, _ = self.rewrite_rules(dict.fromkeys(offsets), accept)
+        return removed
+
+    def rewrite_rules(self, changes: dict, accept=None) -> tuple[dict[int, str], dict[int, int]]:
+        """
+        Description:
+            Remove or replace the rules that start at the given byte offsets, in a single
+            atomic rewrite of the rules file. The rules file is backed up first. The
+            indexes, which are brought up to date beforehand, follow the rewrite in memory
+            (the changed rules are dropped, the replacements added and the rewrite goes to
+            their offset logs), so the rules file is not parsed again, unless someone else
+            changed it meanwhile, and only the changed rules cost anything.
+
+        Args:
+            changes (dict[int, str | None]): The rule to write in place of the rule at each
+                offset, or None to remove it.
+            accept (Callable[[int, str], bool], optional): Called with the offset and the rule
+                found there, only the rules it accepts are changed.
+
+        Returns:
+            tuple[dict[int, str], dict[int, int]]: The rules that were changed, by the offset
+            they started at, and the offset each replacement starts at after the rewrite.
+        """
+        if not changes:
+            return {}, {}
+        with self.rules_lock:
+            # The backup has to be a copy of the file before the rewrite
+            self.file_backup()
+            self.backup_store.flush()
+
+            index = self.get_rule_index()
+            self.sync_target_indexes()
+            with index.lock, self.ip_index.lock:
+                before = index.file_signature()
+                found, moved, shift = self.rule_rewriter.rewrite(changes, accept)
+                if not found:
+                    return found, moved
+                after = index.file_signature()
+                added = [(moved[offset], changes[offset]) for offset in moved]
+
+                if index.signature == before and after[1] == before[1] - shift.removed_bytes:
+                    if self.index_reader.rewritten(before[1]):
+                        index.splice(
+                            {offset: rule_fingerprint(rule) for offset, rule in found.items()},
+                            shift,
+                            after,
+                            added,
+                        )
+                    if (
+                        self.ip_index.signature == before
+                        and self.domain_index.signature == before
+                        and self.ip_index_reader.rewritten(before[1])
+                    ):
+                        for offset, rule in found.items():
+                            try:
+                                parsed = SnortRule.parse(rule)
+                            except ValueError:
+                                continue
+                            self.ip_index.discard(offset, parsed)
+                            self.domain_index.discard(offset, parsed)
+                        self.ip_index.splice(shift)
+                        self.domain_index.splice(shift)
+                        for offset, rule in added:
+                            parsed = SnortRule.parse(rule)
+                            self.ip_index.add(offset, parsed)
+                            self.domain_index.add(offset, parsed)
+                        self.ip_index.signature = self.domain_index.signature = after
+
+            # Whatever could not follow the rewrite reads the rules file again
+            self.get_rule_index()
+            self.sync_target_indexes()
+        self.rules_changed(len(found))
+        return found, moved
+
+    def compact_rules_file(self, shard: str = None) -> dict:
+        """
+        Description:
+            Rewrite the rules file atomically in its compact form: one line per rule,
+            without exact or semantic duplicates, ordered by sid (see `RuleCompactor`).
+            The rules file is backed up first, and the indexes are built again from the
+            new file. The compaction is recorded in the history.
+            With sharded rules, the shards are compacted as well, or only the given one.
+
+        Args:
+            shard (str, optional): The family of the only shard to compact, e.g. `block_ip`.
+
+        Raises:
+            ValueError: If there is no such shard.
+
+        Returns:
+            dict: What the compaction did: the number of rules, lines and bytes before and
+            after, the duplicates dropped, and the seconds it took to read and parse every
+            rule of the file before and after, summed over the files that were compacted.
+        """
+        if shard is not None:
+            if shard not in (self.rule_shards or {}):
+                raise ValueError(f"There is no shard {shard!r}")
+            return self.rule_shards[shard].compact_rules_file()
+
+        compactor = RuleCompactor(self.rules_file)
+        index, ip_index, domain_index = self.rule_index, self.ip_index, self.domain_index
+        with self.rules_lock:
+            self.file_backup()
+            self.backup_store.flush()
+
+            with index.lock, ip_index.lock:
+                bytes_before = self.rules_size()
+                comments, rules, lines_before, parse_before = compactor.read()
+                kept, exact, semantic = compactor.compact(rules)
+                self.rule_rewriter.publish(comments + [line for line, _, _ in kept])
+
+                # The indexes are built from the compacted rules, which are already parsed,
+                # and their readers continue from the end of the new file
+                offset = sum(len(line.encode("utf-8")) + 1 for line in comments)
+                offsets = []
+                for line, _, _ in kept:
+                    offsets.append(offset)
+                    offset += len(line.encode("utf-8")) + 1
+                signature = index.file_signature()
+                for reader in (self.index_reader, self.ip_index_reader):
+                    reader.written()
+                index.clear()
+                index.merge(
+                    [fingerprint for _, fingerprint, _ in kept],
+                    [None if parsed is None else parsed.sid for _, _, parsed in kept],
+                    offsets,
+                )
+                index.signature = signature
+                ip_index.clear()
+                domain_index.clear()
+                for (_, _, parsed), start in zip(kept, offsets):
+                    if parsed is not None:
+                        ip_index.add(start, parsed)
+                        domain_index.add(start, parsed)
+                ip_index.signature = domain_index.signature = signature
+                self.save_rule_index()
+                self.save_target_indexes()
+
+            stats = {
+                "rules_before": len(rules),
+                "rules_after": len(kept),
+                "exact_duplicates": exact,
+                "semantic_duplicates": semantic,
+                "lines_before": lines_before,
+                "lines_after": len(comments) + len(kept),
+                "bytes_before": bytes_before,
+                "bytes_after": offset,
+                "parse_seconds_before": round(parse_before, 6),
+                "parse_seconds_after": round(compactor.parse_seconds(), 6),
+            }
+            self.save_history_batch([{"event": "compacted", **stats}])
+        # The whole rules file changed, as a single change
+        self.rules_changed(1)
+        for store in (self.rule_shards or {}).values():
+            for key, value in store.compact_rules_file().items():
+                stats[key] += value
+        return stats
+
+    def locate_rule(self, sid: int) -> tuple[int, str] | None:
+        """
+        Description:
+            Find the rule with the given sid through the rule index, in O(1).
+
+        Returns:
+            tuple[int, str] | None: The byte offset the rule starts at and its fingerprint,
+            or None if no rule of the rules file has the sid.
+        """
+        index = self.get_rule_index()
+        with index.lock:
+            fingerprint = index.fingerprint_of(sid)
+            offset = None if fingerprint is None else index.offset_of(fingerprint)
+        if offset is None:
+            return None
+        return offset, fingerprint
+
+    def locate_targets(self, targets: list[str]) -> dict[int, str]:
+        """
+        Description:
+            Find the rules of the given targets through the prefix index and the domain
+            index: the rules with the address or prefix itself in their header (not in a
+            list of addresses), and the rules of the domain itself (not of a subdomain).
+
+        Args:
+            targets (list[str]): Addresses, CIDR networks or domains.
+
+        Raises:
+            ValueError: If a target is neither an address nor a domain.
+
+        Returns:
+            dict[int, str]: The fingerprint of each rule, by the byte offset it starts at.
+        """
+        located = {}
+        ip_index, domain_index = self.get_ip_index(), self.get_domain_index()
+        for target in targets:
+            target = str(target).strip()
+            try:
+                key = CidrSet.key(target)
+            except ValueError:
+                entries, key = domain_index.exact(target), None
+            else:
+                entries = ip_index.exact(key)
+            for entry in entries:
+                if (rule := self.ip_index_reader.rule_at(entry.offset)) is None:
+                    continue
+                if key is not None:
+                    # The rules that only have the address in a list keep it
+                    try:
+                        if CidrSet.key(getattr(SnortRule.parse(rule), entry.field)) != key:
+                            continue
+                    except ValueError:
+                        continue
+                located[entry.offset] = rule_fingerprint(rule)
+        return located
+
+    def delete_rules(
+        self, sids: list[int] = (), targets: list[str] = ()
+    ) -> tuple[list[str], list[dict]]:
+        """
+        Description:
+            Delete the rules with the given sids, and the rules of the given targets (see
+            `locate_targets`), with a single rewrite of the rules file. The rules are found
+            through the indexes, so only the deleted rules are read. The targets are also
+            removed from the IP lists (see `remove_from_ip_lists`). The deletions are
+            recorded in the history.
+
+        Args:
+            sids (list[int], optional): The sids of the rules.
+            targets (list[str], optional): Addresses, CIDR networks or domains.
+
+        Raises:
+            ValueError: If a target is neither an address nor a domain.
+
+        Returns:
+            tuple[list[str], list[dict]]: The deleted rules, in the order of the rules file
+            (and then of the shards), and the entries removed from the IP lists.
+        """
+        deleted = []
+        for shard in (self.rule_shards or {}).values():
+            deleted.extend(shard.delete_rules(sids, targets)[0])
+
+        with self.rules_lock:
+            located = self.locate_targets(targets) if targets else {}
+            for sid in sids:
+                if (found := self.locate_rule(sid)) is not None:
+                    offset, fingerprint = found
+                    located[offset] = fingerprint
+
+            removed = self.remove_rules_at(
+                located, accept=lambda offset, rule: rule_fingerprint(rule) == located[offset]
+            )
+            self.rule_expiry.cancel([located[offset] for offset in removed])
+            entries = self.remove_from_ip_lists(targets)
+            self.save_history_batch(
+                [{"event": "deleted", "rule": rule} for rule in removed.values()]
+                + [{"event": "deleted", **entry} for entry in entries]
+            )
+        return [removed[offset] for offset in sorted(removed)] + deleted, entries
+
+    def remove_from_ip_lists(self, targets: list[str]) -> list[dict]:
+        """
+        Description:
+            Remove the addresses and CIDR networks of the given targets from the IP lists
+            they were aggregated into. A prefix that an address was merged into is split,
+            so the rest of its addresses stay listed. Other targets are skipped.
+
+        Args:
+            targets (list[str]): Addresses, CIDR networks or domains.
+
+        Returns:
+            list[dict]: The removed entries: the source of the lists, their action and the
+            removed address or prefix.
+        """
+        if self.ip_aggregator is None:
+            return []
+        entries = []
+        for target in targets:
+            try:
+                network = ipaddress.ip_network(str(target).strip(), strict=False)
+            except ValueError:
+                continue
+            for action in self.ip_aggregator.remove(network):
+                entries.append(
+                    {
+                        "source": self.ip_aggregator.SOURCE,
+                        "action": action,
+                        "prefix": IpLists.prefix_text(network),
+                    }
+                )
+        return entries
+
+    def ip_list_entry(self, context: RuleContext) -> dict | None:
+        """
+        Description:
+            Find the entry of the IP lists that holds the target of an aggregated context,
+            e.g. to tell the client where its address went.
+
+        Args:
+            context (RuleContext): A committed context.
+
+        Returns:
+            dict | None: The source of the lists, their action and the prefix that holds
+            the target now, or None if the context was not aggregated.
+        """
+        if not context.aggregate or self.ip_aggregator is None:
+            return None
+        action, network = context.aggregate
+        for listed, prefix in self.ip_aggregator.lookup(network):
+            if listed == action:
+                return {"source": self.ip_aggregator.SOURCE, "action": action, "prefix": prefix}
+        return None
+
+    def update_rule(self, sid: int, rule: str = None, msg: str = None) -> tuple[str, str]:
+        """
+        Description:
+            Replace the rule with the given sid, in place, with a single rewrite of the
+            rules file: by a whole new rule, or by the same rule with a new `msg`. The new
+            rule keeps the sid and gets the next `rev`, and the layout (single line or
+            pretty) of the old one. A temporary rule keeps its expiry time. The update is
+            recorded in the history.
+
+        Args:
+            sid (int): The sid of the rule.
+            rule (str, optional): The new rule.
+            msg (str, optional): The new message of the rule.
+
+        Raises:
+            KeyError: If no rule has the sid.
+            ValueError: If neither or both of `rule` and `msg` are given, or the new rule is invalid.
+            DuplicateRuleError: If the new rule is already in the rules file.
+
+        Returns:
+            tuple[str, str]: The new rule and the old one.
+        """
+        if (rule is None) == (msg is None):
+            raise ValueError("Provide either a new rule or a new msg")
+
+        for shard in (self.rule_shards or {}).values():
+            if shard.locate_rule(sid) is not None:
+                return shard.update_rule(sid, rule, msg)
+
+        with self.rules_lock:
+            if (found := self.locate_rule(sid)) is None:
+                raise KeyError(sid)
+            offset, fingerprint = found
+            if (previous := self.rule_rewriter.rule_at(offset)) is None:
+                raise KeyError(sid)
+
+            current = SnortRule.parse(previous)
+            if rule is not None:
+                updated = SnortRule.parse(rule)
+            else:
+                options = [option for option in current.options if option_key(option) != "msg"]
+                updated = SnortRule.from_header(
+                    current.header.split(), [f'msg:"{msg}"', *options]
+                )
+            updated.sid = sid
+            updated.rev = (current.rev or 1) + 1
+            text = updated.format(pretty="\n" in previous)
+
+            updated_fingerprint = rule_fingerprint(text)
+            if updated_fingerprint != fingerprint and self.rule_index.has_fingerprint(
+                updated_fingerprint
+            ):
+                raise DuplicateRuleError("The updated rule is already in the rules file")
+
+            changed, _ = self.rewrite_rules(
+                {offset: text}, accept=lambda offset, rule: rule_fingerprint(rule) == fingerprint
+            )
+            if not changed:
+                raise KeyError(sid)
+
+            # A temporary rule expires under its new fingerprint
+            if (expires := self.rule_expiry.expires.get(fingerprint)) is not None:
+                payload = self.rule_expiry.payloads.get(fingerprint)
+                self.rule_expiry.cancel([fingerprint])
+                self.rule_expiry.schedule([(updated_fingerprint, expires, payload)])
+            self.save_history_batch(
+                [{"event": "updated", "rule": text, "previous": changed[offset]}]
+            )
+        return text, changed[offset]
+
+    def covering_rule(self, data: dict) -> str | None:
+        """
+        Description:
+            Find a rule of the rules file that already matches everything the rule of the
+            payload would, through the prefix index or the domain index, e.g.
+            `block ip 10.1.0.0/16 any -> any any` for a `block_ip` of `10.1.39.20`, in
+            O(prefix length), or the rule of `example.com` for a `block_domain` of
+            `www.example.com`, in O(labels).
+
+        Args:
+            data (dict): Data from the post request.
+
+        Returns:
+            str | None: The covering rule, or None.
+        """
+        command = data.get("command")
+        target = str(data.get("target")).strip()
+        try:
+            if (ip_command := self.SUBSUMED_COMMANDS.get(command)) is not None:
+                entry = self.get_ip_index().covering(target, *ip_command)
+            elif (domain_command := self.DOMAIN_COMMANDS.get(command)) is not None:
+                entry = self.get_domain_index().covering(target, *domain_command)
+            else:
+                return None
+        except ValueError:
+            return None
+        if entry is None or (rule := self.ip_index_reader.rule_at(entry.offset)) is None:
+            return None
+
+        # A temporary rule does not cover a rule that would outlive it
+        if (expires := self.rule_expiry.expires.get(rule_fingerprint(rule))) is not None:
+            wanted = self.expires_at(data)
+            if wanted is None or wanted > expires:
+                return None
+        return rule
+
+    def consolidated_domain(self, data: dict) -> str | None:
+        """
+        Description:
+            With `consolidate_domains` set to N, get the parent domain to write the rule
+            for, instead of the domain of the payload, when N - 1 of its siblings already
+            have a rule of the same command, e.g. `example.com` for `d.example.com` with
+            N = 4 and rules for `a.`, `b.` and `c.example.com`. Later subdomains are then
+            covered by the rule of the parent. A top level domain is never a parent.
+
+        Args:
+            data (dict): Data from the post request.
+
+        Returns:
+            str | None: The parent domain, or None.
+        """
+        if self.consolidate_domains < 2:
+            return None
+        if (command := self.DOMAIN_COMMANDS.get(data.get("command"))) is None:
+            return None
+        target = str(data.get("target")).strip()
+        try:
+            siblings = self.get_domain_index().siblings(target, *command)
+        except ValueError:
+            return None
+        parent = target.lower().rstrip(".").partition(".")[2]
+        if siblings + 1 < self.consolidate_domains or "." not in parent:
+            return None
+        return parent
+
+    def sync_target_indexes(self):
+        """
+        Description:
+            Bring the prefix index and the domain index up to date with the rules file.
+            Like the rule index, only the rules appended since they were last used are
+            parsed, unless the rules file was rewritten. Both are fed by the same pass
+            over the rules file, and share a lock.
+        """
+        ip_index, domain_index = self.ip_index, self.domain_index
+        with ip_index.lock:
+            signature = self.rule_index.file_signature()
+            if ip_index.signature == signature and domain_index.signature == signature:
+                return
+
+            def clear():
+                ip_index.clear()
+                domain_index.clear()
+
+            reader = self.ip_index_reader
+            for offset, rule in chain(
+                reader.scan(on_reset=clear, located=True), reader.tail(located=True)
+            ):
+                try:
+                    parsed = SnortRule.parse(rule)
+                except ValueError:
+                    continue
+                ip_index.add(offset, parsed)
+                domain_index.add(offset, parsed)
+            ip_index.signature = domain_index.signature = signature
+
+    def get_ip_index(self) -> IpPrefixIndex:
+        """
+        Description:
+            Get the prefix index of the addresses in the rules, up to date with the rules file.
+
+        Returns:
+            IpPrefixIndex: The up to date prefix index.
+        """
+        self.sync_target_indexes()
+        return self.ip_index
+
+    def get_domain_index(self) -> DomainSuffixIndex:
+        """
+        Description:
+            Get the suffix index of the domains of the rules, up to date with the rules file.
+
+        Returns:
+            DomainSuffixIndex: The up to date domain index.
+        """
+        self.sync_target_indexes()
+        return self.domain_index
+
+    def load_target_indexes(self) -> bool:
+        """
+        Description:
+            Load the prefix index and the domain index from their sidecar files, and
+            continue reading the rules file from where they were saved, see `load_rule_index`.
+
+        Returns:
+            bool: True if both sidecars were loaded, and were saved together.
+        """
+        with self.ip_index.lock:
+            state = self.ip_index.load(self.ip_index_file)
+            if state is None:
+                return False
+            if (
+                self.domain_index.load(self.domain_index_file) != state
+                or self.domain_index.signature != self.ip_index.signature
+            ):
+                self.ip_index.clear()
+                self.domain_index.clear()
+                return False
+            self.ip_index_reader.restore(state)
+        return True
+
+    def save_target_indexes(self):
+        """
+        Description:
+            Bring the prefix index and the domain index up to date with the rules file and
+            save them to their sidecar files.
+        """
+        with self.rules_lock, self.ip_index.lock:
+            self.sync_target_indexes()
+            state = self.ip_index_reader.state()
+            self.ip_index.save(self.ip_index_file, state)
+            self.domain_index.save(self.domain_index_file, state)
+
+    def lookup_ip(self, ip: str) -> list[dict]:
+        """
+        Description:
+            Find everything that matches an address (or a network): the rules (of the rules
+            file and of its shards) with a prefix that contains it in their header, and the IP
+            lists or reputation lists it is in.
+
+        Args:
+            ip (str): The address or network, e.g. `10.1.39.20`.
+
+        Raises:
+            ValueError: If `ip` is not an address or a network.
+
+        Returns:
+            list[dict]: The matches, the rules with the longest prefixes first.
+        """
+        matches = []
+        for key, entry in self.get_ip_index().lookup(ip):
+            matches.append(
+                {
+                    "source": "rules",
+                    "prefix": str(CidrSet.network(key)),
+                    "action": entry.action,
+                    "protocol": entry.protocol,
+                    "field": entry.field,
+                    "sid": entry.sid,
+                    "rule": self.ip_index_reader.rule_at(entry.offset),
+                }
+            )
+        if self.rule_shards is not None:
+            for shard in self.rule_shards.values():
+                matches.extend(shard.lookup_ip(ip))
+            matches.sort(key=lambda match: -ipaddress.ip_network(match["prefix"]).prefixlen)
+        if self.ip_aggregator is not None:
+            for action, prefix in self.ip_aggregator.lookup(ip):
+                matches.append(
+                    {"source": self.ip_aggregator.SOURCE, "prefix": prefix, "action": action}
+                )
+        return matches
+
+    def lookup_domain(self, domain: str) -> list[dict]:
+        """
+        Description:
+            Find the rules that match a domain: the rules of the domain and of its parents,
+            in the rules file and in its shards.
+
+        Args:
+            domain (str): The domain, e.g. `www.example.com`.
+
+        Raises:
+            ValueError: If `domain` is not a domain.
+
+        Returns:
+            list[dict]: The matches, the most specific domains first.
+        """
+        matches = [
+            {
+                "source": "rules",
+                "domain": suffix,
+                "action": entry.action,
+                "protocol": entry.protocol,
+                "sid": entry.sid,
+                "rule": self.ip_index_reader.rule_at(entry.offset),
+            }
+            for suffix, entry in self.get_domain_index().lookup(domain)
+        ]
+        if self.rule_shards is not None:
+            for shard in self.rule_shards.values():
+                matches.extend(shard.lookup_domain(domain))
+            matches.sort(key=lambda match: -match["domain"].count("."))
+        return matches
+
+    def ip_aggregate(self, data: dict):
+        """
+        Description:
+            Get the action and the network of a payload that can go into the IP lists.
+            With `aggregate_ips`, the addresses are merged into CIDR prefixes written as a
+            few IP-list rules to their own rules file (`<rules file stem>.iplists.rules`),
+            instead of one rule per address. With `reputation_lists`, they go to the
+            block/monitor lists of the Snort reputation inspector (in `reputation_dir`).
+
+        Args:
+            data (dict): Data from the post request.
+
+        Returns:
+            tuple | None: The (action, network), or None for any other command, or a
+            target that is not an IP address or network (e.g. a variable like `$HOME_NET`).
+        """
+        if (action := self.AGGREGATED_COMMANDS.get(data.get("command"))) is None:
+            return None
+        try:
+            return action, ipaddress.ip_network(str(data.get("target")).strip(), strict=False)
+        except ValueError:
+            return None
+
+    def prepare_rules(self, payloads: list[dict]) -> list[RuleContext]:
+        """
+        Description:
+            Prepare several payloads. A payload that fails to translate does not stop the
+            others, the error is kept in the `error` of its context.
+
+        Args:
+            payloads (list[dict]): The payloads of the request.
+
+        Returns:
+            list[RuleContext]: The contexts, in the order of the payloads.
+        """
+        contexts = []
+        for payload in payloads:
+            try:
+                contexts.append(self.prepare_rule(payload))
+            except Exception as exc:
+                context = RuleContext(payload)
+                context.error = str(exc)
+                contexts.append(context)
+        return contexts
+
+    def commit_rules(self, contexts: list[RuleContext]):
+        """
+        Description:
+            Last step of the upload pipeline. Persist the rules of the given contexts and
+            record their payloads in the history. Contexts without a rule are skipped.
+            The duplicate check is repeated under the lock of the rules file, against the
+            index and the rest of the contexts, so rules that were prepared concurrently
+            are only written once. The contexts that lost are marked as `duplicate`.
+
+        Args:
+            contexts (list[RuleContext]): The prepared contexts of the request.
+        """
+        if self.rule_shards is not None:
+            # Every shard commits its own rules, under the lock of its own rules file
+            for shard in self.rule_shards.values():
+                if sharded := [context for context in contexts if context.shard is shard]:
+                    shard.commit_rules(sharded)
+            contexts = [context for context in contexts if context.shard is None]
+
+        with self.rules_lock:
+            index = self.get_rule_index()
+            seen = set()
+            accepted = []
+            for context in contexts:
+                if not context.rule or context.duplicate:
+                    continue
+                if index.has_fingerprint(context.fingerprint) or context.fingerprint in seen:
+                    context.duplicate = True
+                    continue
+                seen.add(context.fingerprint)
+                accepted.append(context)
+
+            aggregated = [context for context in accepted if context.aggregate]
+            for context in aggregated:
+                # A network of the same group may already cover it
+                action, network = context.aggregate
+                if not self.ip_aggregator.add(action, [network]):
+                    context.duplicate = True
+            accepted = [context for context in accepted if not context.duplicate]
+
+            if not accepted:
+                return
+
+            self.assign_sids(accepted)
+            self.append_rules([context.rule for context in accepted if not context.aggregate])
+            self.schedule_expiry(accepted)
+            self.save_history_batch([context.payload for context in accepted])
+
     def append_rule(self, data: dict):
         """
         Description:
@@ -531,28 +1714,136 @@ class ManagerSnort:
             data (str): Data to be appended to the local.rules file
         """
 
-        # Right now this is just a simple implementation
+        context = self.prepare_rule(data)
+        if context.rule is None or context.duplicate:
+            return
+
+        store = context.shard or self
+        with store.rules_lock:
+            if context.aggregate:
+                action, network = context.aggregate
+                self.ip_aggregator.add(action, [network])
+            else:
+                store.assign_sids([context])
+                store.append_rules([context.rule])
+                store.schedule_expiry([context])
+
+    def assign_sids(self, contexts: list[RuleContext]):
+        """
+        Description:
+            Reserve the sids of the generated rules of the given contexts, with a single
+            reservation, and write them into their rules. This is done once the rules are
+            known to be written, so duplicates and rejected payloads never use up a sid.
 
-        if (rule := self.rule_translator(data)) is None:
+        Args:
+            contexts (list[RuleContext]): The accepted contexts.
+
+        Raises:
+            SidRangeExhaustedError: If there are not enough free sids left in the range.
+        """
+        if not (pending := [context for context in contexts if context.reserve_sid]):
             return
+        first = self.sid_allocator.reserve(len(pending))
+        for sid, context in enumerate(pending, first):
+            context.rule = self.parse_rule(context.rule).with_sid(sid).format(
+                pretty="\n" in context.rule
+            )
+            context.reserve_sid = False
 
-        if self.rule_exists(rule):
+    def append_rules(self, rules: list[str]):
+        """
+        Description:
+            Append already translated rules to the rules file.
+            The rules file is backed up once and all the rules are written with a single
+            buffered write, no matter how many rules are given.
+
+        Args:
+            rules (list[str]): The rules to append. Duplicates are expected to be filtered out already.
+        """
+        if not rules:
             return
 
+        entry = "".join(f"\n{rule}\n" for rule in rules)
+
         # Backup the rules file
-        self.file_backup()
+        self.file_backup(entry)
 
-        # Append the rule to the rules file
+        # Append the rules to the rules file, and keep the index in sync with what was
+        # written. The index is locked meanwhile, so nobody sees the file as changed
+        # underneath it and reparses it.
         with open(self.rules_file, "a") as file:
-            file.write(f"\n{rule}\n")
+            with self.rule_index.lock:
+                # Each rule starts after the newline that precedes it
+                start = offset = os.fstat(file.fileno()).st_size
+                offsets = []
+                for rule in rules:
+                    offsets.append(offset + 1)
+                    offset += len(f"\n{rule}\n".encode("utf-8"))
+
+                signature = self.rule_index.signature
+                data = entry.encode("utf-8")
+                file.write(entry)
+                file.flush()
+                self.rule_index.add(rules, len(data), offsets)
+                # The readers of the indexes skip what the index already holds, or the
+                # index reads it back when it is next used
+                if self.rule_index.signature is not None and not self.index_reader.advance(
+                    data, start
+                ):
+                    self.rule_index.signature = None
+                self.add_to_target_indexes(rules, offsets, signature, data, start)
+            os.fsync(file.fileno())
+        self.rules_changed(len(rules))
+
+    def rules_changed(self, count: int):
+        """
+        Description:
+            Tell the reload trigger, if there is one, that rules of the rules file changed.
+
+        Args:
+            count (int): The number of rules that were added, removed or replaced.
+        """
+        if self.snort_reloader is not None:
+            self.snort_reloader.changed(count)
+
+    def add_to_target_indexes(
+        self, rules: list[str], offsets: list[int], signature, data: bytes, start: int
+    ):
+        """
+        Description:
+            Add the rules the agent appended to the prefix index and the domain index, so
+            they do not read them back from the rules file. This is only done if the indexes
+            were up to date with the rules file right before the append (`signature`), and
+            nobody else changed the file meanwhile, otherwise they read what they missed
+            when they are next used.
+        """
+        ip_index, domain_index = self.ip_index, self.domain_index
+        with ip_index.lock:
+            if (
+                signature is None
+                or ip_index.signature != signature
+                or domain_index.signature != signature
+                or self.rule_index.signature is None
+                or not self.ip_index_reader.advance(data, start)
+            ):
+                return
+            for offset, rule in zip(offsets, rules):
+                try:
+                    parsed = SnortRule.parse(rule)
+                except ValueError:
+                    continue
+                ip_index.add(offset, parsed)
+                domain_index.add(offset, parsed)
+            ip_index.signature = domain_index.signature = self.rule_index.signature
 
     def rule_exists(self, rule):
         """
         Description:
-            Check if the rule already exists in the rules file
-            This function reads the rules file line by line and determines if the
-            provided rule is present in any of the lines. It is useful for avoiding
-            duplicate entries in the rules file.
+            Check if the rule already exists in the rules file (or in one of its shards)
+            The check is done against the rule index, which is keyed by the fingerprint
+            of each rule. Two rules are the same if they only differ in their sid/rev,
+            whitespace or the order of their options. The lookup is O(1), the rules file
+            is only parsed again when it has changed since the index last saw it.
 
         Args:
             rule (str): Rule to be checked
@@ -561,77 +1852,114 @@ class ManagerSnort:
             bool: True if the rule exists, False otherwise
         """
 
-        # This needs to change if we are going to go with the pretty building of the rule
+        return any(store.get_rule_index().contains(rule) for store in self.rule_stores())
 
-        with open(self.rules_file, "r") as file:
-            rules = self.read_snort_rules(rules=file.readlines())
-            # For now this function can't accurately check if a snort rule is duplicate,
-            # because of the different sids
+    def get_rule_index(self) -> RuleIndex:
+        """
+        Description:
+            Get the rule index, bringing it up to date first if the rules file was changed
+            (different mtime or size) since it was last indexed. Rules appended by someone
+            else are added to the index, it is only rebuilt if the file was rewritten.
 
-            # From the rule to add, create a temp without the sid
-            temp_rule = self.read_snort_rule_no_sid(rule)
+        Returns:
+            RuleIndex: The up to date index of the rules file
+        """
+        index = self.rule_index
+        with index.lock:
+            if index.is_stale():
+                signature = index.file_signature()
+                # The rules are streamed into the index, the file is never held in memory
+                index.extend(self.index_reader.scan(on_reset=index.clear, located=True), signature)
+                index.extend(self.index_reader.tail(located=True), signature)
+                self.sid_allocator.warm_up(index.sids())
+        return index
+
+    def rules_size(self) -> int:
+        try:
+            return os.path.getsize(self.rules_file)
+        except FileNotFoundError:
+            return 0
+
+    def load_rule_index(self) -> bool:
+        """
+        Description:
+            Load the rule index from its sidecar file, and continue reading the rules file
+            from where the index was saved. If the rules file was appended to since, only
+            the new rules are parsed when the index is next used. If it was rewritten (its
+            size, mtime and the hash of its content at the saved offset do not match), it
+            is parsed from the start.
 
-            # rules = list(map(self.rule_splitter, rules))
-            # rule_obj = self.rule_splitter(rule)
-            if any(rule in rule_line for rule_line in rules):
-                return True
-            return False
+        Returns:
+            bool: True if the sidecar was loaded.
+        """
+        index = self.rule_index
+        with index.lock:
+            state = index.load(self.index_file)
+            if state is None:
+                return False
+            self.index_reader.restore(state)
+            self.sid_allocator.warm_up(index.sids())
+        return True
+
+    def save_rule_index(self):
+        """
+        Description:
+            Bring the rule index up to date with the rules file and save it to its sidecar file.
+        """
+        index = self.rule_index
+        with self.rules_lock, index.lock:
+            signature = index.file_signature()
+            index.extend(self.index_reader.scan(on_reset=index.clear, located=True), signature)
+            index.extend(self.index_reader.tail(located=True), signature)
+            self.sid_allocator.warm_up(index.sids())
+            index.save(self.index_file, self.index_reader.state())
 
     def get_rules_from_file(self) -> list[str]:
         """
         Description:
             Get the rules from the rules file
-            This function reads the rules file and returns a list of rules.
-            It removes comments and empty lines from the rules.
+            This function returns a list of the rules in the rules file, without comments
+            and empty lines. The rules file is read incrementally: only the bytes appended
+            since the previous call are parsed, unless the file was truncated or rewritten.
 
         Returns:
             list[str]: List of rules from the rules file
         """
-        with open(self.rules_file, "r") as file:
-            return self.read_snort_rules(rules=file.readlines())
+        return self.rule_reader.read()
 
-    def read_snort_rules(self, rules: list[str]) -> list[str]:
+    def iter_rules_from_file(self):
         """
-        Processes a list of Snort rules and returns a list of valid rules.
-
-        This method filters out comments, handles multi-line rules, and ensures
-        that only properly formatted rules are included in the result.
-
-        Args:
-            rules (list[str]): A list of strings representing Snort rules.
+        Description:
+            Stream the rules of the rules file, one at a time, without comments and
+            empty lines. Only the line being parsed (or the lines of a multi-line rule)
+            is in memory, so a caller can stop early, or aggregate over the rules of a
+            large rules file with constant memory.
 
-        Returns:
-            list[str]: A list of processed Snort rules. Single-line rules are
-            included directly, while multi-line rules are concatenated into
-            single strings.
+        Yields:
+            str: The rules of the rules file, in file order.
         """
+        try:
+            with open(self.rules_file, "r") as file:
+                yield from self.read_snort_rules(file)
+        except FileNotFoundError:
+            return
 
-        # rules =
-        result = []
-        temp = []
-        multi_line = False
-        for rule in rules:
-            # Remove comments and strip whitespace
-            rule = rule.strip()
-            if rule.startswith("#"):
-                continue
+    def read_snort_rules(self, rules):
+        """
+        Processes Snort rules lazily and yields the valid rules.
 
-            # This will only get the rules that are one lined
-            if rule and rule.endswith(")") and rule != ")":
-                result.append(rule)
+        This method filters out comments, handles multi-line rules, and ensures
+        that only properly formatted rules are included in the result. The lines
+        are consumed one at a time, so a file handle can be given directly.
 
-            # This is going to start handling the rule as if it is in multiple lines
-            elif rule and not rule.endswith(")") and rule != ")":
-                temp.append(rule)
-                multi_line = True
-            # If the rule is multi-line and ends with a closing parenthesis, we join the temp list
-            elif multi_line and rule.endswith(")"):
-                temp.append(rule)
-                result.append(" ".join(temp))
-                temp = []
-                multi_line = False
+        Args:
+            rules (Iterable[str]): Lines of Snort rules, e.g. a list of strings or an open file.
 
-        return result
+        Yields:
+            str: The processed Snort rules. Single-line rules are yielded directly,
+            while multi-line rules are concatenated into single strings.
+        """
+        yield from RuleParser().feed(rules)
 
     def read_snort_rule_no_sid(self, rule: str, pretty: bool = False) -> str:
         """
@@ -653,30 +1981,40 @@ class ManagerSnort:
             return "\n".join(temp_rule)
         return " ".join(temp_rule)
 
-    def get_current_sid(self, start=10000, end=20000) -> int:
+    def get_current_sid(self) -> int:
         """
         Description:
-            Get the current Snort ID Version (sid) from the rules file.
-            This function reads the rules file and extracts the sid from the first line.
+            Reserve the next free Snort ID (sid) for a new rule.
+            The sid comes from the sid allocator in O(1), which was warmed up from the
+            rules file at startup and persists its high-water mark, so the same sid is
+            never handed out twice.
+
+        Raises:
+            SidRangeExhaustedError: If there are no free sids left in the configured range.
 
         Returns:
-            str: The current Snort ID Version (sid).
+            int: The reserved sid.
+        """
+        return self.sid_allocator.reserve()
+
+    def parse_rule(self, rule: str) -> SnortRule:
         """
-        # Get all the rules
+        Description:
+            Parse a Snort rule string into a `SnortRule`.
 
-        rules = list(map(self.rule_splitter, self.get_rules_from_file()))
-        # Get all the sids from the rules
-        sids = list(map(lambda x: x.get("options", {}).get("sid"), rules))
+        Args:
+            rule (str): The Snort rule string to be parsed.
 
-        # Filter the sids to get the ones in the range
-        filtered_sids = [int(sid) for sid in sids if start <= int(sid) <= end]
-        current_sid = max(filtered_sids) + 1 if filtered_sids else start
-        return current_sid
+        Returns:
+            SnortRule: The parsed rule.
+        """
+        return SnortRule.parse(rule)
 
     def rule_splitter(self, rule: str) -> dict:
         """
         Description:
             Parses a Snort rule string and extracts its configurations into a dictionary.
+            Prefer `parse_rule`, this layout is kept for the existing callers.
 
         Args:
             rule (str): The Snort rule string to be parsed.
@@ -684,38 +2022,50 @@ class ManagerSnort:
         Returns:
             dict: A dictionary containing the parsed configurations of the rule.
         """
-        # Initialize the result dictionary
-        parsed_rule = {}
-
-        # Split the rule into header and options
-        header, options = rule.split("(", 1)
-        options = options.rstrip(")")
-
-        # Parse the header
-        header_parts = header.strip().split()
-        if len(header_parts) >= 6:
-            parsed_rule["action"] = header_parts[0]
-            parsed_rule["protocol"] = header_parts[1]
-            parsed_rule["src_ip"] = header_parts[2]
-            parsed_rule["src_port"] = header_parts[3]
-            parsed_rule["direction"] = header_parts[4]
-            parsed_rule["dst_ip"] = header_parts[5]
-            parsed_rule["dst_port"] = (
-                header_parts[6] if len(header_parts) > 6 else "any"
-            )
+        return self.parse_rule(rule).to_dict()
+
 
-        # Parse the options
-        options_dict = {}
-        for option in options.split(";"):
-            if ":" in option:
-                key, value = option.split(":", 1)
-                options_dict[key.strip()] = value.strip()
-            elif option.strip():
-                options_dict[option.strip()] = True
+class RuleShard(ManagerArguments, ManagerFiles, ManagerSnort):
+    """
+    Description:
+        The generated rules of one command family (see `ManagerSnort.SHARD_FAMILIES`), in
+        a rules file of their own next to the rules file of the agent,
+        `<rules file stem>.<family>.rules`.
 
-        parsed_rule["options"] = options_dict
+        A shard keeps the same state next to its rules file as the agent keeps next to
+        its own: the indexes and their sidecars, the readers, the rewriter, the expiry of
+        its rules and its backups (named after its file). Appending a rule, checking it
+        for duplicates, editing, compacting and backing up the rules of a family
+        therefore only touch the file of that family. The sid allocator, the history, the
+        layout of the generated rules and the reload trigger are the agent's.
+    """
 
-        return parsed_rule
+    def __init__(self, agent: ManagerSnort, family: str, kwargs: dict):
+        """
+        Args:
+            agent (ManagerSnort): The agent the shard belongs to.
+            family (str): The command family, e.g. `block_ip`.
+            kwargs (dict): The keyword arguments passed to the agent.
+        """
+        self.family = family
+        self.args = getattr(agent, "args", None)
+        self.directory = agent.directory
+        self.data_backup_path = agent.data_backup_path
+        self.rules_file = Path(agent.rules_file.parent, f"{agent.rules_file.stem}.{family}.rules")
+        self.file = self.rules_file.name
+        # Snort fails on an include of a missing file
+        self.rules_file.touch(exist_ok=True)
+        self.backup_store = self.build_backup_store(self.rules_file, kwargs)
+        self.history_file = agent.history_file
+        self.history_store = agent.history_store
+
+        self.pretty_rules = agent.pretty_rules
+        self.consolidate_domains = agent.consolidate_domains
+        self.sid_allocator = agent.sid_allocator
+        self.ip_aggregator = None
+        self.snort_reloader = agent.snort_reloader
+        self.rule_shards = None
+        self.init_rules_file(kwargs)
 
 
 if __name__ == "__main__":
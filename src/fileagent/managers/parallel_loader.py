@@ -0,0 +1,155 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import base64
+import multiprocessing
+import os
+from fileagent.managers.rule_index import RuleIndex, rule_fingerprint
+from fileagent.managers.rule_reader import RuleReader
+
+
+# The first word of the first line of a rule
+ACTIONS = (
+    b"alert",
+    b"block",
+    b"drop",
+    b"log",
+    b"pass",
+    b"react",
+    b"reject",
+    b"rewrite",
+    b"sdrop",
+)
+
+
+def parse_range(path: str, start: int, end: int) -> dict:
+    """
+    Description:
+        Parse the rules between two byte offsets of a rules file, in a worker process.
+        `start` has to be at a rule boundary (see `ParallelRuleLoader.split_points`).
+
+    Returns:
+        dict: The fingerprints, sids and offsets of the rules, and the state of the parser
+        at `end` (a partial last line, the lines of a rule that is not closed yet).
+    """
+    reader = RuleReader(path, keep_rules=False)
+    reader.offset = start
+    fingerprints, sids, offsets = [], [], []
+    with open(path, "rb") as file:
+        for offset, rule in reader.parser.feed_located(reader.lines(file, end)):
+            fingerprints.append(rule_fingerprint(rule))
+            sids.append(RuleIndex.rule_sid(rule))
+            offsets.append(offset)
+    return {
+        "fingerprints": fingerprints,
+        "sids": sids,
+        "offsets": offsets,
+        "partial": reader.partial,
+        "pending": reader.parser.pending,
+        "pending_offset": reader.parser.pending_offset,
+    }
+
+
+class ParallelRuleLoader:
+    """
+    Description:
+        Index a large rules file with a pool of processes.
+
+        The file is cut into chunks at rule boundaries: the start of a line that begins
+        with a rule action, right after a line that closes a rule (or a comment/empty line
+        after one). A multi-line (pretty) rule is therefore never split between two chunks.
+        The chunks are fingerprinted in parallel, and the results are merged, in file order,
+        into the rule index. The reader of the index continues from the end of the file, as
+        if it had parsed it itself.
+    """
+
+    def __init__(self, path, workers: int = None, chunks_per_worker: int = 4):
+        self.path = Path(path)
+        self.workers = workers or os.cpu_count() or 1
+        self.chunks_per_worker = chunks_per_worker
+
+    def split_points(self, size: int, parts: int) -> list[int]:
+        """
+        Description:
+            Find the offsets where the file can be cut into about `parts` chunks.
+
+        Returns:
+            list[int]: The start offset of every chunk, the first one is 0.
+        """
+        points = [0]
+        with open(self.path, "rb") as file:
+            for part in range(1, parts):
+                offset = self.boundary_after(file, max(size * part // parts, points[-1] + 1), size)
+                if offset is None:
+                    break
+                if offset > points[-1]:
+                    points.append(offset)
+        return points
+
+    @staticmethod
+    def boundary_after(file, offset: int, size: int) -> int | None:
+        """
+        Description:
+            Find the first rule boundary at or after the given offset.
+
+        Returns:
+            int | None: The offset of the boundary, or None if there is none until the end.
+        """
+        # Start from the line that begins after the offset
+        file.seek(offset - 1)
+        file.readline()
+        closed = False
+        while (position := file.tell()) < size:
+            line = file.readline()
+            stripped = line.strip()
+            if closed and stripped.startswith(ACTIONS):
+                return position
+            if stripped and not stripped.startswith(b"#"):
+                closed = stripped.endswith(b")")
+        return None
+
+    def load(self, index: RuleIndex, reader: RuleReader):
+        """
+        Description:
+            Index the whole rules file, and set the reader at its end.
+
+        Args:
+            index (RuleIndex): The index to fill, its previous content is dropped.
+            reader (RuleReader): The reader that keeps the index up to date afterwards.
+        """
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        points = self.split_points(stat.st_size, self.workers * self.chunks_per_worker)
+        ranges = list(zip(points, points[1:] + [stat.st_size]))
+
+        # Spawn, so that the workers do not inherit the threads of the agent
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+            results = list(
+                pool.map(
+                    parse_range,
+                    [str(self.path)] * len(ranges),
+                    [start for start, _ in ranges],
+                    [end for _, end in ranges],
+                )
+            )
+
+        with index.lock:
+            index.clear()
+            for result in results:
+                index.merge(result["fingerprints"], result["sids"], result["offsets"])
+            index.signature = signature
+
+            last = results[-1]
+            with open(self.path, "rb") as file:
+                check = reader.checksum(file, stat.st_size)
+            reader.restore(
+                {
+                    "offset": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "check": check.hex(),
+                    "partial": base64.b64encode(last["partial"]).decode("ascii"),
+                    "pending": last["pending"],
+                    "pending_offset": last["pending_offset"],
+                }
+            )
+            index.extend(reader.tail(located=True), signature)
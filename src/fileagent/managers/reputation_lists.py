@@ -0,0 +1,68 @@
+from pathlib import Path
+from fileagent.managers.ip_aggregator import CidrSet, IpLists
+
+
+class ReputationLists(IpLists):
+    """
+    Description:
+        Write the addresses of `block_ip` and `alert_ip` commands to the IP lists of the
+        Snort reputation inspector, instead of one rule per address.
+
+        The lists go into `directory`, which is meant to be the `list_dir` of the
+        `reputation` module: `ip.blocklist` (from `block_ip`), `ip.monitorlist` (from
+        `alert_ip`) and the `interface.info` that declares them. Every line is an address
+        or a CIDR prefix, deduplicated and merged into the smallest set of prefixes.
+
+        Snort configuration:
+            reputation = { list_dir = '<directory>' }
+    """
+
+    SOURCE = "reputation"
+
+    # The file, list id and list type of the lists of every action
+    LISTS = {
+        "block": ("ip.blocklist", 1, "block"),
+        "alert": ("ip.monitorlist", 2, "monitor"),
+    }
+
+    def __init__(self, directory, interval: float = 1.0):
+        """
+        Args:
+            directory (str | Path): The directory of the lists.
+            interval (float, optional): Minimum seconds between two rewrites of the lists.
+                With 0 the lists are rewritten on every change. Defaults to 1.0.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        super().__init__(interval, Path(self.directory, "ip.lists.lock"))
+
+    def load(self):
+        """
+        Description:
+            Read the prefixes back from the lists.
+        """
+        for action, (name, _, _) in self.LISTS.items():
+            try:
+                with open(Path(self.directory, name), "r") as file:
+                    lines = file.readlines()
+            except FileNotFoundError:
+                continue
+
+            cidrs = self.sets.setdefault(action, CidrSet())
+            for line in lines:
+                # A line may end with a comment
+                if prefix := line.partition("#")[0].strip():
+                    cidrs.add(prefix)
+
+    def paths(self) -> list[Path]:
+        return [Path(self.directory, name) for name, _, _ in self.LISTS.values()]
+
+    def files(self) -> dict[Path, str]:
+        files = {
+            Path(self.directory, name): "".join(f"{prefix}\n" for prefix in self.prefixes(action))
+            for action, (name, _, _) in self.LISTS.items()
+        }
+        files[Path(self.directory, "interface.info")] = "".join(
+            f"{name} {list_id} {list_type}\n" for name, list_id, list_type in self.LISTS.values()
+        )
+        return files
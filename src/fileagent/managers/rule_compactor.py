@@ -0,0 +1,101 @@
+from pathlib import Path
+import time
+from fileagent.managers.rule_index import rule_fingerprint
+from fileagent.managers.rule_reader import RuleParser
+from fileagent.managers.snort_rule import SnortRule
+
+
+class RuleCompactor:
+    """
+    Description:
+        Brings a rules file to its compact form: every rule on a single line, in the
+        canonical layout of `SnortRule.format`, without duplicates, and ordered by sid.
+
+        A rule is a duplicate of an earlier one when it has the same fingerprint (see
+        `rule_fingerprint`): an exact duplicate when the single line text is the same, a
+        semantic duplicate when only the sid, the rev, the option order or the
+        whitespace differ. The first one in the rules file is kept. The rules without a
+        sid, and the ones that cannot be parsed, come after the others, in the order of
+        the rules file. The comments are kept, at the top of the file.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def read(self) -> tuple[list[str], list[tuple[str, SnortRule | None]], int, float]:
+        """
+        Description:
+            Read and parse every rule of the rules file.
+
+        Returns:
+            tuple: The comment lines, the (text, parsed rule or None) of every rule, in
+            order, the number of lines of the file, and the seconds it took to read the
+            rules out of the lines (the pass of `RuleParser` every reader of the file makes).
+        """
+        comments = []
+        texts = []
+        parser = RuleParser()
+        lines = 0
+        start = time.perf_counter()
+        try:
+            with open(self.path, "r", encoding="utf-8", errors="replace") as file:
+                for line in file:
+                    lines += 1
+                    if line.lstrip().startswith("#"):
+                        comments.append(line.strip())
+                        continue
+                    texts.extend(parser.feed([line]))
+        except FileNotFoundError:
+            pass
+        seconds = time.perf_counter() - start
+
+        rules = []
+        for rule in texts:
+            try:
+                rules.append((rule, SnortRule.parse(rule)))
+            except ValueError:
+                rules.append((rule, None))
+        return comments, rules, lines, seconds
+
+    def compact(
+        self, rules: list[tuple[str, SnortRule | None]]
+    ) -> tuple[list[tuple[str, str, SnortRule | None]], int, int]:
+        """
+        Description:
+            Get the compact form of the rules.
+
+        Args:
+            rules (list[tuple[str, SnortRule | None]]): The rules, as returned by `read`.
+
+        Returns:
+            tuple: The (single line, fingerprint, parsed rule) of the rules that are kept,
+            ordered by sid, and the number of exact and of semantic duplicates that were
+            dropped.
+        """
+        kept = {}
+        exact = semantic = 0
+        for position, (rule, parsed) in enumerate(rules):
+            line = parsed.format() if parsed is not None else " ".join(rule.split())
+            fingerprint = rule_fingerprint(rule)
+            if (first := kept.get(fingerprint)) is not None:
+                if first[2] == line:
+                    exact += 1
+                else:
+                    semantic += 1
+                continue
+            sid = parsed.sid if parsed is not None else None
+            kept[fingerprint] = (sid is None, sid or 0, line, position, fingerprint, parsed)
+        ordered = sorted(kept.values(), key=lambda entry: (entry[0], entry[1], entry[3]))
+        return [(entry[2], entry[4], entry[5]) for entry in ordered], exact, semantic
+
+    def parse_seconds(self) -> float:
+        """
+        Description:
+            Time the pass of `RuleParser` over the rules file, as in `read`.
+        """
+        parser = RuleParser()
+        start = time.perf_counter()
+        with open(self.path, "r", encoding="utf-8", errors="replace") as file:
+            for _ in parser.feed(file):
+                pass
+        return time.perf_counter() - start
@@ -0,0 +1,306 @@
+from pathlib import Path
+import atexit
+import heapq
+import json
+import os
+import threading
+import time
+from fileagent.managers.file_lock import FileLock
+from fileagent.managers.rule_rewriter import sync_directory
+
+
+class RuleExpiry:
+    """
+    Description:
+        Expiry times of the rules that were uploaded with a `ttl_seconds`, and the reaper
+        that removes them from the rules file once they expire.
+
+        The rules are kept in a min-heap by expiry time, so the next rule to expire is
+        always on top, scheduling a rule is O(log n) and the reaper only ever looks at
+        the rules that are due. A rule that is rescheduled or removed is left in the heap
+        and skipped when it surfaces (lazy deletion), `expires` has the current time of
+        every rule.
+
+        The reaper is a background thread that sleeps until the next expiry. It then waits
+        `window` seconds more and removes everything that is due by then at once, so rules
+        that expire close to each other cost a single rewrite of the rules file.
+
+        The expiry times are kept in an append-only log of JSON lines next to the rules
+        file, so they survive a restart. A line with no expiry time cancels the rule.
+        The log is compacted when most of its lines are cancelled, with a durable atomic
+        replace, so a crash never leaves it half written or brings the old log back.
+
+        The log can be shared by several processes (e.g. the workers of uvicorn): it is
+        written under a `FileLock` (on `<log>.lock`), and what the others appended since
+        it was last read is read (`refresh`) before every write, before a compaction and
+        before the reaper looks for the rules that are due.
+    """
+
+    STOP = object()
+
+    def __init__(self, path, reap, window: float = 1.0):
+        """
+        Args:
+            path (str | Path): The expiry log.
+            reap (Callable[[list[tuple[str, dict]]], None]): Removes the given expired rules
+                (fingerprint and payload).
+            window (float, optional): Seconds the reaper waits after an expiry for more
+                rules to expire, to remove them together. Defaults to 1.0.
+        """
+        self.path = Path(path)
+        self.reap = reap
+        self.window = window
+        self.heap: list[tuple[float, str]] = []
+        self.expires: dict[str, float] = {}
+        self.payloads: dict[str, dict] = {}
+        self.lines = 0
+        # How far the log was read, and its inode, so that only what was appended since
+        # is read, unless the log was compacted (replaced) meanwhile
+        self.offset = 0
+        self.inode: int | None = None
+        self.file_lock = FileLock(self.path.with_name(f"{self.path.name}.lock"))
+        self.condition = threading.Condition(threading.RLock())
+        self.thread: threading.Thread | None = None
+        self.stopping = False
+        self.registered = False
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self.expires)
+
+    def load(self):
+        """
+        Description:
+            Read the expiry times back from the log.
+        """
+        self.refresh()
+        self.compact()
+
+    def refresh(self) -> bool:
+        """
+        Description:
+            Read the lines appended to the log since it was last read (e.g. by another
+            process) and apply them. The whole log is read again if it was replaced.
+
+        Returns:
+            bool: True if anything was read.
+        """
+        with self.condition:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return False
+            if stat.st_ino == self.inode and stat.st_size == self.offset:
+                return False
+
+            with open(self.path, "rb") as file:
+                stat = os.fstat(file.fileno())
+                if stat.st_ino != self.inode or stat.st_size < self.offset:
+                    self.expires.clear()
+                    self.payloads.clear()
+                    self.heap = []
+                    self.inode, self.offset, self.lines = stat.st_ino, 0, 0
+                file.seek(self.offset)
+                data = file.read()
+
+            # A last line without its newline is still being written
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                self.lines += 1
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Half written by a crashed process
+                    continue
+                fingerprint = record["fingerprint"]
+                if record.get("expires") is None:
+                    self.expires.pop(fingerprint, None)
+                    self.payloads.pop(fingerprint, None)
+                else:
+                    self.expires[fingerprint] = record["expires"]
+                    self.payloads[fingerprint] = record.get("payload")
+                    heapq.heappush(self.heap, (record["expires"], fingerprint))
+            self.offset += end
+            return end > 0
+
+    def write(self, records: list[dict]):
+        data = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+        data = data.encode("utf-8")
+        with self.condition, self.file_lock:
+            # The lines of the other processes come first
+            self.refresh()
+            with open(self.path, "ab") as file:
+                file.write(data)
+                self.inode = os.fstat(file.fileno()).st_ino
+            self.offset += len(data)
+            self.lines += len(records)
+
+    def compact(self):
+        """
+        Description:
+            Rewrite the log with only the rules that are still scheduled, when they are
+            less than half of its lines.
+        """
+        with self.condition:
+            if self.lines <= max(2 * len(self.expires), 1024):
+                return
+            with self.file_lock:
+                # The lines of the other processes are kept as well
+                self.refresh()
+                if self.lines <= max(2 * len(self.expires), 1024):
+                    return
+                temp_file = self.path.with_name(f"{self.path.name}.tmp")
+                records = [
+                    {"fingerprint": fingerprint, "expires": expires, "payload": self.payloads.get(fingerprint)}
+                    for fingerprint, expires in self.expires.items()
+                ]
+                with open(temp_file, "w") as file:
+                    file.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records))
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_file, self.path)
+                sync_directory(self.path)
+                stat = os.stat(self.path)
+                self.inode, self.offset, self.lines = stat.st_ino, stat.st_size, len(records)
+
+    def schedule(self, entries: list[tuple[str, float, dict]]):
+        """
+        Description:
+            Schedule rules to expire, and start the reaper if it is not running.
+
+        Args:
+            entries (list[tuple[str, float, dict]]): The fingerprint of each rule, the Unix
+                time it expires at, and the payload it came from (for the history).
+        """
+        if not entries:
+            return
+        with self.condition:
+            self.write(
+                [
+                    {"fingerprint": fingerprint, "expires": expires, "payload": payload}
+                    for fingerprint, expires, payload in entries
+                ]
+            )
+            for fingerprint, expires, payload in entries:
+                self.expires[fingerprint] = expires
+                self.payloads[fingerprint] = payload
+                heapq.heappush(self.heap, (expires, fingerprint))
+            self.condition.notify()
+        self.start()
+
+    def cancel(self, fingerprints):
+        """
+        Description:
+            Forget the expiry time of rules, e.g. once they are removed.
+        """
+        with self.condition:
+            # The rule may have been scheduled by another process
+            self.refresh()
+            fingerprints = [fingerprint for fingerprint in fingerprints if fingerprint in self.expires]
+            if not fingerprints:
+                return
+            self.write([{"fingerprint": fingerprint, "expires": None} for fingerprint in fingerprints])
+            for fingerprint in fingerprints:
+                del self.expires[fingerprint]
+                self.payloads.pop(fingerprint, None)
+            self.compact()
+
+    def next_expiry(self) -> float | None:
+        with self.condition:
+            while self.heap:
+                expires, fingerprint = self.heap[0]
+                if self.expires.get(fingerprint) == expires:
+                    return expires
+                heapq.heappop(self.heap)
+            return None
+
+    def due(self, now: float = None) -> list[tuple[str, dict]]:
+        """
+        Description:
+            Take the rules that expired by `now` off the heap. They stay scheduled until
+            they are cancelled, and are put back on the heap if their removal fails (see
+            `reap_due`), so it is retried.
+
+        Returns:
+            list[tuple[str, dict]]: The fingerprint and payload of every expired rule.
+        """
+        now = time.time() if now is None else now
+        expired = []
+        with self.condition:
+            while (expires := self.next_expiry()) is not None and expires <= now:
+                _, fingerprint = heapq.heappop(self.heap)
+                expired.append((fingerprint, self.payloads.get(fingerprint)))
+        return expired
+
+    def reap_due(self, now: float = None) -> int:
+        """
+        Description:
+            Remove the rules that expired by `now`, at once. If the removal fails, the rules
+            are put back on the heap, so the reaper tries again.
+
+        Returns:
+            int: The number of expired rules.
+        """
+        self.refresh()
+        if expired := self.due(now):
+            try:
+                self.reap(expired)
+            except BaseException:
+                self.restore(fingerprint for fingerprint, _ in expired)
+                raise
+        return len(expired)
+
+    def restore(self, fingerprints):
+        """
+        Description:
+            Put rules that were taken off the heap back on it, unless they were cancelled
+            (or rescheduled, which put them back already) meanwhile.
+        """
+        with self.condition:
+            queued = set(self.heap)
+            for fingerprint in fingerprints:
+                expires = self.expires.get(fingerprint)
+                if expires is not None and (expires, fingerprint) not in queued:
+                    heapq.heappush(self.heap, (expires, fingerprint))
+            self.condition.notify()
+
+    def start(self):
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping = False
+                self.thread = threading.Thread(target=self.run, name="fileagent-reaper", daemon=True)
+                self.thread.start()
+                if not self.registered:
+                    atexit.register(self.stop)
+                    self.registered = True
+
+    def stop(self):
+        """
+        Description:
+            Stop the reaper. The rules that did not expire yet stay in the log.
+        """
+        with self.condition:
+            thread = self.thread
+            self.thread = None
+            self.stopping = True
+            self.condition.notify()
+        if thread is not None and thread.is_alive():
+            thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.stopping:
+                    return
+                expires = self.next_expiry()
+                delay = None if expires is None else expires + self.window - time.time()
+                if delay is None or delay > 0:
+                    # Woken up early by a new rule, that may expire sooner, or by `stop`
+                    self.condition.wait(delay)
+                    continue
+            try:
+                self.reap_due(expires + self.window)
+            except Exception as exc:
+                print(f"Removing the expired rules failed: {exc}")
+                with self.condition:
+                    self.condition.wait(self.window or 1.0)
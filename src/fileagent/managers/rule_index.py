@@ -0,0 +1,537 @@
+from array import array
+from pathlib import Path
+import hashlib
+import json
+import os
+import re
+import threading
+from fileagent.managers.rule_rewriter import OffsetLog
+
+
+# Options that change between two otherwise identical rules and must not take part
+# in the duplicate detection.
+IGNORED_OPTIONS = ("sid", "rev")
+
+# Characters that can end an option, or start/end a quoted value
+SPECIAL_CHARACTERS = re.compile(r"""[;"'\\]""")
+
+
+def split_options(options: str) -> list[str]:
+    """
+    Description:
+        Split the body of a Snort rule (the part between the parentheses) into its options.
+        Semicolons that appear inside double quoted strings, inside a single quoted value
+        (e.g. `pcre:'...'` as written by the builder), or that are escaped with a backslash,
+        do not terminate an option.
+
+    Args:
+        options (str): The option body of the rule, without the surrounding parentheses.
+
+    Returns:
+        list[str]: The options of the rule, stripped and without the trailing semicolon.
+    """
+    if "'" not in options and "\\" not in options:
+        return split_double_quoted(options)
+
+    result = []
+    start = position = 0
+    quote = None
+    # Jump from one special character to the next instead of looking at every character
+    while match := SPECIAL_CHARACTERS.search(options, position):
+        char, index = match.group(), match.start()
+        position = index + 1
+        if char == "\\":
+            position += 1
+        elif quote:
+            if char == quote:
+                quote = None
+        elif char == '"' or (char == "'" and options[start:index].rstrip().endswith(":")):
+            quote = char
+        elif char == ";":
+            if option := options[start:index].strip():
+                result.append(option)
+            start = position
+
+    if option := options[start:].strip():
+        result.append(option)
+    return result
+
+
+def split_double_quoted(options: str) -> list[str]:
+    """
+    Description:
+        Fast path of `split_options` for the common option bodies, the ones without single
+        quotes and backslashes. The body is split on every semicolon and the pieces that
+        end inside a double quoted string are joined back.
+    """
+    result = []
+    pending = None
+    for part in options.split(";"):
+        if pending is not None:
+            pending = f"{pending};{part}"
+            if not part.count('"') % 2:
+                continue
+            part, pending = pending, None
+        elif part.count('"') % 2:
+            pending = part
+            continue
+        if part := part.strip():
+            result.append(part)
+
+    if pending is not None and (pending := pending.strip()):
+        result.append(pending)
+    return result
+
+
+def normalize_option(option: str) -> str:
+    """
+    Description:
+        Bring an option to its canonical text. Whitespace outside of quoted strings is
+        collapsed and removed around the `:` and `,` separators, quoted values are kept as is.
+
+    Args:
+        option (str): A single option, as returned by `split_options`.
+
+    Returns:
+        str: The canonical form of the option.
+    """
+    result = []
+    quoted = False
+    pending_space = False
+    for char in option:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char.isspace():
+            pending_space = True
+            continue
+
+        if pending_space:
+            if result and result[-1] not in ":," and char not in ":,":
+                result.append(" ")
+            pending_space = False
+        result.append(char)
+    return "".join(result)
+
+
+def option_key(option: str) -> str:
+    """
+    Description:
+        Get the keyword of an option, e.g. `sid` for `sid: 10000`.
+    """
+    return option.split(":", 1)[0].strip()
+
+
+def rule_options(rule: str) -> tuple[str, list[str]]:
+    """
+    Description:
+        Split a rule into its header and its list of options.
+
+    Args:
+        rule (str): The Snort rule, single line or pretty (multi-line).
+
+    Returns:
+        tuple[str, list[str]]: The header of the rule and its options.
+    """
+    header, _, options = rule.strip().partition("(")
+    options = options.strip()
+    if options.endswith(")"):
+        options = options[:-1]
+    return header, split_options(options)
+
+
+def canonical_rule(rule: str) -> str:
+    """
+    Description:
+        Build the canonical text of a rule that is used for duplicate detection.
+        The header tokens are joined with single spaces, the sid/rev options are dropped
+        and the rest of the options are normalized and sorted, so that formatting, option
+        order and the numbering of the rule do not matter.
+
+    Args:
+        rule (str): The Snort rule, single line or pretty (multi-line).
+
+    Returns:
+        str: The canonical text of the rule.
+    """
+    header, options = rule_options(rule)
+    canonical_options = sorted(
+        normalize_option(option)
+        for option in options
+        if option_key(option) not in IGNORED_OPTIONS
+    )
+    return f"{' '.join(header.split())} ({';'.join(canonical_options)})"
+
+
+def rule_fingerprint(rule: str) -> str:
+    """
+    Description:
+        Hash the canonical text of a rule into a short and stable fingerprint.
+
+    Args:
+        rule (str): The Snort rule to fingerprint.
+
+    Returns:
+        str: Hex digest identifying the rule regardless of sid, rev, whitespace and option order.
+    """
+    return hashlib.blake2b(
+        canonical_rule(rule).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+class RuleIndex:
+    """
+    Description:
+        Resident index of the rules in a rules file, keyed by the fingerprint of each rule.
+
+        The index remembers the size and modification time of the file it was built from.
+        When either of them changes without the index being told about it (the file was
+        edited by hand, restored from a backup, etc.) the index is considered stale and
+        has to be rebuilt before it is trusted again.
+
+        Along with its sid, the index knows the byte offset each rule starts at, when the
+        rule was read from the file. The index can be saved to a sidecar file next to the
+        rules file (`save`) and loaded back (`load`), so a restarted agent does not have
+        to parse the whole rules file again. When rules are cut out of the file, the
+        offsets of the others are moved through an offset log, see `splice`.
+    """
+
+    SIDECAR_VERSION = 1
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.fingerprints: dict[str, int | None] = {}
+        # The offsets as they were before the rewrites of the offset log, see `offset_of`
+        self.offsets: dict[str, int] = {}
+        self.moves = OffsetLog()
+        # The fingerprint of every sid, built on first use and kept up to date after that
+        self.by_sid: dict[int, str] | None = None
+        self.signature: tuple[int, int] | None = None
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.fingerprints)
+
+    def file_signature(self) -> tuple[int, int]:
+        """
+        Description:
+            Get the (mtime in ns, size) of the rules file. A missing file has the signature (0, 0).
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return (0, 0)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def is_stale(self) -> bool:
+        """
+        Description:
+            Check if the rules file changed since the index last saw it.
+        """
+        return self.signature != self.file_signature()
+
+    def rebuild(self, rules, signature: tuple[int, int]):
+        """
+        Description:
+            Replace the contents of the index with the given rules.
+
+        Args:
+            rules (Iterable[str]): The rules currently in the file.
+            signature (tuple[int, int]): The file signature taken before the rules were read.
+        """
+        fingerprints = {}
+        for rule in rules:
+            fingerprints[rule_fingerprint(rule)] = self.rule_sid(rule)
+
+        with self.lock:
+            self.fingerprints = fingerprints
+            self.offsets = {}
+            self.moves.clear()
+            self.by_sid = None
+            self.signature = signature
+
+    def clear(self):
+        """
+        Description:
+            Empty the index, e.g. before the rules file is indexed again from the start.
+        """
+        with self.lock:
+            self.fingerprints = {}
+            self.offsets = {}
+            self.moves.clear()
+            self.by_sid = None
+            self.signature = None
+
+    def extend(self, located_rules, signature: tuple[int, int]):
+        """
+        Description:
+            Add the rules read from the file, e.g. by a `RuleReader` scanning what was
+            appended to it, without rebuilding the index.
+
+        Args:
+            located_rules (Iterable[tuple[int, str]]): The rules, with the byte offset they start at.
+            signature (tuple[int, int]): The file signature taken before the rules were read.
+        """
+        with self.lock:
+            for offset, rule in located_rules:
+                self.record(rule_fingerprint(rule), self.rule_sid(rule), offset)
+            self.signature = signature
+
+    def record(self, fingerprint: str, sid: int | None, offset: int | None):
+        self.fingerprints[fingerprint] = sid
+        if offset is not None and (offset := self.moves.base(offset)) is not None:
+            self.offsets[fingerprint] = offset
+        if self.by_sid is not None and sid is not None:
+            self.by_sid[sid] = fingerprint
+
+    def merge(self, fingerprints: list[str], sids: list, offsets: list[int]):
+        """
+        Description:
+            Add rules that were already fingerprinted, e.g. by the workers of a `ParallelRuleLoader`.
+
+        Args:
+            fingerprints (list[str]): The fingerprints of the rules.
+            sids (list[int | None]): The sid of each rule.
+            offsets (list[int]): The byte offset each rule starts at.
+        """
+        with self.lock:
+            self.apply_moves()
+            self.fingerprints.update(zip(fingerprints, sids))
+            self.offsets.update(zip(fingerprints, offsets))
+            self.by_sid = None
+
+    def add(self, rules, appended_bytes: int = None, offsets: list[int] = None):
+        """
+        Description:
+            Record rules that were just appended to the rules file.
+            If the number of appended bytes is given and the file grew by exactly that much,
+            the index stays in sync with the file, otherwise it is marked as stale.
+
+        Args:
+            rules (str | list[str]): The appended rule, or rules.
+            appended_bytes (int, optional): Number of bytes written to the file for the rules.
+            offsets (list[int], optional): The byte offset each rule was written at.
+        """
+        if isinstance(rules, str):
+            rules = [rules]
+
+        with self.lock:
+            for position, rule in enumerate(rules):
+                self.record(
+                    rule_fingerprint(rule),
+                    self.rule_sid(rule),
+                    None if offsets is None else offsets[position],
+                )
+
+            if appended_bytes is None or self.signature is None:
+                self.signature = None
+                return
+
+            signature = self.file_signature()
+            if signature[1] == self.signature[1] + appended_bytes:
+                self.signature = signature
+            else:
+                self.signature = None
+
+    def splice(self, removed: dict, shift, signature: tuple[int, int], added=()):
+        """
+        Description:
+            Follow a rewrite of the rules file that cut rules out of it or replaced them,
+            without reading it again: the rules that were cut out are dropped, the rewrite
+            goes to the offset log (the offsets of the other rules are moved when they are
+            read) and the rules written in place of some are added. It costs the rules
+            that were changed, not the size of the index.
+
+        Args:
+            removed (dict[int, str]): The fingerprints of the rules that were cut out (or
+                replaced), by the offset they started at.
+            shift (OffsetShift): Maps the offsets before the rewrite to the offsets after it.
+            signature (tuple[int, int]): The file signature after the rewrite.
+            added (Iterable[tuple[int, str]], optional): The rules written by the rewrite,
+                with the offset they start at.
+        """
+        with self.lock:
+            for offset, fingerprint in removed.items():
+                # The same rule may be in the file twice, only the one at the offset goes
+                if self.offset_of(fingerprint) != offset:
+                    continue
+                del self.offsets[fingerprint]
+                sid = self.fingerprints.pop(fingerprint, None)
+                if self.by_sid is not None and self.by_sid.get(sid) == fingerprint:
+                    del self.by_sid[sid]
+            if self.moves.push(shift):
+                self.apply_moves()
+            for offset, rule in added:
+                self.record(rule_fingerprint(rule), self.rule_sid(rule), offset)
+            self.signature = signature
+
+    def apply_moves(self):
+        """
+        Description:
+            Move the offsets of every rule through the offset log, and clear it.
+        """
+        with self.lock:
+            moves = self.moves
+            if not moves:
+                return
+            first, move = moves.first, moves.composed()
+            self.offsets = {
+                fingerprint: offset if offset < first else moved
+                for fingerprint, offset in self.offsets.items()
+                if offset < first or (moved := move(offset)) is not None
+            }
+            moves.clear()
+
+    def fingerprint_of(self, sid: int) -> str | None:
+        """
+        Description:
+            Get the fingerprint of the indexed rule with the given sid, in O(1) (the map of
+            the sids is built once, on first use).
+        """
+        with self.lock:
+            if self.by_sid is None:
+                self.by_sid = {
+                    sid: fingerprint
+                    for fingerprint, sid in self.fingerprints.items()
+                    if sid is not None
+                }
+            return self.by_sid.get(sid)
+
+    def sids(self) -> list[int]:
+        """
+        Description:
+            Get the sids of the indexed rules.
+        """
+        return [sid for sid in self.fingerprints.values() if sid is not None]
+
+    def contains(self, rule: str) -> bool:
+        """
+        Description:
+            Check in O(1) if a rule equivalent to the given one is in the index.
+        """
+        return rule_fingerprint(rule) in self.fingerprints
+
+    def has_fingerprint(self, fingerprint: str) -> bool:
+        """
+        Description:
+            Check in O(1) if a rule with the given fingerprint is in the index.
+        """
+        return fingerprint in self.fingerprints
+
+    def get_offset(self, rule: str) -> int | None:
+        """
+        Description:
+            Get the byte offset, in the rules file, of the indexed rule that is equivalent to the given one.
+        """
+        return self.offset_of(rule_fingerprint(rule))
+
+    def offset_of(self, fingerprint: str) -> int | None:
+        """
+        Description:
+            Get the byte offset, in the rules file, of the indexed rule with the given fingerprint.
+        """
+        with self.lock:
+            offset = self.offsets.get(fingerprint)
+            if offset is None or not self.moves:
+                return offset
+            return self.moves(offset)
+
+    def save(self, sidecar, reader_state: dict):
+        """
+        Description:
+            Save the index to a sidecar file, along with the state of the reader that
+            indexed the rules file, so both can be restored after a restart.
+
+            The sidecar is a JSON header line (the signature of the rules file, the reader
+            state with the content hash at its offset, and the number of rules) followed
+            by the fingerprints, the sids and the offsets as packed arrays, which are
+            loaded without parsing every entry.
+
+        Args:
+            sidecar (str | Path): The sidecar file.
+            reader_state (dict): The state of the reader, see `RuleReader.state`.
+        """
+        sidecar = Path(sidecar)
+        with self.lock:
+            self.apply_moves()
+            fingerprints = list(self.fingerprints)
+            sids = array("q", (-1 if sid is None else sid for sid in self.fingerprints.values()))
+            offsets = array("q", (self.offsets.get(fingerprint, -1) for fingerprint in fingerprints))
+            header = {
+                "version": self.SIDECAR_VERSION,
+                "signature": self.signature,
+                "reader": reader_state,
+                "count": len(fingerprints),
+            }
+
+        temp_file = sidecar.with_name(f"{sidecar.name}.tmp")
+        with open(temp_file, "wb") as file:
+            file.write(json.dumps(header).encode("utf-8") + b"\n")
+            file.write("".join(fingerprints).encode("ascii"))
+            file.write(sids.tobytes())
+            file.write(offsets.tobytes())
+        os.replace(temp_file, sidecar)
+
+    def load(self, sidecar) -> dict | None:
+        """
+        Description:
+            Load the index from a sidecar file written by `save`.
+
+        Args:
+            sidecar (str | Path): The sidecar file.
+
+        Returns:
+            dict | None: The state of the reader to continue from, or None if there is no
+            usable sidecar (missing, from another version or truncated).
+        """
+        try:
+            with open(sidecar, "rb") as file:
+                header = json.loads(file.readline())
+                data = file.read()
+        except (FileNotFoundError, json.JSONDecodeError, UnicodeDecodeError):
+            return None
+
+        if not isinstance(header, dict) or header.get("version") != self.SIDECAR_VERSION:
+            return None
+        count = header["count"]
+        if len(data) != count * (32 + 8 + 8):
+            return None
+
+        hexdigests = data[: count * 32].decode("ascii")
+        fingerprints = [hexdigests[i : i + 32] for i in range(0, count * 32, 32)]
+        sids = array("q")
+        sids.frombytes(data[count * 32 : count * 40])
+        offsets = array("q")
+        offsets.frombytes(data[count * 40 :])
+
+        with self.lock:
+            self.fingerprints = {
+                fingerprint: None if sid < 0 else sid for fingerprint, sid in zip(fingerprints, sids)
+            }
+            self.offsets = {
+                fingerprint: offset
+                for fingerprint, offset in zip(fingerprints, offsets)
+                if offset >= 0
+            }
+            self.moves.clear()
+            self.by_sid = None
+            self.signature = tuple(header["signature"]) if header["signature"] else None
+        return header["reader"]
+
+    def get_sid(self, rule: str) -> int | None:
+        """
+        Description:
+            Get the sid of the indexed rule that is equivalent to the given one.
+        """
+        return self.fingerprints.get(rule_fingerprint(rule))
+
+    @staticmethod
+    def rule_sid(rule: str) -> int | None:
+        """
+        Description:
+            Extract the sid of a rule, if it has a numeric one.
+        """
+        for option in rule_options(rule)[1]:
+            if option_key(option) == "sid":
+                value = option.split(":", 1)[1].strip()
+                return int(value) if value.isdigit() else None
+        return None
@@ -0,0 +1,419 @@
+from pathlib import Path
+import base64
+import hashlib
+import os
+import threading
+
+
+class RuleParser:
+    """
+    Description:
+        Incremental parser of the lines of a rules file.
+        Comments and empty lines are skipped, single-line rules are emitted as they are,
+        and the lines of a multi-line rule are joined once its closing parenthesis is
+        reached. The lines of a rule that is not closed yet are kept, so the parser can be
+        fed a file in pieces (e.g. as it is being written) and still join the rule.
+    """
+
+    def __init__(self):
+        self.pending: list[str] = []
+        self.pending_offset: int | None = None
+
+    def feed(self, lines):
+        """
+        Description:
+            Parse more lines of the rules file.
+
+        Args:
+            lines (Iterable[str]): The next lines of the rules file.
+
+        Yields:
+            str: The rules completed by these lines.
+        """
+        for _, rule in self.feed_located((None, line) for line in lines):
+            yield rule
+
+    def feed_located(self, lines):
+        """
+        Description:
+            Parse more lines of the rules file, keeping track of where each rule starts.
+
+        Args:
+            lines (Iterable[tuple[int, str]]): The next lines, with the byte offset they start at.
+
+        Yields:
+            tuple[int, str]: The rules completed by these lines, with the offset of their first line.
+        """
+        for offset, rule in lines:
+            # Remove comments and strip whitespace
+            rule = rule.strip()
+            if rule.startswith("#"):
+                continue
+
+            # This will only get the rules that are one lined
+            if rule and rule.endswith(")") and rule != ")":
+                yield offset, rule
+
+            # This is going to start handling the rule as if it is in multiple lines
+            elif rule and not rule.endswith(")") and rule != ")":
+                if not self.pending:
+                    self.pending_offset = offset
+                self.pending.append(rule)
+
+            # If the rule is multi-line and ends with a closing parenthesis, we join the pending lines
+            elif self.pending and rule.endswith(")"):
+                self.pending.append(rule)
+                yield self.pending_offset, " ".join(self.pending)
+                self.pending = []
+
+
+class RuleReader:
+    """
+    Description:
+        Reader of a rules file that only parses what was appended since its last read.
+
+        The reader remembers the byte offset it reached and the state of the parser at
+        that offset (a rule, or a line, that was only partly written). The next read
+        starts from there. The whole file is parsed again only when it was not just
+        appended to: a different inode (replaced), a smaller size (truncated), the same
+        size with a different modification time, or different content right before the
+        offset or at the start of the file (rewritten).
+    """
+
+    CHECK_BYTES = 4096
+    CHUNK_BYTES = 1 << 16
+
+    def __init__(self, path, keep_rules: bool = True):
+        """
+        Args:
+            path (str | Path): The rules file.
+            keep_rules (bool, optional): Keep the rules that were read, for `read`. A reader
+                that only streams the new rules (`scan`) does not need them.
+        """
+        self.path = Path(path)
+        self.keep_rules = keep_rules
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        self.rules: list[str] = []
+        self.parser = RuleParser()
+        self.partial = b""
+        self.offset = 0
+        self.inode = None
+        self.mtime = None
+        self.check = None
+        # The bytes `check` was computed from, once the reader read them itself
+        self.edges: tuple[bytes, bytes] | None = None
+
+    def rule_at(self, offset: int) -> str | None:
+        """
+        Description:
+            Read the rule that starts at the given byte offset, e.g. one from the offsets
+            of the rule index.
+
+        Returns:
+            str | None: The rule, or None if no rule starts there.
+        """
+        parser = RuleParser()
+        try:
+            with open(self.path, "rb") as file:
+                file.seek(offset)
+                for line in file:
+                    for rule in parser.feed([line.decode("utf-8", errors="replace")]):
+                        return rule
+        except FileNotFoundError:
+            pass
+        return None
+
+    def checksum(self, file, offset: int) -> bytes:
+        """
+        Description:
+            Hash the start of the file and the bytes right before the offset.
+        """
+        return self.digest(*self.read_edges(file, offset))
+
+    def read_edges(self, file, offset: int) -> tuple[bytes, bytes]:
+        file.seek(0)
+        head = file.read(min(offset, self.CHECK_BYTES))
+        start = max(0, offset - self.CHECK_BYTES)
+        file.seek(start)
+        return head, file.read(offset - start)
+
+    @staticmethod
+    def digest(head: bytes, last: bytes) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(head)
+        digest.update(last)
+        return digest.digest()
+
+    def lines(self, file, end: int):
+        """
+        Description:
+            Read the complete lines between the offset and `end`, in chunks, so that only
+            a chunk of the file is in memory at a time. The last line is kept in
+            `partial` until its newline is written.
+
+        Yields:
+            tuple[int, str]: The byte offset of each line, and the line without its newline.
+        """
+        file.seek(self.offset)
+        buffer = self.partial
+        start = self.offset - len(buffer)
+        while self.offset < end:
+            chunk = file.read(min(self.CHUNK_BYTES, end - self.offset))
+            if not chunk:
+                break
+            self.offset += len(chunk)
+            *lines, buffer = (buffer + chunk).split(b"\n")
+            for line in lines:
+                yield start, line.decode("utf-8", errors="replace")
+                start += len(line) + 1
+        self.partial = buffer
+
+    def scan(self, on_reset=None, located: bool = False):
+        """
+        Description:
+            Stream the rules completed since the last scan, parsing only the bytes that were
+            appended to the rules file since then. The generator has to be exhausted before
+            the reader is used again.
+
+        Args:
+            on_reset (Callable[[], None], optional): Called before anything is yielded, when
+                the file is parsed from the start (first read, or the file was rewritten).
+            located (bool, optional): Yield the byte offset of each rule along with it.
+
+        Yields:
+            str | tuple[int, str]: The rules completed since the last scan.
+        """
+        with self.lock:
+            try:
+                file = open(self.path, "rb")
+            except FileNotFoundError:
+                self.reset()
+                if on_reset:
+                    on_reset()
+                return
+
+            with file:
+                stat = os.fstat(file.fileno())
+                if (
+                    stat.st_ino != self.inode
+                    or stat.st_size < self.offset
+                    or (stat.st_size == self.offset and stat.st_mtime_ns != self.mtime)
+                    or self.checksum(file, self.offset) != self.check
+                ):
+                    self.reset()
+                    self.inode = stat.st_ino
+                    if on_reset:
+                        on_reset()
+
+                # Only read up to the size seen above, a later append is read next time
+                for offset, rule in self.parser.feed_located(self.lines(file, stat.st_size)):
+                    if self.keep_rules:
+                        self.rules.append(rule)
+                    yield (offset, rule) if located else rule
+
+                self.mtime = stat.st_mtime_ns
+                self.edges = self.read_edges(file, self.offset)
+                self.check = self.digest(*self.edges)
+
+    def advance(self, data: bytes, start: int) -> bool:
+        """
+        Description:
+            Move the reader past bytes that were just appended to the rules file at `start`
+            by its writer, which already knows what they hold, without reading them back.
+            This is only done if the reader had reached `start`, and the file is exactly
+            `data` longer than that, otherwise the next scan reads what the reader missed.
+
+        Args:
+            data (bytes): The bytes that were appended.
+            start (int): The size of the file before the append.
+
+        Returns:
+            bool: True if the reader is now at the end of the file.
+        """
+        with self.lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return False
+            if (
+                stat.st_ino != self.inode
+                or self.offset != start
+                or stat.st_size != start + len(data)
+                or self.partial
+                or self.parser.pending
+            ):
+                return False
+
+            if self.edges is None:
+                # Restored from a saved state, the bytes behind the checksum are read once
+                with open(self.path, "rb") as file:
+                    edges = self.read_edges(file, start)
+                if self.digest(*edges) != self.check:
+                    return False
+                self.edges = edges
+
+            *lines, self.partial = data.split(b"\n")
+            offset = start
+            located = []
+            for line in lines:
+                located.append((offset, line.decode("utf-8", errors="replace")))
+                offset += len(line) + 1
+            for _, rule in self.parser.feed_located(located):
+                if self.keep_rules:
+                    self.rules.append(rule)
+
+            head, last = self.edges
+            if len(head) < self.CHECK_BYTES:
+                head = (head + data)[: self.CHECK_BYTES]
+            self.edges = (head, (last + data)[-self.CHECK_BYTES :])
+            self.offset = stat.st_size
+            self.mtime = stat.st_mtime_ns
+            self.check = self.digest(*self.edges)
+            return True
+
+    def rewritten(self, size: int) -> bool:
+        """
+        Description:
+            Follow a rewrite of the rules file by its writer, that the indexes fed by the
+            reader follow as well (see `RuleRewriter`): a reader that had reached the end of
+            the old file (`size`) moves to the end of the new one. Any other reader starts
+            over, and so does a reader that keeps the rules, which it can not follow.
+
+        Args:
+            size (int): The size of the file before the rewrite.
+
+        Returns:
+            bool: True if the reader is at the end of the new file.
+        """
+        with self.lock:
+            if (
+                self.keep_rules
+                or self.inode is None
+                or self.offset != size
+                or self.partial
+                or self.parser.pending
+            ):
+                self.reset()
+                return False
+            return self.skip_to_end()
+
+    def written(self) -> bool:
+        """
+        Description:
+            Follow a rules file its writer wrote whole, and indexed itself (see
+            `RuleCompactor`): the reader moves to the end of the new file. A reader that
+            keeps the rules starts over.
+
+        Returns:
+            bool: True if the reader is at the end of the new file.
+        """
+        with self.lock:
+            self.reset()
+            return not self.keep_rules and self.skip_to_end()
+
+    def skip_to_end(self) -> bool:
+        # Called with the lock held, after the last line of the file was fed to the parser
+        try:
+            with open(self.path, "rb") as file:
+                stat = os.fstat(file.fileno())
+                self.edges = self.read_edges(file, stat.st_size)
+        except FileNotFoundError:
+            self.reset()
+            return False
+        self.partial = b""
+        self.inode = stat.st_ino
+        self.offset = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.check = self.digest(*self.edges)
+        return True
+
+    def update(self) -> tuple[list[str], bool]:
+        """
+        Description:
+            Parse what was appended to the rules file since the last read.
+
+        Returns:
+            tuple[list[str], bool]: The rules completed since the last read, and whether
+            the file was parsed from the start (in which case those are all of its rules).
+        """
+        reset = []
+        rules = list(self.scan(on_reset=lambda: reset.append(True)))
+        return rules, bool(reset)
+
+    def tail(self, located: bool = False) -> list:
+        """
+        Description:
+            Get the rule completed by the last line of the file, when that line has no
+            newline yet (e.g. a hand edited file). It is not part of `rules` until its
+            newline is written, since the line may still be growing.
+
+        Args:
+            located (bool, optional): Return the byte offset of the rule along with it.
+
+        Returns:
+            list[str] | list[tuple[int, str]]: The rule completed by the last line, if any.
+        """
+        with self.lock:
+            if not self.partial:
+                return []
+            parser = RuleParser()
+            parser.pending = list(self.parser.pending)
+            parser.pending_offset = self.parser.pending_offset
+            line = (self.offset - len(self.partial), self.partial.decode("utf-8", errors="replace"))
+            rules = list(parser.feed_located([line]))
+            return rules if located else [rule for _, rule in rules]
+
+    def state(self) -> dict:
+        """
+        Description:
+            Get the position of the reader, to be stored next to the rules file and restored
+            by another reader later on, e.g. after a restart.
+
+        Returns:
+            dict: The offset reached, the signature of the file there and the parser state.
+        """
+        with self.lock:
+            return {
+                "offset": self.offset,
+                "mtime": self.mtime,
+                "check": self.check.hex() if self.check else None,
+                "partial": base64.b64encode(self.partial).decode("ascii"),
+                "pending": list(self.parser.pending),
+                "pending_offset": self.parser.pending_offset,
+            }
+
+    def restore(self, state: dict):
+        """
+        Description:
+            Continue from a position returned by `state`. If the file is not the one the
+            state was taken from (its content at the offset differs), the next scan parses
+            it from the start as usual.
+        """
+        with self.lock:
+            self.reset()
+            try:
+                self.inode = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                return
+            self.offset = state["offset"]
+            self.mtime = state["mtime"]
+            self.check = bytes.fromhex(state["check"]) if state["check"] else None
+            self.partial = base64.b64decode(state["partial"])
+            self.parser.pending = list(state["pending"])
+            self.parser.pending_offset = state["pending_offset"]
+
+    def read(self) -> list[str]:
+        """
+        Description:
+            Get all the rules of the rules file, parsing only what is new.
+            Only available when the reader keeps the rules (`keep_rules`).
+
+        Returns:
+            list[str]: The rules of the rules file.
+        """
+        with self.lock:
+            self.update()
+            return self.rules + self.tail()
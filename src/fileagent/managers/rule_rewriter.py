@@ -0,0 +1,379 @@
+from bisect import bisect_right
+from pathlib import Path
+import os
+import shutil
+from fileagent.managers.rule_reader import RuleParser
+
+
+def sync_directory(path: Path):
+    """
+    Description:
+        Sync the directory of a file that was just replaced, so the rename itself is
+        durable and a crash does not bring the previous file back.
+    """
+    try:
+        descriptor = os.open(Path(path).parent, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+class OffsetShift:
+    """
+    Description:
+        Maps the byte offsets of the rules file before a rewrite to the offsets after it,
+        given the byte ranges that were cut out of it (or replaced), in O(log ranges) per
+        offset. The indexes use it to follow the rewrite instead of parsing the rules file
+        again.
+    """
+
+    def __init__(self, ranges: list[tuple[int, int]], inserted: list[int] | None = None):
+        """
+        Args:
+            ranges (list[tuple[int, int]]): The (start, end) of the ranges that were cut
+                out, sorted and not overlapping.
+            inserted (list[int], optional): The number of bytes written in place of each
+                range, a rule that replaces the one that started there. Defaults to none.
+        """
+        self.starts = [start for start, _ in ranges]
+        self.ends = [end for _, end in ranges]
+        self.inserted = inserted or [0] * len(ranges)
+        self.cut = []
+        # Where each range starts after the rewrite
+        self.new_starts = []
+        total = 0
+        for (start, end), written in zip(ranges, self.inserted):
+            self.new_starts.append(start - total)
+            total += end - start - written
+            self.cut.append(total)
+
+    def __bool__(self) -> bool:
+        return bool(self.starts)
+
+    @property
+    def first(self) -> float:
+        # The offsets before it do not move
+        return self.starts[0] if self.starts else float("inf")
+
+    @property
+    def removed_bytes(self) -> int:
+        return self.cut[-1] if self.cut else 0
+
+    def __call__(self, offset: int) -> int | None:
+        """
+        Returns:
+            int | None: The offset after the rewrite, or None if it was cut out. The offset
+            of a replaced rule maps to the offset of its replacement.
+        """
+        position = bisect_right(self.starts, offset)
+        if position and offset < self.ends[position - 1]:
+            if offset == self.starts[position - 1] and self.inserted[position - 1]:
+                return self.new_starts[position - 1]
+            return None
+        return offset - (self.cut[position - 1] if position else 0)
+
+    def inverse(self, offset: int) -> int | None:
+        """
+        Returns:
+            int | None: The offset before the rewrite of an offset after it, or None if it
+            is inside a replacement (and not at its start).
+        """
+        position = bisect_right(self.new_starts, offset)
+        if not position:
+            return offset
+        position -= 1
+        start, written = self.new_starts[position], self.inserted[position]
+        if written and offset == start:
+            return self.starts[position]
+        if offset < start + written:
+            return None
+        return offset + self.cut[position]
+
+
+class OffsetLog:
+    """
+    Description:
+        The rewrites an index followed without moving its offsets yet.
+
+        An index that keeps an offset log stores every offset as it was before the oldest
+        rewrite of the log, and maps it through the log when it is read (a lookup only
+        reads the offsets of the rules it returns). Following a rewrite then only costs
+        the rules it changed, instead of moving the offset of every rule. Once the log
+        holds `MAX_PENDING` rewrites the index moves all of its offsets at once, and
+        clears the log.
+    """
+
+    MAX_PENDING = 64
+
+    def __init__(self):
+        self.shifts: list[OffsetShift] = []
+
+    def __len__(self) -> int:
+        return len(self.shifts)
+
+    def clear(self):
+        self.shifts = []
+
+    def push(self, shift: OffsetShift) -> bool:
+        """
+        Description:
+            Add a rewrite to the log.
+
+        Returns:
+            bool: True if the log is full, and the index should move its offsets.
+        """
+        if shift:
+            self.shifts.append(shift)
+        return len(self.shifts) >= self.MAX_PENDING
+
+    @property
+    def first(self) -> float:
+        # The offsets before it were not moved by any of the rewrites
+        return min((shift.first for shift in self.shifts), default=float("inf"))
+
+    def __call__(self, offset: int) -> int | None:
+        """
+        Returns:
+            int | None: The current offset of a stored offset, or None if its rule was
+            cut out.
+        """
+        for shift in self.shifts:
+            if (offset := shift(offset)) is None:
+                return None
+        return offset
+
+    def composed(self):
+        """
+        Description:
+            Compose the rewrites of the log into a single map, to move many offsets at once
+            with one bisection each instead of one per rewrite. Every rewrite only moves
+            or drops the offsets between the boundaries of its ranges, so the map is
+            constant between the boundaries of all the rewrites, taken back to stored
+            offsets, and it is evaluated once at each of them.
+
+        Returns:
+            Callable[[int], int | None]: The map of the stored offsets to the current ones.
+        """
+        points = set()
+        for position, shift in enumerate(self.shifts):
+            earlier = self.shifts[:position]
+            for start, end in zip(shift.starts, shift.ends):
+                for boundary in (start, end):
+                    for previous in reversed(earlier):
+                        if (boundary := previous.inverse(boundary)) is None:
+                            # Inside a replacement, not a boundary the agent writes
+                            return self
+                    points.update((boundary, boundary + 1))
+        points = sorted(points)
+        deltas = [None if (moved := self(point)) is None else point - moved for point in points]
+
+        def move(offset: int) -> int | None:
+            position = bisect_right(points, offset) - 1
+            if position < 0:
+                return offset
+            delta = deltas[position]
+            return None if delta is None else offset - delta
+
+        return move
+
+    def base(self, offset: int) -> int | None:
+        """
+        Returns:
+            int | None: The offset to store for a rule that starts at the given current
+            offset (e.g. one that was just appended).
+        """
+        for shift in reversed(self.shifts):
+            if (offset := shift.inverse(offset)) is None:
+                return None
+        return offset
+
+
+class RuleRewriter:
+    """
+    Description:
+        Rewrites the rules file without some of its rules, or with some of them replaced,
+        atomically.
+
+        The rules to change are given by the byte offset they start at (as kept by the rule
+        index), so only those rules are parsed: the rewriter seeks to each of them to find
+        where it ends, and then copies the rest of the file around them, in chunks, into a
+        temporary file next to it. The temporary file is fsynced and renamed over the rules
+        file, so a reader (or Snort) sees either the old file or the new one, never a half
+        written one. The empty line the agent writes before each rule goes with it when
+        the rule is removed, and stays when it is replaced.
+    """
+
+    CHUNK_BYTES = 1 << 20
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def extent(self, file, offset: int) -> tuple[int, int, str] | None:
+        """
+        Description:
+            Find the bytes of the rule that starts at the offset, with the empty line before it.
+
+        Returns:
+            tuple[int, int, str] | None: The start and the end of the bytes, and the text
+            of the rule, or None if no rule starts there.
+        """
+        if offset > 0:
+            file.seek(offset - 1)
+            if file.read(1) != b"\n":
+                return None
+        file.seek(offset)
+        parser = RuleParser()
+        end = offset
+        for line in file:
+            end += len(line)
+            for _ in parser.feed([line.decode("utf-8", errors="replace")]):
+                # The rule as it is written, e.g. on several lines
+                file.seek(offset)
+                rule = file.read(end - offset).decode("utf-8", errors="replace").strip()
+                start = offset
+                if offset >= 2:
+                    file.seek(offset - 2)
+                    if file.read(1) == b"\n":
+                        start = offset - 1
+                elif offset == 1:
+                    start = 0
+                return start, end, rule
+            if not parser.pending:
+                # The offset is not the start of a rule (a comment or an empty line)
+                return None
+        return None
+
+    def rule_at(self, offset: int) -> str | None:
+        """
+        Description:
+            Read the rule that starts at the offset, as it is written (e.g. on several lines).
+        """
+        try:
+            with open(self.path, "rb") as file:
+                found = self.extent(file, offset)
+        except FileNotFoundError:
+            return None
+        return None if found is None else found[2]
+
+    def remove(self, offsets, accept=None) -> tuple[dict[int, str], OffsetShift]:
+        """
+        Description:
+            Remove the rules that start at the given offsets from the rules file.
+
+        Args:
+            offsets (Iterable[int]): The byte offsets of the rules to remove.
+            accept (Callable[[int, str], bool], optional): Called with each offset and the
+                rule found there, only the rules it accepts are removed (e.g. to check that
+                the rule there is still the expected one).
+
+        Returns:
+            tuple[dict[int, str], OffsetShift]: The removed rules, by the offset they
+            started at, and the map of the offsets of the other rules.
+        """
+        removed, _, shift = self.rewrite(dict.fromkeys(offsets), accept)
+        return removed, shift
+
+    def rewrite(
+        self, changes: dict, accept=None
+    ) -> tuple[dict[int, str], dict[int, int], OffsetShift]:
+        """
+        Description:
+            Remove or replace the rules that start at the given offsets, in a single
+            rewrite of the rules file.
+
+        Args:
+            changes (dict[int, str | None]): The text to write in place of the rule at each
+                offset, or None to remove it.
+            accept (Callable[[int, str], bool], optional): Called with each offset and the
+                rule found there, only the rules it accepts are changed.
+
+        Returns:
+            tuple[dict[int, str], dict[int, int], OffsetShift]: The rules that were there
+            before, by the offset they started at, the offset each replacement starts at
+            after the rewrite, and the map of the offsets of the other rules (the changed
+            rules map to None).
+        """
+        found = {}
+        ranges = []
+        texts = []
+        with open(self.path, "rb") as source:
+            for offset in sorted(changes):
+                if ranges and offset < ranges[-1][1]:
+                    continue
+                extent = self.extent(source, offset)
+                if extent is None:
+                    continue
+                start, end, rule = extent
+                if accept is not None and not accept(offset, rule):
+                    continue
+                text = changes[offset]
+                if text is None:
+                    ranges.append((start, end))
+                    texts.append(b"")
+                else:
+                    ranges.append((offset, end))
+                    texts.append(text.strip().encode("utf-8") + b"\n")
+                found[offset] = rule
+
+            shift = OffsetShift(ranges, [len(text) for text in texts])
+            if not ranges:
+                return found, {}, shift
+
+            moved = {}
+            temp_file = self.path.with_name(f"{self.path.name}.tmp")
+            with open(temp_file, "wb") as target:
+                position = 0
+                for (start, end), text in zip(ranges + [(None, None)], texts + [b""]):
+                    self.copy(source, target, position, start)
+                    if text:
+                        moved[start] = target.tell()
+                        target.write(text)
+                    position = end
+                target.flush()
+                os.fsync(target.fileno())
+        self.replace(temp_file)
+        return found, moved, shift
+
+    def publish(self, lines):
+        """
+        Description:
+            Replace the whole rules file with the given lines, atomically, e.g. with its
+            compact form.
+
+        Args:
+            lines (Iterable[str]): The lines of the new rules file, without their newline.
+        """
+        temp_file = self.path.with_name(f"{self.path.name}.tmp")
+        with open(temp_file, "w", encoding="utf-8") as target:
+            for line in lines:
+                target.write(f"{line}\n")
+            target.flush()
+            os.fsync(target.fileno())
+        self.replace(temp_file)
+
+    def replace(self, temp_file: Path):
+        # The temporary file takes the place (and the mode) of the rules file
+        if self.path.exists():
+            shutil.copymode(self.path, temp_file)
+        os.replace(temp_file, self.path)
+        self.sync_directory()
+
+    def copy(self, source, target, start: int, end: int | None):
+        source.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            size = self.CHUNK_BYTES if remaining is None else min(self.CHUNK_BYTES, remaining)
+            chunk = source.read(size)
+            if not chunk:
+                return
+            target.write(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    def sync_directory(self):
+        sync_directory(self.path)
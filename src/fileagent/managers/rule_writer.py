@@ -0,0 +1,132 @@
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+
+class RuleWriter:
+    """
+    Description:
+        Single writer of the rules file, with group commit.
+
+        Requests do not write to the rules file themselves, they submit their prepared
+        rules and wait for the returned future. A dedicated thread drains the queue,
+        coalesces everything that arrived within a short window into a single commit
+        (one backup, one write and one fsync), and then resolves the futures of every
+        request in the group. Stopping the writer drains the pending submissions first,
+        so nothing that was accepted is dropped on shutdown.
+    """
+
+    STOP = object()
+
+    def __init__(self, commit, window: float = 0.005, max_batch: int = 1000):
+        """
+        Args:
+            commit (Callable[[list], None]): Persists a group of submitted items.
+            window (float, optional): Seconds to wait for more submissions after the first one of a group.
+            max_batch (int, optional): Maximum number of items committed together.
+        """
+        self.commit = commit
+        self.window = window
+        self.max_batch = max_batch
+        self.queue: queue.Queue = queue.Queue()
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+        self.commits = 0
+
+    def start(self):
+        """
+        Description:
+            Start the writer thread, if it is not already running.
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run, name="fileagent-writer", daemon=True
+                )
+                self.thread.start()
+
+    def submit(self, items: list) -> Future:
+        """
+        Description:
+            Queue items to be committed together with whatever else arrives in the same window.
+
+        Args:
+            items (list): The items to commit, e.g. prepared rule contexts.
+
+        Returns:
+            Future: Resolves to the items once they are committed, or to the commit's exception.
+        """
+        future = Future()
+        self.start()
+        self.queue.put((items, future))
+        return future
+
+    def stop(self, timeout: float = None):
+        """
+        Description:
+            Commit everything that is still queued and stop the writer thread.
+        """
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None and thread.is_alive():
+            self.queue.put(self.STOP)
+            thread.join(timeout)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            first = self.queue.get()
+            if first is self.STOP:
+                break
+
+            group = [first]
+            count = len(first[0])
+            deadline = time.monotonic() + self.window
+            while count < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    submission = (
+                        self.queue.get(timeout=remaining)
+                        if remaining > 0
+                        else self.queue.get_nowait()
+                    )
+                except queue.Empty:
+                    break
+                if submission is self.STOP:
+                    stopping = True
+                    break
+                group.append(submission)
+                count += len(submission[0])
+
+            self.flush(group)
+
+        # Drain whatever was submitted after the stop request
+        pending = []
+        while True:
+            try:
+                submission = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if submission is not self.STOP:
+                pending.append(submission)
+        if pending:
+            self.flush(pending)
+
+    def flush(self, group: list):
+        """
+        Description:
+            Commit a group of submissions at once and resolve their futures.
+        """
+        items = [item for submission, _ in group for item in submission]
+        try:
+            self.commit(items)
+        except Exception as exc:
+            for _, future in group:
+                future.set_exception(exc)
+        else:
+            for submission, future in group:
+                future.set_result(submission)
+        finally:
+            self.commits += 1
@@ -0,0 +1,121 @@
+from pathlib import Path
+import json
+import os
+from fileagent.managers.file_lock import FileLock
+from fileagent.managers.rule_rewriter import sync_directory
+
+
+class SidRangeExhaustedError(RuntimeError):
+    """
+    Raised when every sid of the configured range has already been handed out.
+    """
+
+
+class SidAllocator:
+    """
+    Description:
+        Hands out Snort ids (sids) from the range [start, end] in O(1).
+
+        The allocator keeps the next free sid (the high-water mark) in memory and persists it
+        in a small state file, so that a restart never hands out a sid that was already used,
+        even if the rule that used it has since been removed from the rules file.
+        Reservations are done under a lock, so concurrent requests never get the same sid.
+
+        The state file is shared by every process that allocates from it (e.g. the workers
+        of uvicorn): the lock is a `FileLock` on `<state file>.lock` as well, and the mark
+        is read back from the state file under it before it moves, so two processes never
+        hand out the same sid either.
+    """
+
+    def __init__(self, state_file, start: int = 10000, end: int = 20000):
+        if start > end:
+            raise ValueError("The start of the sid range must not be after its end")
+
+        self.state_file = Path(state_file)
+        self.start = start
+        self.end = end
+        self.lock = FileLock(self.state_file.with_name(f"{self.state_file.name}.lock"))
+        with self.lock:
+            self.next_sid = max(start, self.load())
+
+    def load(self) -> int:
+        """
+        Description:
+            Read the persisted high-water mark, if there is one.
+
+        Returns:
+            int: The next free sid stored in the state file, or the start of the range.
+        """
+        try:
+            with open(self.state_file, "r") as file:
+                return int(json.load(file).get("next_sid", self.start))
+        except (FileNotFoundError, ValueError, AttributeError):
+            return self.start
+
+    def save(self):
+        """
+        Description:
+            Persist the high-water mark. The new mark is synced to a temporary file that
+            then replaces the state file, and the directory is synced after the rename, so
+            a crash leaves either the previous mark or the new one in place.
+        """
+        temp_file = self.state_file.with_name(f"{self.state_file.name}.tmp")
+        with open(temp_file, "w") as file:
+            json.dump({"next_sid": self.next_sid}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, self.state_file)
+        sync_directory(self.state_file)
+
+    def warm_up(self, sids):
+        """
+        Description:
+            Move the high-water mark past the sids that are already in use.
+            This is meant to be fed with a single scan of the rules file at startup,
+            and again whenever the rules file is reindexed after an external change.
+            The mark never moves backwards.
+
+        Args:
+            sids (Iterable[int]): The sids found in the rules file. Sids outside the range are ignored.
+        """
+        in_range = [sid for sid in sids if sid is not None and self.start <= sid <= self.end]
+        if not in_range:
+            return
+
+        with self.lock:
+            self.next_sid = max(self.next_sid, self.load())
+            if (highest := max(in_range)) >= self.next_sid:
+                self.next_sid = highest + 1
+                self.save()
+
+    def reserve(self, count: int = 1) -> int:
+        """
+        Description:
+            Reserve `count` consecutive sids.
+
+        Args:
+            count (int, optional): Number of sids to reserve. Defaults to 1.
+
+        Raises:
+            SidRangeExhaustedError: If the range does not have `count` free sids left.
+
+        Returns:
+            int: The first of the reserved sids.
+        """
+        with self.lock:
+            # Another process may have moved the mark since
+            first = self.next_sid = max(self.next_sid, self.load())
+            if first + count - 1 > self.end:
+                raise SidRangeExhaustedError(
+                    f"No free sids left in the range {self.start}-{self.end}"
+                )
+            self.next_sid = first + count
+            self.save()
+            return first
+
+    def remaining(self) -> int:
+        """
+        Description:
+            Number of sids that can still be reserved.
+        """
+        return self.end - self.next_sid + 1
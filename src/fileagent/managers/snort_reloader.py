@@ -0,0 +1,306 @@
+from collections import deque
+from pathlib import Path
+import atexit
+import json
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import threading
+import time
+from fileagent.managers.file_lock import FileLock
+
+
+class ReloadCommand:
+    """
+    Description:
+        Reload Snort by running a command, e.g. `systemctl reload snort3`. The command is
+        split like a shell would, but it is not run through a shell.
+    """
+
+    def __init__(self, command: str, timeout: float = 30.0):
+        self.command = shlex.split(command)
+        self.timeout = timeout
+
+    def __call__(self):
+        subprocess.run(self.command, check=True, timeout=self.timeout, capture_output=True)
+
+    def __str__(self) -> str:
+        return f"command {shlex.join(self.command)}"
+
+
+class ReloadSignal:
+    """
+    Description:
+        Reload Snort by sending a signal (SIGHUP by default) to its process. The process is
+        given by its pid, or by the pid file Snort writes (`--create-pidfile`), which is read
+        again before every reload, so a restarted Snort is still found.
+    """
+
+    def __init__(self, pid: int | str, signum: int = signal.SIGHUP):
+        """
+        Args:
+            pid (int | str): The pid of the Snort process, or the path of its pid file.
+            signum (int, optional): The signal to send. Defaults to SIGHUP.
+        """
+        self.pid = int(pid) if str(pid).isdigit() else Path(pid)
+        self.signum = signum
+
+    @classmethod
+    def from_name(cls, pid: int | str, name: str = "HUP") -> "ReloadSignal":
+        """
+        Description:
+            Build the trigger from the name of the signal, with or without its `SIG` prefix.
+        """
+        name = name.upper()
+        return cls(pid, signal.Signals[name if name.startswith("SIG") else f"SIG{name}"])
+
+    def __call__(self):
+        pid = self.pid
+        if isinstance(pid, Path):
+            pid = int(pid.read_text().split()[0])
+        os.kill(pid, self.signum)
+
+    def __str__(self) -> str:
+        return f"signal {signal.Signals(self.signum).name} to {self.pid}"
+
+
+class ReloadSocket:
+    """
+    Description:
+        Reload Snort by sending a command to its control socket: a Unix socket path, or a
+        `host:port` for a TCP control port. The default command is the one of the Snort 3
+        shell. The command is sent as one line.
+    """
+
+    MESSAGE = "snort.reload_config()"
+
+    def __init__(self, address: str, message: str = MESSAGE, timeout: float = 5.0):
+        self.address = address
+        self.message = message.rstrip("\n") + "\n"
+        self.timeout = timeout
+
+    def connect(self) -> socket.socket:
+        host, colon, port = self.address.rpartition(":")
+        if colon and port.isdigit():
+            return socket.create_connection((host or "127.0.0.1", int(port)), timeout=self.timeout)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(self.timeout)
+        try:
+            client.connect(self.address)
+        except OSError:
+            client.close()
+            raise
+        return client
+
+    def __call__(self):
+        with self.connect() as client:
+            client.sendall(self.message.encode("utf-8"))
+
+    def __str__(self) -> str:
+        return f"control socket {self.address}"
+
+
+class SnortReloader:
+    """
+    Description:
+        Makes Snort reload its configuration after the rule set changed, at most once every
+        `window` seconds.
+
+        The first change after a reload starts a timer, and the changes that come in until
+        it fires are folded into a single reload, so a burst of uploads costs one reload of
+        the sensor instead of one per rule. With a `window` of 0 every change reloads right
+        away. A reload that fails is retried after another window, with the changes it was
+        for still pending.
+
+        How many changes were folded into each reload, and how the reloads went, is kept
+        in `metrics`.
+
+        With a `state_file`, the window is kept across the processes that reload the same
+        Snort (e.g. the workers of uvicorn): the start of the last reload is kept in the
+        state file, and the check and the trigger run under a `FileLock` on
+        `<state file>.lock`. The changes of a process that another process already
+        reloaded are folded into that reload, and a process whose changes came after it
+        waits for the rest of its window.
+    """
+
+    RECENT = 100
+
+    def __init__(self, trigger, window: float = 1.0, state_file=None):
+        """
+        Args:
+            trigger (Callable[[], None]): Reloads Snort, raises if it could not, e.g. a
+                `ReloadCommand`, a `ReloadSignal` or a `ReloadSocket`.
+            window (float, optional): Seconds the changes are collected for before a reload.
+                Defaults to 1.0.
+            state_file (str | Path, optional): The file the processes reloading the same
+                Snort share the time of the last reload through. Defaults to None, for a
+                window of this process only.
+        """
+        self.trigger = trigger
+        self.window = window
+        self.state_file = Path(state_file) if state_file is not None else None
+        self.lock = threading.RLock()
+        # Held while the trigger runs, so that reloads never overlap
+        if self.state_file is not None:
+            self.reloading = FileLock(self.state_file.with_name(f"{self.state_file.name}.lock"))
+        else:
+            self.reloading = threading.Lock()
+        self.pending = 0
+        # Wall clock time of the last change still pending
+        self.latest = 0.0
+        self.timer: threading.Timer | None = None
+        self.stopping = False
+        self.registered = False
+
+        self.reloads = 0
+        self.failures = 0
+        self.changes = 0
+        self.folded: deque[int] = deque(maxlen=self.RECENT)
+        self.reloaded_elsewhere = 0
+        self.last_reload: float | None = None
+        self.last_seconds: float | None = None
+        self.last_error: str | None = None
+
+    def changed(self, count: int = 1):
+        """
+        Description:
+            Record changes of the rule set, and schedule a reload if none is scheduled yet.
+
+        Args:
+            count (int, optional): The number of changes, e.g. of rules appended. Defaults to 1.
+        """
+        if count <= 0:
+            return
+        with self.lock:
+            self.pending += count
+            self.latest = time.time()
+            self.schedule()
+
+    def schedule(self, delay: float | None = None):
+        delay = self.window if delay is None else delay
+        if delay <= 0 or self.stopping:
+            threading.Thread(target=self.reload, name="fileagent-reload", daemon=True).start()
+        elif self.timer is None:
+            self.timer = threading.Timer(delay, self.reload)
+            self.timer.daemon = True
+            self.timer.start()
+            if not self.registered:
+                # Do not leave the changes of the last window unloaded on exit
+                self.registered = True
+                atexit.register(self.stop)
+
+    def load_state(self) -> float:
+        """
+        Description:
+            Read the start of the last reload of any process from the state file.
+
+        Returns:
+            float: Its wall clock time, or 0 without a state file or a reload.
+        """
+        if self.state_file is None:
+            return 0.0
+        try:
+            return float(json.loads(self.state_file.read_text()).get("last_reload", 0.0))
+        except (FileNotFoundError, ValueError, AttributeError):
+            return 0.0
+
+    def save_state(self, started: float):
+        temp_file = self.state_file.with_name(f"{self.state_file.name}.tmp")
+        temp_file.write_text(json.dumps({"last_reload": started}))
+        os.replace(temp_file, self.state_file)
+
+    def reload(self) -> bool:
+        """
+        Description:
+            Reload Snort now, if any change is pending and no other process reloaded it
+            since. The trigger runs without the lock held, so the changes that come in
+            meanwhile are recorded for the next reload. A reload of another process within
+            the window moves this one to the end of the window, unless the reloader stops.
+
+        Returns:
+            bool: True if Snort was reloaded.
+        """
+        with self.lock:
+            if not self.pending:
+                self.timer = None
+                return False
+        with self.reloading:
+            last_reload = self.load_state()
+            with self.lock:
+                self.timer = None
+                folded = self.pending
+                if not folded:
+                    return False
+                if last_reload > self.latest:
+                    # Another process reloaded after these changes were written
+                    self.pending -= folded
+                    self.reloaded_elsewhere += folded
+                    return False
+                if (wait := last_reload + self.window - time.time()) > 0 and not self.stopping:
+                    self.schedule(wait)
+                    return False
+            started = time.time()
+            start = time.perf_counter()
+            try:
+                self.trigger()
+            except Exception as exc:
+                print(f"Reloading Snort through {self.trigger} failed: {exc}")
+                with self.lock:
+                    self.failures += 1
+                    self.last_error = f"{type(exc).__name__}: {exc}"
+                    if not self.stopping and self.window > 0 and self.timer is None:
+                        self.schedule()
+                return False
+            if self.state_file is not None:
+                self.save_state(started)
+            with self.lock:
+                self.pending -= folded
+                self.reloads += 1
+                self.changes += folded
+                self.folded.append(folded)
+                self.last_seconds = time.perf_counter() - start
+                self.last_reload = time.time()
+                self.last_error = None
+            return True
+
+    def stop(self):
+        """
+        Description:
+            Reload now for the pending changes, instead of waiting for the timer.
+        """
+        with self.lock:
+            self.stopping = True
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        self.reload()
+
+    def metrics(self) -> dict:
+        """
+        Description:
+            Get the metrics of the reloads.
+
+        Returns:
+            dict: The trigger, the window, the number of reloads and of failed reloads, the
+            changes folded into the reloads, into those of other processes and those still
+            pending, the changes folded into each of the last reloads (oldest first), their
+            mean and maximum, and the time and duration of the last reload.
+        """
+        with self.lock:
+            return {
+                "trigger": str(self.trigger),
+                "window": self.window,
+                "reloads": self.reloads,
+                "failed_reloads": self.failures,
+                "changes": self.changes,
+                "reloaded_elsewhere": self.reloaded_elsewhere,
+                "pending_changes": self.pending,
+                "folded": list(self.folded),
+                "mean_folded": self.changes / self.reloads if self.reloads else None,
+                "max_folded": max(self.folded, default=None),
+                "last_reload": self.last_reload,
+                "last_reload_seconds": self.last_seconds,
+                "last_error": self.last_error,
+            }
@@ -0,0 +1,258 @@
+import sys
+from fileagent.managers.rule_index import option_key, rule_options
+
+
+class SnortRule:
+    """
+    Description:
+        Compact, typed representation of a Snort rule.
+
+        The header fields are attributes, the values that repeat across rules (action,
+        protocol, direction, ports, `any`/variables) are interned so every rule shares
+        the same string objects, and gid/sid/rev are integers. The options are kept as a
+        tuple of their text, in order, as split by the quoted-string-aware `split_options`,
+        so `msg` or `content` values with semicolons or colons are kept whole.
+
+        A rule parsed from text (`parse`) or built from the parts of the builder
+        (`from_parts`) is written back (`format`) exactly as it was, unless its
+        gid/sid/rev were changed.
+    """
+
+    __slots__ = (
+        "action",
+        "protocol",
+        "src_ip",
+        "src_port",
+        "direction",
+        "dst_ip",
+        "dst_port",
+        "options",
+        "gid",
+        "sid",
+        "rev",
+    )
+
+    NUMERIC_OPTIONS = ("gid", "sid", "rev")
+
+    def __init__(
+        self,
+        action: str,
+        protocol: str,
+        src_ip: str = None,
+        src_port: str = None,
+        direction: str = None,
+        dst_ip: str = None,
+        dst_port: str = None,
+        options: tuple[str, ...] = (),
+    ):
+        """
+        Args:
+            action (str): The action of the rule, e.g. `alert` or `block`.
+            protocol (str): The protocol, or the keyword of a service/file rule.
+            src_ip, src_port, direction, dst_ip, dst_port (str, optional): The rest of the
+                header of a traditional rule.
+            options (tuple[str, ...]): The options of the rule, without their `;`.
+        """
+        intern = sys.intern
+        self.action = intern(action)
+        self.protocol = intern(protocol)
+        if src_ip is None:
+            self.src_ip = self.src_port = self.direction = self.dst_ip = self.dst_port = None
+        else:
+            self.src_ip = self.intern_address(src_ip)
+            self.src_port = intern(src_port)
+            self.direction = intern(direction)
+            self.dst_ip = self.intern_address(dst_ip)
+            self.dst_port = intern(dst_port)
+
+        self.options = tuple(options)
+        self.gid = self.sid = self.rev = None
+        for option in self.options:
+            if option.startswith(self.NUMERIC_OPTIONS):
+                key = option_key(option)
+                if key in self.NUMERIC_OPTIONS and getattr(self, key) is None:
+                    setattr(self, key, self.numeric_value(option))
+
+    @staticmethod
+    def intern_address(value: str) -> str:
+        # Only the addresses that repeat across rules are worth interning
+        if value == "any" or value.startswith(("$", "!$")):
+            return sys.intern(value)
+        return value
+
+    @staticmethod
+    def numeric_value(option: str) -> int | None:
+        value = option.partition(":")[2].strip()
+        return int(value) if value.isdigit() else None
+
+    @classmethod
+    def from_header(cls, header: list[str], options) -> "SnortRule":
+        if len(header) == 7:
+            return cls(*header, options=options)
+        if len(header) == 2:
+            return cls(header[0], header[1], options=options)
+        raise ValueError(f"Invalid rule header: {' '.join(map(str, header))}")
+
+    @classmethod
+    def parse(cls, rule: str) -> "SnortRule":
+        """
+        Description:
+            Parse the text of a rule, single line or pretty (multi-line).
+
+        Args:
+            rule (str): The Snort rule.
+
+        Raises:
+            ValueError: If the header of the rule is neither a traditional one
+                (action, protocol, source, direction, destination) nor an action and a keyword.
+
+        Returns:
+            SnortRule: The parsed rule.
+        """
+        header, options = rule_options(rule)
+        return cls.from_header(header.split(), options)
+
+    @classmethod
+    def from_parts(cls, parts: list, opts: list[str]) -> "SnortRule":
+        """
+        Description:
+            Build a rule from the header parts and the options returned by `ManagerSnort.builder`.
+
+        Args:
+            parts (list): The header parts, e.g. `["alert", "ip", "10.0.0.1", "any", "->", "any", "any"]`.
+            opts (list[str]): The options, with their trailing `;`.
+
+        Returns:
+            SnortRule: The rule.
+        """
+        options = [option.strip().removesuffix(";").strip() for option in opts]
+        return cls.from_header([str(part) for part in parts], options)
+
+    @property
+    def header(self) -> str:
+        fields = (
+            self.action,
+            self.protocol,
+            self.src_ip,
+            self.src_port,
+            self.direction,
+            self.dst_ip,
+            self.dst_port,
+        )
+        return " ".join(field for field in fields if field is not None)
+
+    def option_texts(self) -> list[str]:
+        """
+        Description:
+            Get the text of the options, with the current gid/sid/rev.
+
+        Returns:
+            list[str]: The options, without their `;`.
+        """
+        result = []
+        seen = set()
+        for option in self.options:
+            key = option_key(option)
+            if key in self.NUMERIC_OPTIONS and key not in seen:
+                seen.add(key)
+                value = getattr(self, key)
+                if value != self.numeric_value(option):
+                    if value is not None:
+                        result.append(f"{key}: {value}")
+                    continue
+            result.append(option)
+
+        for key in self.NUMERIC_OPTIONS:
+            if key not in seen and (value := getattr(self, key)) is not None:
+                result.append(f"{key}: {value}")
+        return result
+
+    def with_sid(self, sid: int) -> "SnortRule":
+        """
+        Description:
+            Get a copy of the rule with the given sid. A rule that has no sid yet gets it
+            where the builder puts it, after its `msg`, `reference` and `gid` options.
+
+        Args:
+            sid (int): The sid.
+
+        Returns:
+            SnortRule: The rule with the sid.
+        """
+        options = list(self.options)
+        if self.sid is None and not any(option_key(option) == "sid" for option in options):
+            position = 0
+            while position < len(options) and option_key(options[position]) in (
+                "msg",
+                "reference",
+                "gid",
+            ):
+                position += 1
+            options.insert(position, f"sid: {sid}")
+        rule = SnortRule.from_header(self.header.split(), options)
+        rule.sid = sid
+        return rule
+
+    def get(self, key: str, default=None):
+        """
+        Description:
+            Get the value of the first option with the given keyword, e.g. the quoted
+            text of `msg`. An option without a value (e.g. `nocase`) has the value True.
+        """
+        for option in self.options:
+            if option_key(option) == key:
+                name, separator, value = option.partition(":")
+                return value.strip() if separator else True
+        return default
+
+    def format(self, pretty: bool = False) -> str:
+        """
+        Description:
+            Write the rule as text, in the layout of `ManagerSnort.build_formatter`.
+
+        Args:
+            pretty (bool, optional): One option per line. Defaults to False.
+
+        Returns:
+            str: The Snort rule.
+        """
+        opts = [f"{option};" for option in self.option_texts()]
+        if pretty:
+            body = "\n    ".join(opts)
+            return f"{self.header} (\n    {body}\n)"
+        return f"{self.header} ({' '.join(opts)})"
+
+    def to_dict(self) -> dict:
+        """
+        Description:
+            Get the rule in the dictionary layout of `ManagerSnort.rule_splitter`.
+        """
+        parsed_rule = {}
+        if self.src_ip is not None:
+            parsed_rule["action"] = self.action
+            parsed_rule["protocol"] = self.protocol
+            parsed_rule["src_ip"] = self.src_ip
+            parsed_rule["src_port"] = self.src_port
+            parsed_rule["direction"] = self.direction
+            parsed_rule["dst_ip"] = self.dst_ip
+            parsed_rule["dst_port"] = self.dst_port
+
+        options_dict = {}
+        for option in self.option_texts():
+            key, separator, value = option.partition(":")
+            options_dict[key.strip()] = value.strip() if separator else True
+        parsed_rule["options"] = options_dict
+        return parsed_rule
+
+    def __str__(self) -> str:
+        return self.format()
+
+    def __repr__(self) -> str:
+        return f"SnortRule({self.format()!r})"
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, SnortRule):
+            return NotImplemented
+        return self.header == other.header and self.option_texts() == other.option_texts()
+
+    __hash__ = None
@@ -0,0 +1,50 @@
+from fileagent import FileAgent
+import unittest
+from pathlib import Path
+import tempfile
+import time
+
+
+class AgentTestCase(unittest.TestCase):
+    """
+    Base of the tests that run agents on a rules file (`local.rules`) in a temporary directory.
+
+    `RULES` is what the rules file holds when a test starts (None for no rules file), and
+    `AGENT_OPTIONS` the options every agent of the test case gets, on top of those given
+    to `make_agent`. The background work of the agents is stopped when the test ends.
+    """
+
+    RULES: str | None = ""
+    AGENT_OPTIONS: dict = {}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.rules_file = Path(self.tmp.name, "local.rules")
+        if self.RULES is not None:
+            self.rules_file.write_text(self.RULES)
+
+    def make_agent(self, **opts) -> FileAgent:
+        agent = FileAgent(
+            port=8000,
+            host="127.0.0.1",
+            directory=self.tmp.name,
+            file="local.rules",
+            **{**self.AGENT_OPTIONS, **opts},
+        )
+        self.addCleanup(agent.rule_writer.stop)
+        for store in agent.rule_stores():
+            self.addCleanup(store.rule_expiry.stop)
+            self.addCleanup(store.backup_store.stop)
+        if agent.ip_aggregator is not None:
+            self.addCleanup(agent.ip_aggregator.stop)
+        if agent.snort_reloader is not None:
+            self.addCleanup(agent.snort_reloader.stop)
+        return agent
+
+    def wait_for(self, condition, timeout: float = 10.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out")
+            time.sleep(0.02)
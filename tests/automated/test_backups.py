@@ -0,0 +1,225 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.backup_store import BackupStore
+import unittest
+from pathlib import Path
+from fastapi.testclient import TestClient
+import datetime
+import gzip
+import os
+import threading
+import time
+
+
+class TestBackups(AgentTestCase):
+    RULES = 'alert ip 10.0.0.1 any -> any any (msg:"A"; sid:10001;)\n'
+
+    def setUp(self):
+        super().setUp()
+        self.backup_path = Path(self.tmp.name, "backup")
+
+    def kinds(self) -> list[str]:
+        return [kind for _, kind, _ in self.agent.backup_store.backups()]
+
+    def append(self, target: str) -> str:
+        """Append a rule, and return the moment right after it."""
+        self.agent.append_rule({"command": "block_ip", "target": target})
+        time.sleep(0.01)
+        moment = datetime.datetime.now().isoformat(sep=" ")
+        time.sleep(0.01)
+        return moment
+
+    def test_delta_backups_record_only_appends(self):
+        """Delta mode writes one snapshot and then one small journal per append."""
+        self.agent = self.make_agent(backup_mode="delta", snapshot_every=2)
+        for i in range(3):
+            self.append(f"10.0.1.{i}")
+
+        self.assertEqual(self.kinds(), ["snapshot", "journal", "journal", "snapshot", "journal"])
+        for _, kind, path in self.agent.backup_store.backups():
+            if kind == "journal":
+                self.assertEqual(path.read_text().count("block ip"), 1)
+
+    def test_external_change_starts_a_new_snapshot(self):
+        """A change made outside of the agent is captured by a new snapshot."""
+        self.agent = self.make_agent(backup_mode="delta")
+        self.append("10.0.2.1")
+        with open(self.rules_file, "a") as file:
+            file.write('alert ip 10.0.2.9 any -> any any (msg:"Manual"; sid:10009;)\n')
+        self.append("10.0.2.2")
+
+        self.assertEqual(self.kinds(), ["snapshot", "journal", "snapshot", "journal"])
+
+    def test_restore_as_of_a_timestamp(self):
+        """The rules file can be rebuilt as it was at any point in time."""
+        self.agent = self.make_agent(backup_mode="delta")
+        self.append("10.0.3.1")
+        moment = self.append("10.0.3.2")
+        expected = self.rules_file.read_text()
+        self.append("10.0.3.3")
+
+        restored = self.agent.restore_backup(moment, target=Path(self.tmp.name, "copy.rules"))
+        self.assertEqual(restored.read_text(), expected)
+
+        self.agent.restore_backup(moment)
+        self.assertEqual(self.rules_file.read_text(), expected)
+
+    def test_restore_from_full_backups(self):
+        """Full backups are restored to the state right before the last append."""
+        self.agent = self.make_agent()
+        original = self.rules_file.read_text()
+        moment = self.append("10.0.4.1")
+        self.append("10.0.4.2")
+
+        self.agent.restore_backup(moment)
+        self.assertEqual(self.rules_file.read_text(), original)
+        self.assertEqual(set(self.kinds()), {"bak"})
+
+    def test_compressed_backups(self):
+        """Compressed backups are gzip files and restore like the plain ones."""
+        self.agent = self.make_agent(backup_mode="delta", backup_compress=True)
+        self.append("10.0.5.1")
+        moment = self.append("10.0.5.2")
+        expected = self.rules_file.read_text()
+        self.append("10.0.5.3")
+
+        for _, _, path in self.agent.backup_store.backups():
+            self.assertEqual(path.suffix, ".gz")
+            with gzip.open(path, "rt") as file:
+                self.assertIn("sid:", file.read())
+        self.agent.restore_backup(moment)
+        self.assertEqual(self.rules_file.read_text(), expected)
+
+    def test_retention_keeps_the_latest(self):
+        """Old backups are deleted, without breaking the chain of the kept journals."""
+        self.agent = self.make_agent(backup_mode="delta", snapshot_every=4, backup_keep_last=2)
+        for i in range(7):
+            self.append(f"10.0.6.{i}")
+
+        # The 2 latest journals need their snapshot and the journal before them
+        self.assertEqual(self.kinds(), ["snapshot", "journal", "journal", "journal"])
+        expected = self.rules_file.read_text()
+        self.agent.restore_backup(datetime.datetime.now().isoformat(sep=" "))
+        self.assertEqual(self.rules_file.read_text(), expected)
+
+    def test_retention_hourly_and_daily(self):
+        """The latest backup of every hour and of every day within the windows is kept."""
+        store = BackupStore(self.backup_path, self.rules_file, keep_last=1, keep_hourly=2, keep_daily=2)
+        now = datetime.datetime(2026, 1, 10, 12, 30)
+        times = [
+            datetime.datetime(2026, 1, 8, 9, 0),  # outside of every window
+            datetime.datetime(2026, 1, 9, 9, 0),
+            datetime.datetime(2026, 1, 9, 18, 0),  # latest of the previous day
+            datetime.datetime(2026, 1, 10, 11, 10),
+            datetime.datetime(2026, 1, 10, 11, 50),  # latest of the previous hour
+            datetime.datetime(2026, 1, 10, 12, 0),
+            datetime.datetime(2026, 1, 10, 12, 20),  # latest, of the hour and of the day
+        ]
+        backups = [(when, "bak", Path(f"{i}.bak")) for i, when in enumerate(times)]
+        self.assertEqual(store.retained(backups, now), {2, 4, 6})
+
+    def test_backups_do_not_block_appends(self):
+        """The append returns before its backup is written."""
+        self.agent = self.make_agent()
+        store = self.agent.backup_store
+        copy = store.copy
+
+        def slow_copy(*args):
+            time.sleep(0.5)
+            copy(*args)
+
+        store.copy = slow_copy
+        start = time.perf_counter()
+        self.agent.append_rule({"command": "block_ip", "target": "10.0.7.1"})
+        self.assertLess(time.perf_counter() - start, 0.4)
+
+        self.assertEqual(self.kinds(), ["bak"])
+        self.assertEqual(
+            store.backups()[0][2].read_text(),
+            'alert ip 10.0.0.1 any -> any any (msg:"A"; sid:10001;)\n',
+        )
+
+    def block_copies(self, store: BackupStore):
+        """Hold the worker in the copy of the first backup, until the returned event is set."""
+        release = threading.Event()
+        started = threading.Event()
+        copy = store.copy
+
+        def blocked_copy(*args):
+            started.set()
+            release.wait(10)
+            copy(*args)
+
+        store.copy = blocked_copy
+        self.addCleanup(release.set)
+        return started, release
+
+    def open_rules_files(self) -> int:
+        """Count the handles this process has open on the rules file."""
+        count = 0
+        for fd in os.listdir("/proc/self/fd"):
+            try:
+                count += os.readlink(f"/proc/self/fd/{fd}") == str(self.rules_file)
+            except OSError:
+                continue
+        return count
+
+    def test_pending_copies_are_coalesced(self):
+        """While the worker is busy, later copies replace the pending one and close its
+        handle on the rules file: the latest is written."""
+        self.agent = self.make_agent()
+        store = self.agent.backup_store
+        started, release = self.block_copies(store)
+        self.append("10.0.8.0")
+        self.wait_for(started.is_set)
+        for i in range(1, 4):
+            self.append(f"10.0.8.{i}")
+        expected = self.rules_file.read_text()
+        self.append("10.0.8.4")
+
+        self.assertLessEqual(self.open_rules_files(), 2)
+        release.set()
+        self.assertEqual(self.kinds(), ["bak", "bak"])
+        self.assertEqual(store.metrics()["coalesced"], 3)
+        self.assertEqual(store.backups()[-1][2].read_text(), expected)
+        self.assertEqual(self.open_rules_files(), 0)
+
+    def test_superseded_chain_is_dropped(self):
+        """A replaced snapshot takes the journal segments on top of it along, and the
+        rules file still restores from what is left."""
+        self.agent = self.make_agent(backup_mode="delta")
+        started, release = self.block_copies(self.agent.backup_store)
+        self.append("10.0.9.1")
+        self.wait_for(started.is_set)
+        for i in range(2, 4):
+            # Every change made outside of the agent starts a new chain
+            with open(self.rules_file, "a") as file:
+                file.write(f'alert ip 10.0.9.{i}9 any -> any any (msg:"Manual"; sid:1009{i};)\n')
+            self.append(f"10.0.9.{i}")
+        release.set()
+
+        self.assertEqual(self.kinds(), ["snapshot", "journal", "snapshot", "journal"])
+        expected = self.rules_file.read_text()
+        self.agent.restore_backup(datetime.datetime.now().isoformat(sep=" "))
+        self.assertEqual(self.rules_file.read_text(), expected)
+
+    def test_failures_are_reported(self):
+        """A backup that fails is logged and counted in the metrics."""
+        self.agent = self.make_agent()
+        store = self.agent.backup_store
+
+        def failing_copy(*args):
+            raise OSError("No space left on device")
+
+        store.copy = failing_copy
+        with self.assertLogs("fileagent.managers.backup_store", "ERROR") as logs:
+            self.append("10.0.10.1")
+            store.flush()
+        self.assertIn("No space left on device", logs.output[0])
+        metrics = TestClient(self.agent.app).get("/metrics/backups").json()
+        self.assertEqual(metrics[0]["failures"], 1)
+        self.assertEqual(metrics[0]["last_error"], "No space left on device")
+        self.assertEqual(metrics[0]["source"], str(self.rules_file))
+
+
+if __name__ == "__main__":
+    unittest.main()
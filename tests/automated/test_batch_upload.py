@@ -0,0 +1,54 @@
+from agent_test_case import AgentTestCase
+import unittest
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+
+class TestBatchUpload(AgentTestCase):
+    def setUp(self):
+        """Set up an agent and a client in a temporary directory."""
+        super().setUp()
+        self.agent = self.make_agent()
+        self.client = TestClient(self.agent.app)
+        self.agent.append_rule({"command": "block_ip", "target": "10.0.0.1"})
+
+    def test_upload_batch(self):
+        """A batch is deduplicated and persisted with one backup and one history write."""
+        payloads = [
+            {"command": "block_ip", "target": "10.0.0.2"},
+            {"command": "block_ip", "target": "10.0.0.1"},
+            {"command": "alert_ip", "target": "10.0.0.3"},
+            {"command": "block_ip", "target": "10.0.0.2"},
+            {"command": "custom", "target": ""},
+        ]
+
+        with patch.object(
+            self.agent, "file_backup", wraps=self.agent.file_backup
+        ) as mock_backup, patch.object(
+            self.agent.history_store, "append", wraps=self.agent.history_store.append
+        ) as mock_save:
+            response = self.client.post("/upload/batch", json=payloads)
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["added"], 2)
+        self.assertEqual(
+            [result["status"] for result in body["results"]],
+            ["added", "duplicate", "added", "duplicate", "failed"],
+        )
+        mock_backup.assert_called_once()
+        mock_save.assert_called_once()
+
+        rules = self.agent.get_rules_from_file()
+        self.assertEqual(len(rules), 3)
+        history = self.agent.read_history()
+        self.assertEqual(len(history["history"]), 2)
+
+    def test_upload_batch_empty(self):
+        """An empty batch is rejected."""
+        response = self.client.post("/upload/batch", json=[])
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
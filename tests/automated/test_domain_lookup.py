@@ -0,0 +1,102 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.domain_index import DomainSuffixIndex
+from fileagent.managers.snort_rule import SnortRule
+import unittest
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+
+class TestDomainLookup(AgentTestCase):
+    def test_lookup_endpoint(self):
+        """The lookup returns the rules of the domain and of its parents, the most specific first."""
+        agent = self.make_agent()
+        agent.append_rule({"command": "block_domain", "target": "example.com"})
+        agent.append_rule({"command": "alert_domain", "target": "www.example.com"})
+        client = TestClient(agent.app)
+
+        matches = client.get("/rules/lookup", params={"domain": "WWW.Example.com"}).json()["matches"]
+        self.assertEqual(
+            [(m["domain"], m["action"]) for m in matches],
+            [("www.example.com", "alert"), ("example.com", "block")],
+        )
+        self.assertIn("Block domain with SNI example.com", matches[1]["rule"])
+        self.assertEqual(client.get("/rules/lookup", params={"domain": "example.org"}).json()["matches"], [])
+        self.assertEqual(client.get("/rules/lookup", params={"domain": "no_dots"}).status_code, 400)
+        self.assertEqual(
+            client.get("/rules/lookup", params={"domain": "a.com", "ip": "10.0.0.1"}).status_code, 400
+        )
+
+    def test_subdomains_are_covered(self):
+        """A block_domain under a blocked parent is a duplicate, an alert_domain is not."""
+        agent = self.make_agent()
+        agent.append_rule({"command": "block_domain", "target": "example.com"})
+        client = TestClient(agent.app)
+
+        response = client.post("/upload", json={"command": "block_domain", "target": "a.b.example.com"})
+        self.assertEqual(response.status_code, 409)
+        response = client.post("/upload", json={"command": "alert_domain", "target": "a.example.com"})
+        self.assertEqual(response.status_code, 200)
+        response = client.post("/upload", json={"command": "block_domain", "target": "notexample.com"})
+        self.assertEqual(response.status_code, 200)
+
+        # The index survives a restart
+        restarted = self.make_agent()
+        self.assertTrue(
+            restarted.prepare_rule({"command": "block_domain", "target": "x.example.com"}).duplicate
+        )
+
+    def test_consolidation(self):
+        """With consolidate_domains, the Nth sibling gets a rule for the parent instead."""
+        agent = self.make_agent(consolidate_domains=3)
+        agent.append_rule({"command": "block_domain", "target": "a.feed.example"})
+        agent.append_rule({"command": "block_domain", "target": "b.feed.example"})
+        agent.append_rule({"command": "alert_domain", "target": "c.feed.example"})
+        self.assertNotIn("SNI feed.example", self.rules_file.read_text())
+
+        context = agent.prepare_rule({"command": "block_domain", "target": "d.feed.example"})
+        self.assertIn("Block domain with SNI feed.example", context.rule)
+        self.assertEqual(context.payload["target"], "d.feed.example")
+        agent.commit_rules([context])
+        self.assertTrue(
+            agent.prepare_rule({"command": "block_domain", "target": "e.feed.example"}).duplicate
+        )
+
+        # Siblings of a top level domain are never consolidated
+        agent.append_rule({"command": "block_domain", "target": "one.example"})
+        agent.append_rule({"command": "block_domain", "target": "two.example"})
+        context = agent.prepare_rule({"command": "block_domain", "target": "three.example"})
+        self.assertIn("Block domain with SNI three.example", context.rule)
+
+    def test_index_follows_appends_and_restarts(self):
+        """Appended rules are indexed without reading them back, and a restart loads the sidecar."""
+        agent = self.make_agent()
+        agent.append_rule({"command": "block_domain", "target": "example.net"})
+        self.assertEqual(agent.domain_index.signature, agent.rule_index.file_signature())
+        agent.save_target_indexes()
+
+        with patch.object(DomainSuffixIndex, "add") as mock_add:
+            restarted = self.make_agent()
+        mock_add.assert_not_called()
+        self.assertEqual(restarted.lookup_domain("a.example.net")[0]["domain"], "example.net")
+
+        # A rules file rewritten by hand is reindexed
+        self.rules_file.write_text('alert ssl any any -> any 443 (content:"evil.test"; sid:10050;)\n')
+        self.assertEqual(restarted.lookup_domain("a.example.net"), [])
+        self.assertEqual(restarted.lookup_domain("www.evil.test")[0]["sid"], 10050)
+
+    def test_domain_of(self):
+        """Only the rules whose single content is a domain are indexed, and only plain ones cover."""
+        cases = {
+            'block ssl any any -> any 443 (msg:"x"; ssl_state:client_hello; content:"|61 2e 63 6f|"; sid:1;)': ("a.co", True),
+            'block ssl any any -> any 443 (content:"a.co",nocase; sid:2;)': ("a.co", False),
+            'block ssl 10.0.0.1 any -> any 443 (content:"a.co"; sid:3;)': ("a.co", False),
+            'block ssl any any -> any 443 (content:"a.co"; content:"b"; sid:4;)': None,
+            'alert tcp any any -> any 80 (content:"GET"; sid:5;)': None,
+            "alert ip any any -> any any (sid:6;)": None,
+        }
+        for rule, expected in cases.items():
+            self.assertEqual(DomainSuffixIndex.domain_of(SnortRule.parse(rule)), expected, rule)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.history_store import HistoryStore
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import json
+
+
+class TestHistoryStore(AgentTestCase):
+    def test_migration_from_history_json(self):
+        """Entries of an existing history.json are migrated once into the log."""
+        legacy = Path(self.tmp.name, "history.json")
+        legacy.write_text(json.dumps({"history": [{"timestamp": "t0", "content": {}}]}))
+
+        agent = self.make_agent()
+        agent.save_history({"command": "block_ip", "target": "10.0.0.1"})
+
+        self.assertFalse(legacy.exists())
+        self.assertTrue(Path(self.tmp.name, "history.json.migrated").exists())
+        history = self.make_agent().read_history()["history"]
+        self.assertEqual([entry["timestamp"] for entry in history][0], "t0")
+        self.assertEqual(history[1]["content"]["target"], "10.0.0.1")
+        self.assertEqual(len(history), 2)
+
+    def test_given_history_file_is_kept(self):
+        """A history file given to the agent is the log, whatever its name, and only the
+        default history.json is migrated."""
+        legacy = Path(self.tmp.name, "history.json")
+        legacy.write_text(json.dumps({"history": [{"timestamp": "t0", "content": {}}]}))
+        history_file = Path(self.tmp.name, "notifications.json")
+
+        agent = self.make_agent(history_file=str(history_file))
+        agent.save_history({"command": "block_ip", "target": "10.0.0.1"})
+
+        self.assertEqual(agent.history_file, history_file)
+        self.assertTrue(legacy.exists())
+        self.assertFalse(history_file.with_suffix(".jsonl").exists())
+        history = agent.read_history()["history"]
+        self.assertEqual([entry["content"] for entry in history], [{"command": "block_ip", "target": "10.0.0.1"}])
+
+    def test_given_legacy_history_file_is_migrated(self):
+        """A given history file in the old format is rewritten in place as a log, before
+        anything is appended to it, and a copy of it is kept."""
+        history_file = Path(self.tmp.name, "notifications.json")
+        legacy = json.dumps({"history": [{"timestamp": "t0", "content": {"i": 0}}]})
+        history_file.write_text(legacy)
+
+        agent = self.make_agent(history_file=str(history_file))
+        agent.save_history({"i": 1})
+
+        self.assertEqual(agent.history_file, history_file)
+        self.assertEqual(Path(self.tmp.name, "notifications.json.migrated").read_text(), legacy)
+        history = self.make_agent(history_file=str(history_file)).read_history()["history"]
+        self.assertEqual([entry["content"] for entry in history], [{"i": 0}, {"i": 1}])
+        self.assertEqual(agent.read_history_page()[0], history)
+
+    def test_entries_appended_to_a_legacy_file_are_recovered(self):
+        """Entries that were appended to a legacy file, the first one on the line of its
+        document, are kept by the migration."""
+        history_file = Path(self.tmp.name, "notifications.json")
+        history_file.write_text(
+            json.dumps({"history": [{"timestamp": "t0", "content": {"i": 0}}]})
+            + '{"timestamp":"t1","content":{"i":1}}\n{"timestamp":"t2","content":{"i":2}}\n'
+        )
+
+        agent = self.make_agent(history_file=str(history_file))
+        history = agent.read_history()["history"]
+        self.assertEqual([entry["content"]["i"] for entry in history], [0, 1, 2])
+
+    def test_append_does_not_rewrite(self):
+        """Appending only adds lines at the end of the log."""
+        store = HistoryStore(Path(self.tmp.name, "history.jsonl"))
+        store.append([{"content": 1}])
+        before = store.path.read_bytes()
+        store.append([{"content": 2}, {"content": 3}])
+        after = store.path.read_bytes()
+
+        self.assertTrue(after.startswith(before))
+        self.assertEqual(len(after.splitlines()), 3)
+
+    def test_concurrent_appends_are_not_lost(self):
+        """Concurrent writers never lose each other's entries."""
+        agent = self.make_agent()
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda i: agent.save_history({"i": i}), range(200)))
+
+        history = agent.read_history()["history"]
+        self.assertEqual(sorted(entry["content"]["i"] for entry in history), list(range(200)))
+
+
+if __name__ == "__main__":
+    unittest.main()
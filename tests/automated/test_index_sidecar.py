@@ -0,0 +1,97 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.rule_reader import RuleParser
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+import os
+
+
+class TestIndexSidecar(AgentTestCase):
+    RULES = "".join(
+        f'alert ip 10.2.0.{i} any -> any any (msg:"Known {i}"; sid:{10000 + i};)\n'
+        for i in range(50)
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.sidecar = Path(self.tmp.name, "local.rules.idx")
+
+    def parsed_lines(self, func):
+        """Count the lines of the rules file that are parsed while running func."""
+        lines = []
+        feed = RuleParser.feed_located
+
+        def recording_feed(parser, located):
+            for line in located:
+                lines.append(line)
+                yield from feed(parser, [line])
+
+        with patch.object(RuleParser, "feed_located", recording_feed):
+            result = func()
+        return len(lines), result
+
+    def test_warm_start_does_not_parse(self):
+        """A restarted agent loads the index from the sidecar instead of parsing the file."""
+        self.make_agent()
+        self.assertTrue(self.sidecar.exists())
+
+        parsed, agent = self.parsed_lines(self.make_agent)
+        self.assertEqual(parsed, 0)
+        self.assertTrue(
+            agent.rule_exists('alert ip 10.2.0.7 any -> any any (msg:"Known 7"; sid:1;)')
+        )
+        self.assertEqual(agent.get_current_sid(), 10050)
+
+    def test_appended_rules_are_parsed_after_load(self):
+        """Only the rules appended after the sidecar was saved are parsed."""
+        self.make_agent()
+        with open(self.rules_file, "a") as file:
+            file.write('alert ip 10.2.1.1 any -> any any (msg:"New"; sid:10100;)\n')
+
+        parsed, agent = self.parsed_lines(self.make_agent)
+        self.assertEqual(parsed, 1)
+        self.assertTrue(agent.rule_exists('alert ip 10.2.1.1 any -> any any (msg:"New";)'))
+        self.assertEqual(agent.get_current_sid(), 10101)
+
+    def test_rewritten_file_is_reindexed(self):
+        """A sidecar that does not match the rules file any more is rebuilt."""
+        self.make_agent()
+        self.rules_file.write_text('alert ip 10.2.2.2 any -> any any (msg:"Only"; sid:10001;)\n')
+
+        agent = self.make_agent()
+        self.assertFalse(
+            agent.rule_exists('alert ip 10.2.0.7 any -> any any (msg:"Known 7"; sid:1;)')
+        )
+        self.assertTrue(agent.rule_exists('alert ip 10.2.2.2 any -> any any (msg:"Only";)'))
+
+    def test_corrupt_sidecar_is_ignored(self):
+        """A truncated sidecar is ignored and replaced."""
+        self.make_agent()
+        with open(self.sidecar, "r+b") as file:
+            file.truncate(os.path.getsize(self.sidecar) - 5)
+
+        parsed, agent = self.parsed_lines(self.make_agent)
+        self.assertEqual(parsed, 50)
+        self.assertEqual(len(agent.rule_index), 50)
+
+    def test_offsets(self):
+        """The index knows where each rule starts in the rules file, also for appended rules."""
+        agent = self.make_agent()
+        agent.append_rule({"command": "block_ip", "target": "10.2.3.3"})
+        content = self.rules_file.read_bytes()
+
+        known = 'alert ip 10.2.0.9 any -> any any (msg:"Known 9"; sid:10009;)'
+        offset = agent.rule_index.get_offset(known)
+        self.assertEqual(content[offset : offset + len(known)].decode(), known)
+
+        appended = agent.get_rules_from_file()[-1]
+        offset = agent.rule_index.get_offset(appended)
+        self.assertTrue(content[offset:].startswith(b"block ip 10.2.3.3"))
+
+        agent.save_rule_index()
+        reloaded = self.make_agent()
+        self.assertEqual(reloaded.rule_index.get_offset(appended), offset)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,188 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.ip_aggregator import CidrSet, IpLists
+import ipaddress
+import random
+import unittest
+from pathlib import Path
+from fastapi.testclient import TestClient
+
+
+class TestIpAggregator(AgentTestCase):
+    AGENT_OPTIONS = {"aggregate_ips": True, "aggregate_interval": 0}
+
+    def setUp(self):
+        super().setUp()
+        self.lists_file = Path(self.tmp.name, "local.iplists.rules")
+
+    def test_cidr_set_is_minimal(self):
+        """Adding addresses one by one gives the same prefixes as collapsing them at once."""
+        generator = random.Random(7)
+        addresses = [
+            ipaddress.ip_address(f"10.0.{generator.randrange(4)}.{generator.randrange(256)}")
+            for _ in range(800)
+        ]
+        addresses += [ipaddress.ip_address("2001:db8::1"), ipaddress.ip_address("2001:db8::")]
+        cidrs = CidrSet(addresses)
+        expected = list(ipaddress.collapse_addresses(a for a in addresses if a.version == 4))
+        expected += list(ipaddress.collapse_addresses(a for a in addresses if a.version == 6))
+        self.assertEqual(list(cidrs), expected)
+
+        self.assertTrue(cidrs.covers("2001:db8::1"))
+        self.assertTrue(cidrs.add("10.0.0.0/16"))
+        self.assertEqual([str(network) for network in cidrs], ["10.0.0.0/16", "2001:db8::/127"])
+        self.assertFalse(cidrs.add("10.0.200.1"))
+
+    def test_cidr_set_removal(self):
+        """Removing networks splits the prefixes they were merged into, and leaves the same
+        prefixes as collapsing the addresses that are left."""
+        generator = random.Random(11)
+        addresses = {
+            ipaddress.ip_address(f"10.0.{generator.randrange(2)}.{generator.randrange(256)}")
+            for _ in range(400)
+        }
+        cidrs = CidrSet(addresses)
+        for _ in range(40):
+            length = generator.choice([32, 32, 30, 27, 24])
+            network = ipaddress.ip_network(
+                f"10.0.{generator.randrange(2)}.{generator.randrange(256)}/{length}", strict=False
+            )
+            changed = cidrs.remove(network)
+            self.assertEqual(changed, any(address in network for address in addresses))
+            addresses = {address for address in addresses if address not in network}
+            self.assertEqual(list(cidrs), list(ipaddress.collapse_addresses(addresses)))
+
+        cidrs = CidrSet(["10.1.0.0/30"])
+        self.assertTrue(cidrs.remove("10.1.0.1"))
+        self.assertEqual([str(network) for network in cidrs], ["10.1.0.0/32", "10.1.0.2/31"])
+        self.assertFalse(cidrs.remove("10.1.0.1"))
+
+    def test_addresses_go_into_ip_lists(self):
+        """block_ip and alert_ip go into the IP lists, the other commands into the rules file."""
+        agent = self.make_agent()
+        for host in range(256):
+            agent.append_rule({"command": "block_ip", "target": f"10.5.0.{host}"})
+        agent.append_rule({"command": "block_ip", "target": "10.5.1.7"})
+        agent.append_rule({"command": "alert_ip", "target": "10.6.0.1"})
+        agent.append_rule({"command": "block_domain", "target": "example.com"})
+
+        self.assertEqual(self.rules_file.read_text().count("(\n"), 1)
+        lines = self.lists_file.read_text().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("alert ip [10.6.0.1] any -> any any ("))
+        self.assertTrue(lines[1].startswith("block ip [10.5.0.0/24,10.5.1.7] any -> any any ("))
+        self.assertIn("rev: 257;", lines[1])
+
+    def test_covered_addresses_are_duplicates(self):
+        """An address inside a listed prefix is a duplicate, and gets no sid."""
+        agent = self.make_agent()
+        first = agent.prepare_rule({"command": "block_ip", "target": "10.7.0.0/24"})
+        agent.commit_rules([first])
+        sid = agent.sid_allocator.next_sid
+
+        context = agent.prepare_rule({"command": "block_ip", "target": "10.7.0.9"})
+        self.assertTrue(context.duplicate)
+        self.assertFalse(agent.prepare_rule({"command": "alert_ip", "target": "10.7.0.9"}).duplicate)
+
+        # Within the same group commit, the network covers the address
+        contexts = agent.prepare_rules(
+            [
+                {"command": "block_ip", "target": "10.8.0.0/16"},
+                {"command": "block_ip", "target": "10.8.3.3"},
+            ]
+        )
+        agent.commit_rules(contexts)
+        self.assertEqual([c.duplicate for c in contexts], [False, True])
+        self.assertEqual(agent.sid_allocator.next_sid, sid)
+
+    def test_lists_are_split_and_reloaded(self):
+        """Long lists are split across rules, which keep their sids after a restart."""
+        agent = self.make_agent(ip_list_size=10)
+        for host in range(0, 60, 2):
+            agent.append_rule({"command": "block_ip", "target": f"10.9.0.{host}"})
+        lines = self.lists_file.read_text().splitlines()
+        self.assertEqual(len(lines), 3)
+        sids = [agent.parse_rule(line).sid for line in lines]
+
+        restarted = self.make_agent(ip_list_size=10)
+        context = restarted.prepare_rule({"command": "block_ip", "target": "10.9.0.58"})
+        self.assertTrue(context.duplicate)
+        restarted.append_rule({"command": "block_ip", "target": "10.9.0.61"})
+        lines = self.lists_file.read_text().splitlines()
+        self.assertEqual([restarted.parse_rule(line).sid for line in lines][:3], sids)
+        self.assertGreater(restarted.get_current_sid(), max(sids))
+
+    def test_delete_and_upload_response(self):
+        """An aggregated address is reported as the list entry it went into, and deleting
+        it by target removes it from the lists, also when it was merged into a prefix."""
+        agent = self.make_agent()
+        client = TestClient(agent.app)
+        response = client.post("/upload", json={"command": "block_ip", "target": "10.12.0.0"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()["rule"])
+        self.assertEqual(
+            response.json()["ip_list"], {"source": "ip_lists", "action": "block", "prefix": "10.12.0.0"}
+        )
+        response = client.post("/upload", json={"command": "block_ip", "target": "10.12.0.1"})
+        self.assertEqual(response.json()["ip_list"]["prefix"], "10.12.0.0/31")
+        client.post("/upload", json={"command": "alert_ip", "target": "10.12.0.1"})
+
+        response = client.delete("/rules", params={"target": "10.12.0.1"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["deleted"], 2)
+        self.assertEqual(
+            response.json()["ip_lists"],
+            [
+                {"source": "ip_lists", "action": "alert", "prefix": "10.12.0.1"},
+                {"source": "ip_lists", "action": "block", "prefix": "10.12.0.1"},
+            ],
+        )
+        self.assertEqual(self.lists_file.read_text().count("\n"), 1)
+        self.assertIn("block ip [10.12.0.0] any", self.lists_file.read_text())
+        history = [entry["content"] for entry in agent.history_store.read()["history"]]
+        self.assertEqual(history[-1], {"event": "deleted", "source": "ip_lists", "action": "block", "prefix": "10.12.0.1"})
+
+        # Removed for good: a restart does not bring it back, and it can be uploaded again
+        restarted = self.make_agent()
+        self.assertFalse(restarted.ip_aggregator.covers("block", "10.12.0.1"))
+        self.assertFalse(restarted.prepare_rule({"command": "block_ip", "target": "10.12.0.1"}).duplicate)
+
+    def test_removal_survives_a_reload(self):
+        """A removal that is not written yet is applied again when another process
+        rewrote the lists meanwhile."""
+        agent = self.make_agent(aggregate_interval=60)
+        other = self.make_agent()
+        agent.append_rule({"command": "block_ip", "target": "10.13.0.0/30"})
+        agent.ip_aggregator.flush()
+        agent.ip_aggregator.remove(ipaddress.ip_network("10.13.0.2/32"))
+        other.append_rule({"command": "block_ip", "target": "10.13.1.1"})
+        agent.ip_aggregator.flush()
+        self.assertEqual(
+            agent.ip_aggregator.prefixes("block"), ["10.13.0.0/31", "10.13.0.3", "10.13.1.1"]
+        )
+        self.assertIn("[10.13.0.0/31,10.13.0.3,10.13.1.1]", self.lists_file.read_text())
+
+    def test_ip_lists_are_abstract(self):
+        """A subclass of IpLists that does not render its files cannot be instantiated."""
+
+        class Unrendered(IpLists):
+            def load(self):
+                pass
+
+            def paths(self):
+                return []
+
+        with self.assertRaises(TypeError):
+            Unrendered(0, Path(self.tmp.name, "lists.lock"))
+
+    def test_debounced_rewrite(self):
+        """With an interval, a burst of addresses is written once, when the agent stops."""
+        agent = self.make_agent(aggregate_interval=60)
+        for host in range(5):
+            agent.append_rule({"command": "block_ip", "target": f"10.10.0.{host}"})
+        self.assertFalse(self.lists_file.exists())
+        agent.ip_aggregator.stop()
+        self.assertIn("[10.10.0.0/30,10.10.0.4]", self.lists_file.read_text())
+
+
+if __name__ == "__main__":
+    unittest.main()
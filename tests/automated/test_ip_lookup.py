@@ -0,0 +1,105 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.ip_prefix_index import IpPrefixIndex
+from fileagent.managers.snort_rule import SnortRule
+import unittest
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+
+class TestIpLookup(AgentTestCase):
+    RULES = (
+        'block ip 10.1.0.0/16 any -> any any (msg:"Block network"; sid:10001;)\n'
+        'alert tcp any any -> [10.1.39.0/24,!10.1.39.1] 80 (msg:"Web"; content:"x"; sid:10002;)\n'
+        "alert ip $HOME_NET any -> any any (sid:10003;)\n"
+        "block ip 2001:db8::/32 any -> any any (\n"
+        '    msg:"Block v6";\n'
+        "    sid:10004;\n"
+        ")\n"
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.agent = self.make_agent()
+        self.client = TestClient(self.agent.app)
+
+    def test_lookup_endpoint(self):
+        """The lookup returns the rules whose header prefixes contain the address."""
+        response = self.client.get("/rules/lookup", params={"ip": "10.1.39.20"})
+        self.assertEqual(response.status_code, 200)
+        matches = response.json()["matches"]
+        self.assertEqual([m["sid"] for m in matches], [10002, 10001])
+        self.assertEqual(matches[0]["prefix"], "10.1.39.0/24")
+        self.assertEqual(matches[0]["field"], "dst_ip")
+        self.assertEqual(
+            matches[1]["rule"],
+            'block ip 10.1.0.0/16 any -> any any (msg:"Block network"; sid:10001;)',
+        )
+
+        matches = self.client.get("/rules/lookup", params={"ip": "2001:db8::7"}).json()["matches"]
+        self.assertEqual(matches[0]["sid"], 10004)
+        self.assertTrue(matches[0]["rule"].startswith("block ip 2001:db8::/32 any -> any any ("))
+
+        # The address is negated in the list of the second rule
+        matches = self.client.get("/rules/lookup", params={"ip": "10.1.39.1"}).json()["matches"]
+        self.assertEqual([m["sid"] for m in matches], [10001])
+        self.assertEqual(self.client.get("/rules/lookup", params={"ip": "10.2.0.1"}).json()["matches"], [])
+        self.assertEqual(self.client.get("/rules/lookup", params={"ip": "nope"}).status_code, 400)
+        self.assertEqual(self.client.get("/rules/lookup").status_code, 400)
+
+    def test_redundant_rules_are_rejected(self):
+        """A block_ip/block_icmp inside a plain block ip rule is a duplicate, an alert_ip is not."""
+        for command in ("block_ip", "block_icmp"):
+            payload = {"command": command, "target": "10.1.39.20"}
+            response = self.client.post("/upload", json=payload)
+            self.assertEqual(response.status_code, 409)
+
+        response = self.client.post("/upload", json={"command": "alert_ip", "target": "10.1.39.20"})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post("/upload", json={"command": "block_ip", "target": "10.2.0.1"})
+        self.assertEqual(response.status_code, 200)
+
+        # Rules appended since are indexed too, and a covering rule is reported in a batch
+        response = self.client.post(
+            "/upload/batch",
+            json=[
+                {"command": "alert_ip", "target": "10.1.39.20"},
+                {"command": "block_ip", "target": "2001:db8::1"},
+            ],
+        )
+        results = response.json()["results"]
+        self.assertEqual([r["status"] for r in results], ["duplicate", "duplicate"])
+        self.assertIn("2001:db8::/32", results[1]["rule"])
+
+    def test_rewritten_file_is_reindexed(self):
+        """The prefix index follows a rules file that was rewritten."""
+        self.assertEqual(len(self.agent.lookup_ip("10.1.0.1")), 1)
+        self.rules_file.write_text('block ip 10.9.0.0/16 any -> any any (msg:"Other"; sid:10009;)\n')
+        self.assertEqual(self.agent.lookup_ip("10.1.0.1"), [])
+        self.assertEqual(self.agent.lookup_ip("10.9.1.1")[0]["sid"], 10009)
+
+    def test_index_follows_appends_and_restarts(self):
+        """Appended rules are indexed without reading them back, and a restart loads the sidecar."""
+        self.agent.append_rule({"command": "block_ip", "target": "10.3.0.0/24"})
+        self.assertEqual(self.agent.ip_index.signature, self.agent.rule_index.file_signature())
+        self.assertEqual(self.agent.lookup_ip("10.3.0.5")[0]["prefix"], "10.3.0.0/24")
+        self.agent.save_target_indexes()
+
+        with patch.object(IpPrefixIndex, "add") as mock_add:
+            restarted = self.make_agent()
+        mock_add.assert_not_called()
+        self.assertTrue(restarted.covering_rule({"command": "block_ip", "target": "10.3.0.5"}))
+        self.assertEqual([m["sid"] for m in restarted.lookup_ip("10.1.39.20")], [10002, 10001])
+
+    def test_plain_rules(self):
+        """Only rules that match all the traffic of their prefix cover other rules."""
+        index = IpPrefixIndex()
+        index.add(0, SnortRule.parse('block ip 10.0.0.0/8 any -> any 80 (sid:1;)'))
+        index.add(1, SnortRule.parse('block ip 10.0.0.0/8 any -> any any (content:"x"; sid:2;)'))
+        index.add(2, SnortRule.parse('drop ip 10.0.0.0/8 any -> any any (sid:3;)'))
+        self.assertIsNone(index.covering("10.1.1.1", "block", "ip"))
+        self.assertEqual(index.covering("10.1.1.1", "drop", "icmp").sid, 3)
+        self.assertEqual(len(index.lookup("10.1.1.1")), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
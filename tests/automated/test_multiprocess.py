@@ -0,0 +1,200 @@
+from fileagent import FileAgent
+from agent_test_case import AgentTestCase
+from fileagent.managers.sid_allocator import SidAllocator
+import fileagent.__main__
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from fastapi.testclient import TestClient
+import httpx
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+WORKERS = 4
+ROUNDS = 20
+
+
+def upload_worker(directory: str, worker: int, options: dict) -> dict:
+    """
+    One process of the stress test: an agent of its own on the shared rules file, that
+    uploads the addresses every worker uploads, domains of its own (some of them deleted
+    again right away, some temporary) and addresses that go to the IP lists.
+    """
+    agent = FileAgent(
+        port=8000, host="127.0.0.1", directory=directory, file="local.rules", **options
+    )
+    accepted = {"shared": [], "domains": [], "deleted": 0}
+    with TestClient(agent.app) as client:
+        for i in range(ROUNDS):
+            response = client.post("/upload", json={"command": "block_icmp", "target": f"10.20.0.{i}"})
+            if response.status_code == 200:
+                accepted["shared"].append(i)
+
+            domain = f"w{worker}-{i}.stress.example"
+            payload = {"command": "block_domain", "target": domain}
+            if i % 4 == 0:
+                payload["ttl_seconds"] = 3600
+            response = client.post("/upload", json=payload)
+            assert response.status_code == 200, response.text
+            accepted["domains"].append(domain)
+
+            if i % 5 == 4:
+                deleted = client.delete("/rules", params={"target": domain}).json()["deleted"]
+                accepted["deleted"] += deleted
+                accepted["domains"].remove(domain)
+
+            response = client.post("/upload", json={"command": "alert_ip", "target": f"10.30.{worker}.{i}"})
+            assert response.status_code == 200, response.text
+    return accepted
+
+
+def reserve_worker(state_file: str, count: int) -> list[int]:
+    allocator = SidAllocator(state_file, start=10000, end=20000)
+    return [allocator.reserve() for _ in range(count)]
+
+
+class TestMultiprocess(AgentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.context = multiprocessing.get_context("spawn")
+
+    def test_workers_share_the_rules_file(self):
+        """Agents in several processes hammer the same rules file: no rule is lost or
+        written twice, sids are unique, and the history, the indexes, the expiry log and
+        the IP lists hold what every process did."""
+        options = {"aggregate_ips": True, "aggregate_interval": 0, "commit_window": 0}
+        with self.context.Pool(WORKERS) as pool:
+            results = pool.starmap(
+                upload_worker, [(self.tmp.name, worker, options) for worker in range(WORKERS)]
+            )
+
+        agent = self.make_agent(**options)
+        rules = agent.get_rules_from_file()
+
+        # Every shared address was accepted by a single process, and written once
+        accepted = sorted(i for result in results for i in result["shared"])
+        self.assertEqual(accepted, list(range(ROUNDS)))
+        for i in range(ROUNDS):
+            self.assertEqual(sum(f'From IP 10.20.0.{i}"' in rule for rule in rules), 1)
+
+        # The domains of every process are there once, the deleted ones are gone
+        domains = [domain for result in results for domain in result["domains"]]
+        self.assertEqual(len(domains), WORKERS * (ROUNDS - ROUNDS // 5))
+        for domain in domains:
+            self.assertEqual(sum(f'SNI {domain}"' in rule for rule in rules), 1, domain)
+        self.assertEqual(len(rules), ROUNDS + len(domains))
+
+        sids = [agent.parse_rule(rule).sid for rule in rules]
+        sids += agent.ip_aggregator.sids()
+        self.assertEqual(len(set(sids)), len(sids))
+        self.assertGreater(agent.sid_allocator.next_sid, max(sids))
+
+        # The indexes saved by the last process agree with the rules file
+        index = agent.get_rule_index()
+        self.assertEqual(len(index), len(rules))
+        self.assertTrue(all(index.contains(rule) for rule in rules))
+        self.assertEqual(len(agent.lookup_domain("w0-0.stress.example")), 1)
+
+        history = [entry["content"] for entry in agent.history_store.read()["history"]]
+        self.assertEqual(
+            len([entry for entry in history if entry.get("command") in ("block_icmp", "block_domain")]),
+            len(accepted) + WORKERS * ROUNDS,
+        )
+        self.assertEqual(
+            len([entry for entry in history if entry.get("event") == "deleted"]),
+            sum(result["deleted"] for result in results),
+        )
+
+        # The temporary rules of every process that were not deleted, and the addresses
+        # of every process
+        temporary = [i for i in range(0, ROUNDS, 4) if i % 5 != 4]
+        self.assertEqual(len(agent.rule_expiry), WORKERS * len(temporary))
+        for worker in range(WORKERS):
+            for i in range(ROUNDS):
+                self.assertTrue(agent.ip_aggregator.covers("alert", f"10.30.{worker}.{i}"))
+
+    def test_sid_allocator(self):
+        """Processes reserving from the same state file never get the same sid."""
+        state_file = str(Path(self.tmp.name, "local.rules.sid"))
+        with self.context.Pool(WORKERS) as pool:
+            reserved = pool.starmap(reserve_worker, [(state_file, 250)] * WORKERS)
+        sids = sorted(sid for sids in reserved for sid in sids)
+        self.assertEqual(sids, list(range(10000, 10000 + 250 * WORKERS)))
+        self.assertEqual(SidAllocator(state_file).next_sid, 10000 + 250 * WORKERS)
+
+    def test_uvicorn_workers(self):
+        """The API served by several uvicorn workers writes every rule once."""
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        process = subprocess.Popen(
+            [
+                sys.executable, "-m", "fileagent",
+                "--workers", "3",
+                "--host", "127.0.0.1",
+                "--port", str(port),
+                "--directory", self.tmp.name,
+                "--file", "local.rules",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+
+        url = f"http://127.0.0.1:{port}"
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                httpx.get(f"{url}/openapi.json", timeout=1)
+                break
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    self.fail("The workers did not start")
+                time.sleep(0.2)
+
+        def upload(i):
+            payload = {"command": "block_ip", "target": f"10.40.0.{i % 30}"}
+            return httpx.post(f"{url}/upload", json=payload, timeout=30).status_code
+
+        with ThreadPoolExecutor(8) as executor:
+            statuses = list(executor.map(upload, range(90)))
+        self.assertEqual(statuses.count(200), 30)
+        self.assertEqual(statuses.count(409), 60)
+
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=60)
+        agent = self.make_agent()
+        rules = agent.get_rules_from_file()
+        self.assertEqual(len(rules), 30)
+        sids = [agent.parse_rule(rule).sid for rule in rules]
+        self.assertEqual(len(set(sids)), 30)
+
+    def test_workers_start_without_an_agent(self):
+        """With several workers, the parent process only starts them: every agent is
+        built by a worker, from the command line arguments."""
+        argv = ["fileagent", "--workers", "2", "--directory", self.tmp.name, "--file", "local.rules", "--sid-start", "500"]
+        with patch("sys.argv", argv), patch.dict(os.environ), patch(
+            "fileagent.__main__.FileAgent"
+        ) as agent, patch("uvicorn.run") as run:
+            fileagent.__main__.main()
+            options = json.loads(os.environ[FileAgent.OPTIONS_ENV])
+
+        agent.assert_not_called()
+        run.assert_called_once_with(
+            "fileagent.main:create_app", factory=True, host="0.0.0.0", port=8000, workers=2
+        )
+        self.assertEqual(options["directory"], self.tmp.name)
+        self.assertEqual(options["file"], "local.rules")
+        self.assertEqual(options["sid_start"], 500)
+
+
+if __name__ == "__main__":
+    unittest.main()
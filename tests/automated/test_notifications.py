@@ -0,0 +1,76 @@
+from agent_test_case import AgentTestCase
+import unittest
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+import datetime
+import json
+
+
+class TestNotifications(AgentTestCase):
+    def setUp(self):
+        """Set up an agent with a history of 250 entries, one per minute."""
+        super().setUp()
+        self.agent = self.make_agent()
+        self.agent.history_store.append(
+            [
+                {"timestamp": f"2026-01-01 {i // 60:02d}:{i % 60:02d}:00", "content": {"i": i}}
+                for i in range(250)
+            ]
+        )
+        self.client = TestClient(self.agent.app)
+
+    def get(self, **params):
+        response = self.client.get("/notifications", params=params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_pages_follow_the_cursor(self):
+        """Following next_cursor walks the whole history once, in order."""
+        seen = []
+        cursor = None
+        for _ in range(4):
+            body = self.get(limit=100, **({"cursor": cursor} if cursor else {}))
+            seen.extend(entry["content"]["i"] for entry in body["notifications"])
+            cursor = body["next_cursor"]
+
+        self.assertEqual(seen, list(range(250)))
+        self.assertEqual(body["latest"]["content"]["i"], 249)
+
+        # Polling with the last cursor only returns what was added since
+        self.agent.save_history({"i": 250})
+        body = self.get(cursor=cursor)
+        self.assertEqual([entry["content"]["i"] for entry in body["notifications"]], [250])
+
+    def test_since_seeks_to_the_window(self):
+        """`since` returns the records from that time on, without decoding everything before."""
+        with patch(
+            "fileagent.managers.history_store.json.loads", wraps=json.loads
+        ) as mock_loads:
+            body = self.get(since="2026-01-01 03:20:00", limit=5)
+
+        self.assertEqual(
+            [entry["content"]["i"] for entry in body["notifications"]],
+            [200, 201, 202, 203, 204],
+        )
+        self.assertLess(mock_loads.call_count, 50)
+
+    def test_since_in_epoch_seconds(self):
+        """`since` is also given in Unix epoch seconds, and compared in local time."""
+        since = datetime.datetime(2026, 1, 1, 4, 5).timestamp()
+        body = self.get(since=str(since))
+        self.assertEqual([entry["content"]["i"] for entry in body["notifications"]], [245, 246, 247, 248, 249])
+
+    def test_invalid_since_is_rejected(self):
+        """A `since` that is not a time, or out of the range of a date, is a bad request."""
+        for since in ["garbage", "inf", "nan", "1e20", "1e12", "2026-13-01 00:00:00", "2026-01-01"]:
+            response = self.client.get("/notifications", params={"since": since})
+            self.assertEqual(response.status_code, 400, since)
+            self.assertIn("Invalid time", response.json()["detail"])
+
+    def test_limit_is_validated(self):
+        response = self.client.get("/notifications", params={"limit": 0})
+        self.assertEqual(response.status_code, 422)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.parallel_loader import ParallelRuleLoader
+from fileagent.managers.rule_index import RuleIndex
+from fileagent.managers.rule_reader import RuleReader
+import unittest
+from pathlib import Path
+
+
+class TestParallelLoader(AgentTestCase):
+    def setUp(self):
+        super().setUp()
+        rules = []
+        for i in range(120):
+            if i % 3 == 0:
+                # Pretty rules span several lines, each starting like a rule would
+                rules.append(
+                    f"alert ip 10.3.0.{i} any -> any any (\n"
+                    f'    msg:"Pretty {i}";\n'
+                    f"    sid:{10000 + i};\n"
+                    ")\n"
+                )
+            elif i % 10 == 1:
+                rules.append(f"# comment {i}\n\n")
+            else:
+                rules.append(
+                    f'block ip 10.3.1.{i} any -> any any (msg:"Line {i}"; sid:{10000 + i};)\n'
+                )
+        self.rules_file.write_text("".join(rules))
+
+    def serial_index(self) -> RuleIndex:
+        index = RuleIndex(self.rules_file)
+        reader = RuleReader(self.rules_file, keep_rules=False)
+        signature = index.file_signature()
+        index.extend(reader.scan(located=True), signature)
+        index.extend(reader.tail(located=True), signature)
+        return index
+
+    def parallel_index(self, workers: int = 2) -> tuple[RuleIndex, RuleReader]:
+        index = RuleIndex(self.rules_file)
+        reader = RuleReader(self.rules_file, keep_rules=False)
+        ParallelRuleLoader(self.rules_file, workers).load(index, reader)
+        return index, reader
+
+    def test_split_points_are_rule_boundaries(self):
+        """The file is only cut at the start of a rule, never inside a pretty rule."""
+        loader = ParallelRuleLoader(self.rules_file, 4)
+        content = self.rules_file.read_bytes()
+        points = loader.split_points(len(content), 16)
+        self.assertGreater(len(points), 4)
+        self.assertEqual(points, sorted(set(points)))
+        for point in points[1:]:
+            self.assertEqual(content[point - 1 : point], b"\n")
+            previous = content[:point].rstrip().rsplit(b"\n", 1)[-1]
+            self.assertTrue(previous.endswith(b")") or previous.startswith(b"#"))
+            self.assertFalse(content[point:].startswith(b"    "))
+
+    def test_same_index_as_serial(self):
+        """The parallel load finds the same rules, sids and offsets as a serial scan."""
+        serial = self.serial_index()
+        index, _ = self.parallel_index()
+        self.assertEqual(len(index), 112)
+        self.assertEqual(index.fingerprints, serial.fingerprints)
+        self.assertEqual(index.offsets, serial.offsets)
+        self.assertFalse(index.is_stale())
+
+    def test_reader_continues_after_load(self):
+        """The reader continues from the end of the file, also with a partial last rule."""
+        with open(self.rules_file, "a") as file:
+            file.write("alert ip 10.3.2.1 any -> any any (\n    sid:")
+        index, reader = self.parallel_index()
+        self.assertEqual(len(index), 112)
+
+        with open(self.rules_file, "a") as file:
+            file.write("10500;\n)\n")
+        rules, reset = reader.update()
+        self.assertFalse(reset)
+        self.assertEqual(len(rules), 1)
+        self.assertEqual(RuleIndex.rule_sid(rules[0]), 10500)
+
+    def test_agent_uses_parallel_loader(self):
+        """An agent indexes a large rules file with the loader when it has no sidecar."""
+        agent = self.make_agent(parse_workers=2, parallel_parse_bytes=1)
+        self.assertEqual(len(agent.rule_index), 112)
+        self.assertEqual(agent.get_current_sid(), 10120)
+        self.assertTrue(Path(self.tmp.name, "local.rules.idx").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+from agent_test_case import AgentTestCase
+import unittest
+from pathlib import Path
+
+
+class TestReputationLists(AgentTestCase):
+    AGENT_OPTIONS = {"reputation_lists": True, "aggregate_interval": 0}
+
+    def setUp(self):
+        super().setUp()
+        self.lists_dir = Path(self.tmp.name, "reputation")
+
+    def read_list(self, name: str) -> list[str]:
+        return Path(self.lists_dir, name).read_text().splitlines()
+
+    def test_addresses_go_into_lists(self):
+        """block_ip goes into the blocklist, alert_ip into the monitorlist, not into the rules file."""
+        agent = self.make_agent()
+        agent.append_rule({"command": "block_ip", "target": "10.20.0.1"})
+        agent.append_rule({"command": "block_ip", "target": "10.20.0.0"})
+        agent.append_rule({"command": "block_ip", "target": "2001:db8::5"})
+        agent.append_rule({"command": "alert_ip", "target": "10.21.0.0/16"})
+        agent.append_rule({"command": "block_icmp", "target": "10.22.0.1"})
+
+        self.assertEqual(self.read_list("ip.blocklist"), ["10.20.0.0/31", "2001:db8::5"])
+        self.assertEqual(self.read_list("ip.monitorlist"), ["10.21.0.0/16"])
+        self.assertEqual(
+            self.read_list("interface.info"), ["ip.blocklist 1 block", "ip.monitorlist 2 monitor"]
+        )
+        self.assertNotIn("10.20.0.1", self.rules_file.read_text())
+        self.assertIn("block icmp 10.22.0.1", self.rules_file.read_text())
+        self.assertEqual(list(self.lists_dir.glob("*.tmp")), [])
+
+    def test_deduplicated_and_reloaded(self):
+        """Addresses already listed are duplicates, also after a restart."""
+        agent = self.make_agent()
+        contexts = agent.prepare_rules(
+            [
+                {"command": "block_ip", "target": "10.23.0.0/24"},
+                {"command": "block_ip", "target": "10.23.0.0/24"},
+            ]
+        )
+        agent.commit_rules(contexts)
+        self.assertEqual([c.duplicate for c in contexts], [False, True])
+
+        # An address added by hand, with a comment
+        with open(Path(self.lists_dir, "ip.blocklist"), "a") as file:
+            file.write("192.0.2.1 # added by hand\n")
+
+        restarted = self.make_agent()
+        self.assertTrue(
+            restarted.prepare_rule({"command": "block_ip", "target": "10.23.0.77"}).duplicate
+        )
+        self.assertTrue(
+            restarted.prepare_rule({"command": "block_ip", "target": "192.0.2.1"}).duplicate
+        )
+        restarted.append_rule({"command": "block_ip", "target": "10.23.1.0/24"})
+        self.assertEqual(self.read_list("ip.blocklist"), ["10.23.0.0/23", "192.0.2.1"])
+
+    def test_deleted_from_lists(self):
+        """Deleting an address by target removes it from the lists, splitting its prefix."""
+        agent = self.make_agent()
+        agent.append_rule({"command": "block_ip", "target": "10.24.0.0/30"})
+        entries = agent.delete_rules(targets=["10.24.0.1"])[1]
+        self.assertEqual(entries, [{"source": "reputation", "action": "block", "prefix": "10.24.0.1"}])
+        self.assertEqual(self.read_list("ip.blocklist"), ["10.24.0.0", "10.24.0.2/31"])
+        self.assertEqual(agent.delete_rules(targets=["10.24.0.1"]), ([], []))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.rule_reader import RuleReader
+import unittest
+from pathlib import Path
+from fastapi.testclient import TestClient
+
+
+class TestRuleCompaction(AgentTestCase):
+    RULES = None
+
+    def test_compact_output_mode(self):
+        """With compact_rules the generated rules are written on a single line."""
+        self.rules_file.write_text("")
+        agent = self.make_agent(compact_rules=True)
+        client = TestClient(agent.app)
+        response = client.post("/upload", json={"command": "block_ip", "target": "10.1.0.1"})
+        self.assertEqual(response.status_code, 200)
+        rule = response.json()["rule"]
+        self.assertNotIn("\n", rule)
+        self.assertEqual(self.rules_file.read_text(), f"\n{rule}\n")
+        self.assertIn("\n", self.make_agent().building_rule_block("10.1.0.2"))
+
+    def test_compaction(self):
+        """The rules file is rewritten one rule per line, deduplicated and ordered by sid,
+        and the indexes follow it."""
+        self.rules_file.write_text(
+            "# Local rules\n"
+            "\n"
+            "block ip 10.2.0.3 any -> any any (\n"
+            '    msg:"Three";\n'
+            "    sid: 10003;\n"
+            ")\n"
+            "\n"
+            'block ip 10.2.0.1 any -> any any (msg:"One"; sid:10001;)\n'
+            'block ip 10.2.0.1 any -> any any (msg:"One"; sid:10001;)\n'
+            'alert tcp any any -> any 80 (msg:"No sid";)\n'
+            "block ip 10.2.0.1 any -> any any (sid:10009; rev:2; msg:\"One\";)\n"
+            "# Kept\n"
+            'block ip 10.2.0.2 any -> any any (msg:"Two"; sid:10002;)\n'
+        )
+        agent = self.make_agent()
+        client = TestClient(agent.app)
+        response = client.post("/rules/compact")
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()
+        self.assertEqual(stats["rules_before"], 6)
+        self.assertEqual(stats["rules_after"], 4)
+        self.assertEqual(stats["exact_duplicates"], 1)
+        self.assertEqual(stats["semantic_duplicates"], 1)
+        self.assertEqual(stats["lines_before"], 13)
+        self.assertEqual(stats["lines_after"], 6)
+        self.assertLess(stats["bytes_after"], stats["bytes_before"])
+        self.assertGreater(stats["parse_seconds_before"], 0)
+
+        self.assertEqual(
+            self.rules_file.read_text(),
+            "# Local rules\n"
+            "# Kept\n"
+            'block ip 10.2.0.1 any -> any any (msg:"One"; sid:10001;)\n'
+            'block ip 10.2.0.2 any -> any any (msg:"Two"; sid:10002;)\n'
+            'block ip 10.2.0.3 any -> any any (msg:"Three"; sid: 10003;)\n'
+            'alert tcp any any -> any 80 (msg:"No sid";)\n',
+        )
+        self.assertTrue(any(Path(self.tmp.name, "backup").iterdir()))
+        self.assertEqual(agent.history_store.last()["content"]["event"], "compacted")
+
+        # The indexes point into the new file, their readers do not read it again
+        self.assertEqual(agent.index_reader.offset, self.rules_file.stat().st_size)
+        for offset, rule in RuleReader(self.rules_file, keep_rules=False).scan(located=True):
+            self.assertEqual(agent.rule_index.get_offset(rule), offset)
+        self.assertEqual(agent.lookup_ip("10.2.0.3")[0]["sid"], 10003)
+        self.assertEqual(client.delete("/rules/10002").status_code, 200)
+        self.assertNotIn("10.2.0.2", self.rules_file.read_text())
+
+        # Compacting a compact file changes nothing
+        before = self.rules_file.read_text()
+        stats = agent.compact_rules_file()
+        self.assertEqual(stats["rules_before"], stats["rules_after"])
+        self.assertEqual(self.rules_file.read_text(), before)
+
+        # The sidecars were saved with the new file
+        restarted = self.make_agent()
+        self.assertEqual(restarted.lookup_ip("10.2.0.1")[0]["sid"], 10001)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.ip_prefix_index import IpPrefixIndex
+from fileagent.managers.rule_index import RuleIndex
+from fileagent.managers.rule_reader import RuleReader
+from fileagent.managers.rule_rewriter import OffsetLog, OffsetShift, RuleRewriter
+import unittest
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+
+class TestRuleEdit(AgentTestCase):
+    RULES = (
+        "# Rules kept by hand\n"
+        'alert tcp any any -> any 80 (msg:"Kept"; sid:10001;)\n'
+        "alert ip [10.1.0.1,10.1.0.2] any -> any any (\n"
+        '    msg:"List";\n'
+        "    sid:10002;\n"
+        ")\n"
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.agent = self.make_agent()
+        self.client = TestClient(self.agent.app)
+
+    def upload(self, command: str, target: str) -> str:
+        response = self.client.post("/upload", json={"command": command, "target": target})
+        self.assertEqual(response.status_code, 200)
+        return response.json()["rule"]
+
+    def sid_of(self, rule: str) -> int:
+        return self.agent.parse_rule(rule).sid
+
+    def parsed_match(self, matches: list[dict]):
+        return self.agent.parse_rule(matches[0]["rule"])
+
+    def test_delete_by_sid(self):
+        """A rule is deleted by sid, the indexes follow without parsing the rules file again."""
+        first = self.upload("block_ip", "10.2.0.1")
+        second = self.upload("block_ip", "10.2.0.2")
+        with patch.object(RuleIndex, "extend") as extend, patch.object(IpPrefixIndex, "add") as add:
+            response = self.client.delete(f"/rules/{self.sid_of(first)}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["rules"], [first])
+        extend.assert_not_called()
+        add.assert_not_called()
+
+        self.assertNotIn("10.2.0.1", self.rules_file.read_text())
+        self.assertFalse(self.agent.rule_exists(first))
+        self.assertEqual(self.agent.lookup_ip("10.2.0.1"), [])
+        self.assertEqual(
+            self.parsed_match(self.agent.lookup_ip("10.2.0.2")), self.agent.parse_rule(second)
+        )
+        self.assertEqual(self.agent.history_store.last()["content"]["event"], "deleted")
+
+        self.assertEqual(self.client.delete(f"/rules/{self.sid_of(first)}").status_code, 404)
+        self.assertEqual(self.client.delete("/rules/99999").status_code, 404)
+
+    def test_patch_bumps_rev(self):
+        """A patched rule keeps its sid and place, gets the next rev and the new content."""
+        rule = self.upload("block_ip", "10.3.0.1")
+        after = self.upload("block_domain", "after.example")
+        sid = self.sid_of(rule)
+
+        response = self.client.patch(f"/rules/{sid}", json={"msg": "Renamed"})
+        self.assertEqual(response.status_code, 200)
+        updated = response.json()["rule"]
+        self.assertEqual(response.json()["previous"], rule)
+        self.assertIn('msg:"Renamed"', updated)
+        self.assertEqual(self.agent.parse_rule(updated).sid, sid)
+        self.assertEqual(self.agent.parse_rule(updated).rev, 2)
+        text = self.rules_file.read_text()
+        self.assertLess(text.index("Renamed"), text.index("after.example"))
+        self.assertNotIn(rule, text)
+
+        # The indexes point at the new rule, and at the rules that moved
+        self.assertTrue(self.agent.rule_exists(updated))
+        self.assertFalse(self.agent.rule_exists(rule))
+        self.assertEqual(
+            self.parsed_match(self.agent.lookup_ip("10.3.0.1")), self.agent.parse_rule(updated)
+        )
+        self.assertEqual(
+            self.parsed_match(self.agent.lookup_domain("after.example")), self.agent.parse_rule(after)
+        )
+        offset = self.agent.locate_rule(sid)[0]
+        # The same as reading the rules file again
+        self.agent.index_reader.reset()
+        self.agent.rule_index.clear()
+        self.assertTrue(self.agent.rule_exists(updated))
+        self.assertEqual(self.agent.locate_rule(sid)[0], offset)
+
+        response = self.client.patch(
+            f"/rules/{sid}", json={"rule": "block ip 10.3.0.9 any -> any any (msg:\"New\";)"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.agent.parse_rule(response.json()["rule"]).rev, 3)
+        self.assertEqual(self.agent.lookup_ip("10.3.0.1"), [])
+        latest = self.agent.history_store.last()["content"]
+        self.assertEqual(latest["event"], "updated")
+        self.assertEqual(latest["previous"], updated)
+
+    def test_patch_errors(self):
+        """Unknown sids, empty patches and duplicates are rejected, pretty rules stay pretty."""
+        rule = self.upload("block_ip", "10.4.0.1")
+        self.upload("block_ip", "10.4.0.2")
+        sid = self.sid_of(rule)
+        self.assertEqual(self.client.patch("/rules/99999", json={"msg": "x"}).status_code, 404)
+        self.assertEqual(self.client.patch(f"/rules/{sid}", json={}).status_code, 400)
+        response = self.client.patch(
+            f"/rules/{sid}",
+            json={"rule": 'block ip 10.4.0.2 any -> any any (msg:"Block traffic From IP 10.4.0.2";)'},
+        )
+        self.assertEqual(response.status_code, 409)
+
+        response = self.client.patch("/rules/10002", json={"msg": "Renamed list"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('(\n    msg:"Renamed list";\n', self.rules_file.read_text())
+        self.assertEqual(len(self.agent.lookup_ip("10.1.0.2")), 1)
+
+    def test_delete_by_target(self):
+        """The rules of an address or a domain are deleted together, lists and parents are kept."""
+        self.upload("block_ip", "10.5.0.1")
+        self.upload("alert_ip", "10.5.0.1")
+        self.upload("block_ip", "10.5.0.2")
+        self.upload("block_domain", "www.example.com")
+        self.upload("block_domain", "example.com")
+
+        response = self.client.delete(
+            "/rules", params=[("target", "10.5.0.1"), ("target", "www.example.com"), ("target", "10.1.0.1")]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["deleted"], 3)
+        text = self.rules_file.read_text()
+        self.assertNotIn("10.5.0.1", text)
+        self.assertNotIn("SNI www.example.com", text)
+        self.assertIn("10.5.0.2", text)
+        self.assertIn("SNI example.com", text)
+        self.assertIn("10.1.0.1", text)
+
+        self.assertEqual(self.client.delete("/rules", params={"target": "-"}).status_code, 400)
+
+    def test_offsets_follow_edits(self):
+        """After appends, deletions and updates, with the offset log applied or not, every
+        indexed offset is the one a fresh scan of the rules file finds."""
+        with patch.object(OffsetLog, "MAX_PENDING", 3):
+            sids = [self.sid_of(self.upload("block_ip", f"10.6.0.{i}")) for i in range(8)]
+            self.upload("block_domain", "edits.example")
+            for step, sid in enumerate(sids):
+                if step % 3 == 0:
+                    self.agent.delete_rules(sids=[sid])
+                elif step % 3 == 1:
+                    self.agent.update_rule(sid, msg=f"Edited {step}")
+                else:
+                    self.upload("alert_ip", f"10.7.0.{step}")
+
+        reader = RuleReader(self.rules_file, keep_rules=False)
+        scanned = list(reader.scan(located=True))
+        self.assertEqual(len(scanned), 10)
+        for offset, rule in scanned:
+            self.assertEqual(self.agent.rule_index.get_offset(rule), offset)
+            parsed = self.agent.parse_rule(rule)
+            if parsed.src_ip.startswith("10."):
+                matches = self.agent.lookup_ip(parsed.src_ip)
+                self.assertEqual([self.agent.parse_rule(match["rule"]) for match in matches], [parsed])
+        self.assertEqual(len(self.agent.lookup_domain("edits.example")), 1)
+
+    def test_offset_log(self):
+        """The composed offset log maps every offset like the rewrites one after the other."""
+        log = OffsetLog()
+        log.push(OffsetShift([(10, 20), (40, 50)], [0, 4]))
+        log.push(OffsetShift([(0, 5), (30, 38)], [0, 12]))
+        log.push(OffsetShift([(60, 70)]))
+        composed = log.composed()
+        for offset in range(100):
+            self.assertEqual(composed(offset), log(offset), offset)
+        # A replaced rule keeps its stored offset, an appended one is stored past the end
+        self.assertEqual(log.base(log(40)), 40)
+        self.assertEqual(log(log.base(200)), 200)
+
+    def test_rewriter_replaces(self):
+        """A replacement keeps the empty line before the rule, the other offsets shift."""
+        self.rules_file.write_text(
+            "\nalert ip any any -> any any (sid:1;)\n\nalert ip any any -> any any (sid:2;)\n"
+        )
+        text = self.rules_file.read_bytes()
+        first, second = text.index(b"alert"), text.rindex(b"alert")
+        found, moved, shift = RuleRewriter(self.rules_file).rewrite(
+            {first: "alert ip any any -> any any (sid:1; rev:2;)", second: None}
+        )
+        self.assertEqual(set(found), {first, second})
+        self.assertEqual(self.rules_file.read_text(), "\nalert ip any any -> any any (sid:1; rev:2;)\n")
+        self.assertEqual(moved, {first: 1})
+        # The replacement takes the place of the rule, the rule after it is gone
+        self.assertEqual(shift(first), 1)
+        self.assertEqual(shift.inverse(1), first)
+        self.assertIsNone(shift(second))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.ip_prefix_index import IpPrefixIndex
+from fileagent.managers.rule_index import RuleIndex
+from fileagent.managers.rule_rewriter import RuleRewriter
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+from fastapi.testclient import TestClient
+import time
+
+
+class TestRuleExpiry(AgentTestCase):
+    RULES = (
+        "# Rules kept by hand\n"
+        'alert tcp any any -> any 80 (msg:"Kept"; sid:10001;)\n'
+    )
+
+    def test_expired_rules_are_removed(self):
+        """An expired rule is removed from the rules file, the indexes and recorded in the history."""
+        agent = self.make_agent()
+        client = TestClient(agent.app)
+        original = self.rules_file.read_text()
+        response = client.post(
+            "/upload", json={"command": "block_ip", "target": "10.5.0.1", "ttl_seconds": 60}
+        )
+        self.assertEqual(response.status_code, 200)
+        rule = response.json()["rule"]
+        client.post("/upload", json={"command": "block_ip", "target": "10.5.0.2"})
+        client.post("/upload", json={"command": "block_domain", "target": "kept.example"})
+        self.assertIn("10.5.0.1", self.rules_file.read_text())
+
+        self.assertEqual(agent.rule_expiry.reap_due(time.time() + 30), 0)
+        # The indexes follow the rewrite without parsing the rules file again
+        with patch.object(RuleIndex, "extend") as extend, patch.object(IpPrefixIndex, "add") as add:
+            self.assertEqual(agent.rule_expiry.reap_due(time.time() + 61), 1)
+        extend.assert_not_called()
+        add.assert_not_called()
+
+        text = self.rules_file.read_text()
+        self.assertNotIn("10.5.0.1", text)
+        self.assertIn("10.5.0.2", text)
+        self.assertTrue(text.startswith(original))
+        self.assertFalse(agent.rule_exists(rule))
+        self.assertEqual(agent.lookup_ip("10.5.0.1"), [])
+        self.assertIn("10.5.0.2", agent.lookup_ip("10.5.0.2")[0]["rule"])
+        self.assertIn("SNI kept.example", agent.lookup_domain("kept.example")[0]["rule"])
+        kept = agent.get_rules_from_file()[-1]
+        self.assertEqual(agent.ip_index_reader.rule_at(agent.rule_index.get_offset(kept)), kept)
+        self.assertEqual(len(agent.rule_expiry), 0)
+
+        latest = agent.history_store.last()["content"]
+        self.assertEqual(latest["event"], "expired")
+        self.assertEqual(latest["rule"], rule)
+        self.assertEqual(latest["payload"]["target"], "10.5.0.1")
+        self.assertTrue(any(Path(self.tmp.name, "backup").iterdir()))
+
+        # The same rule can be uploaded again
+        response = client.post("/upload", json={"command": "block_ip", "target": "10.5.0.1"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_reaper_batches_rewrites(self):
+        """Rules that expire within the window are removed by the reaper with a single rewrite."""
+        agent = self.make_agent(reap_window=0.3)
+        with patch.object(agent.rule_rewriter, "rewrite", wraps=agent.rule_rewriter.rewrite) as rewrite:
+            for number in range(5):
+                agent.append_rule(
+                    {"command": "block_ip", "target": f"10.6.0.{number}", "ttl_seconds": 0.2}
+                )
+            self.wait_for(lambda: "10.6.0." not in self.rules_file.read_text())
+            # The removals are recorded right after the rewrite
+            self.wait_for(lambda: len(agent.history_store.read()["history"]) == 5)
+        rewrite.assert_called_once()
+
+    def test_expiry_survives_restarts(self):
+        """The expiry times are persisted, a rule that expired while the agent was down goes at startup."""
+        agent = self.make_agent(reap_window=0)
+        agent.append_rule({"command": "block_ip", "target": "10.7.0.1", "ttl_seconds": 0.3})
+        agent.append_rule({"command": "block_ip", "target": "10.7.0.2", "ttl_seconds": 3600})
+        agent.rule_expiry.stop()
+        time.sleep(0.4)
+
+        restarted = self.make_agent(reap_window=0)
+        # The rule is forgotten right after the rewrite
+        self.wait_for(lambda: len(restarted.rule_expiry) == 1)
+        self.assertNotIn("10.7.0.1", self.rules_file.read_text())
+        self.assertIn("10.7.0.2", self.rules_file.read_text())
+
+    def test_failed_removal_is_retried(self):
+        """Rules whose removal failed go back on the heap, and the next reap removes them."""
+        agent = self.make_agent()
+        agent.append_rule({"command": "block_ip", "target": "10.7.1.1", "ttl_seconds": 60})
+        with patch.object(agent.rule_rewriter, "rewrite", side_effect=OSError("read-only")):
+            with self.assertRaises(OSError):
+                agent.rule_expiry.reap_due(time.time() + 61)
+        self.assertIn("10.7.1.1", self.rules_file.read_text())
+        self.assertEqual(len(agent.rule_expiry), 1)
+
+        self.assertEqual(agent.rule_expiry.reap_due(time.time() + 61), 1)
+        self.assertNotIn("10.7.1.1", self.rules_file.read_text())
+
+    def test_compacted_log_is_synced(self):
+        """The compacted expiry log is synced, and its directory too, when it is replaced."""
+        agent = self.make_agent()
+        expiry = agent.rule_expiry
+        expiry.schedule([(f"rule-{i}", time.time() + 3600, {}) for i in range(1100)])
+        with patch("os.fsync") as fsync:
+            expiry.cancel([f"rule-{i}" for i in range(1000)])
+        self.assertEqual(fsync.call_count, 2)
+        self.assertEqual(expiry.lines, 100)
+        self.assertEqual(len(self.make_agent().rule_expiry), 100)
+
+    def test_permanent_rules_are_not_lost(self):
+        """A permanent upload makes a temporary rule permanent, and is not covered by a temporary rule."""
+        agent = self.make_agent()
+        agent.append_rule({"command": "block_ip", "target": "10.8.0.1", "ttl_seconds": 60})
+        self.assertTrue(agent.prepare_rule({"command": "block_ip", "target": "10.8.0.1"}).duplicate)
+        self.assertEqual(len(agent.rule_expiry), 0)
+
+        agent.append_rule({"command": "custom", "target": "block ip 10.9.0.0/16 any -> any any (sid:10090;)", "ttl_seconds": 60})
+        self.assertFalse(agent.prepare_rule({"command": "block_ip", "target": "10.9.1.1"}).duplicate)
+        self.assertTrue(
+            agent.prepare_rule(
+                {"command": "block_ip", "target": "10.9.1.1", "ttl_seconds": 30}
+            ).duplicate
+        )
+
+    def test_rewriter(self):
+        """Only the rules at the offsets are removed, with the empty line before them."""
+        self.rules_file.write_text(
+            "# head\n"
+            "\nalert ip any any -> any any (sid:1;)\n"
+            "\nalert ip any any -> any any (\n    msg:\"multi\";\n    sid:2;\n)\n"
+            "alert ip any any -> any any (sid:3;)\n"
+        )
+        text = self.rules_file.read_bytes()
+        offsets = [text.index(b"alert"), text.index(b"alert", 20), text.rindex(b"alert")]
+        removed, shift = RuleRewriter(self.rules_file).remove(
+            offsets + [3], accept=lambda offset, rule: "sid:3" not in rule
+        )
+        self.assertEqual(sorted(removed), offsets[:2])
+        self.assertIn('msg:"multi";', removed[offsets[1]])
+        self.assertEqual(
+            self.rules_file.read_text(), "# head\nalert ip any any -> any any (sid:3;)\n"
+        )
+        self.assertEqual([shift(offset) for offset in offsets], [None, None, 7])
+        self.assertEqual(shift(0), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
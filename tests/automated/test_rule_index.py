@@ -0,0 +1,64 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.rule_index import canonical_rule, rule_fingerprint
+import unittest
+from unittest.mock import patch
+import os
+
+
+class TestRuleIndex(AgentTestCase):
+    RULES = 'alert ip 10.0.0.1 any -> any any (msg:"Known"; sid:10000; rev:1;)\n'
+
+    def setUp(self):
+        """Set up an agent working on a rules file in a temporary directory."""
+        super().setUp()
+        self.agent = self.make_agent()
+
+    def test_fingerprint_ignores_sid_rev_whitespace_and_order(self):
+        """Equivalent rules share a fingerprint, different ones do not."""
+        single = 'block ip 10.0.0.2 any -> any any (msg:"Block; it"; sid:10001; rev:1;)'
+        pretty = 'block ip  10.0.0.2 any -> any any (\n    rev: 3;\n    sid: 12000;\n    msg:"Block; it";\n)'
+        other = 'block ip 10.0.0.3 any -> any any (msg:"Block; it"; sid:10001; rev:1;)'
+        self.assertEqual(rule_fingerprint(single), rule_fingerprint(pretty))
+        self.assertNotEqual(rule_fingerprint(single), rule_fingerprint(other))
+        self.assertEqual(
+            canonical_rule(single), 'block ip 10.0.0.2 any -> any any (msg:"Block; it")'
+        )
+
+    def test_rule_exists(self):
+        """A rule with another sid and layout is detected as a duplicate."""
+        duplicate = self.agent.build_formatter(
+            ["alert", "ip", "10.0.0.1", "any", "->", "any", "any"],
+            ['msg:"Known";', "sid: 10500;"],
+            pretty=True,
+        )
+        self.assertTrue(self.agent.rule_exists(duplicate))
+        self.assertFalse(
+            self.agent.rule_exists('alert ip 10.0.0.9 any -> any any (msg:"New"; sid:1;)')
+        )
+
+    def test_index_kept_current_on_append(self):
+        """Appending through the agent updates the index without reparsing the file."""
+        self.agent.rule_exists("alert ip 1.1.1.1 any -> any any (sid:1;)")
+        self.agent.append_rule({"command": "block_ip", "target": "10.0.0.5"})
+
+        rule = self.agent.building_rule_block("10.0.0.5")
+
+        with patch.object(self.agent, "get_rules_from_file") as mock_read:
+            self.assertTrue(self.agent.rule_exists(rule))
+            mock_read.assert_not_called()
+
+    def test_index_invalidated_on_external_change(self):
+        """The index is rebuilt when the file changes underneath it."""
+        rule = 'alert ip 10.0.0.7 any -> any any (msg:"External"; sid:10007;)'
+        self.assertFalse(self.agent.rule_exists(rule))
+
+        with open(self.rules_file, "a") as file:
+            file.write(f"{rule}\n")
+        stat = os.stat(self.rules_file)
+        os.utime(self.rules_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+        self.assertTrue(self.agent.rule_exists(rule))
+
+
+if __name__ == "__main__":
+    unittest.main()
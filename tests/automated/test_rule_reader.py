@@ -0,0 +1,144 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.rule_index import RuleIndex
+from fileagent.managers.rule_reader import RuleReader
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+import os
+
+
+class TestRuleReader(AgentTestCase):
+    RULES = (
+        "# Local rules\n"
+        'alert ip 10.0.0.1 any -> any any (msg:"A"; sid:10001;)\n'
+        "block ip 10.0.0.2 any -> any any (\n"
+        '    msg:"B";\n'
+        "    sid: 10002;\n"
+        ")\n"
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.reader = RuleReader(self.rules_file)
+
+    def append(self, text: str):
+        with open(self.rules_file, "a") as file:
+            file.write(text)
+
+    def test_only_appended_bytes_are_parsed(self):
+        """A second read parses what was appended, and nothing before it."""
+        rules, rewritten = self.reader.update()
+        self.assertTrue(rewritten)
+        self.assertEqual(len(rules), 2)
+        self.assertEqual(rules[1], 'block ip 10.0.0.2 any -> any any ( msg:"B"; sid: 10002; )')
+
+        self.append('alert ip 10.0.0.3 any -> any any (msg:"C"; sid:10003;)\n')
+        lines = []
+        feed = self.reader.parser.feed_located
+
+        def recording_feed(parsed):
+            for line in parsed:
+                lines.append(line)
+                yield from feed([line])
+
+        with patch.object(self.reader.parser, "feed_located", side_effect=recording_feed):
+            rules, rewritten = self.reader.update()
+
+        self.assertFalse(rewritten)
+        self.assertEqual(rules, ['alert ip 10.0.0.3 any -> any any (msg:"C"; sid:10003;)'])
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(len(self.reader.read()), 3)
+
+    def test_half_written_rule_is_completed(self):
+        """A multi-line rule that was half written at the previous read is joined."""
+        self.reader.update()
+        self.append('alert ip 10.0.0.4 any -> any any (\n    msg:"D";\n    si')
+        self.assertEqual(self.reader.update(), ([], False))
+
+        self.append("d: 10004;\n)\n")
+        rules, rewritten = self.reader.update()
+        self.assertFalse(rewritten)
+        self.assertEqual(rules, ['alert ip 10.0.0.4 any -> any any ( msg:"D"; sid: 10004; )'])
+
+    def test_last_line_without_newline(self):
+        """A complete rule on the last line is read even without its newline."""
+        self.append('alert ip 10.0.0.5 any -> any any (msg:"E"; sid:10005;)')
+        self.assertEqual(len(self.reader.read()), 3)
+
+        self.append("\n")
+        self.assertEqual(len(self.reader.read()), 3)
+
+    def test_truncation_and_rewrite_reparse(self):
+        """The file is parsed from the start after a truncation or a rewrite."""
+        self.reader.update()
+
+        self.rules_file.write_text('alert ip 10.0.0.6 any -> any any (msg:"F"; sid:10006;)\n')
+        rules, rewritten = self.reader.update()
+        self.assertTrue(rewritten)
+        self.assertEqual(self.reader.read(), rules)
+        self.assertEqual(len(rules), 1)
+
+        # Same size and inode, different content
+        self.rules_file.write_text('alert ip 10.0.0.7 any -> any any (msg:"G"; sid:10007;)\n')
+        stat = os.stat(self.rules_file)
+        os.utime(self.rules_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        rules, rewritten = self.reader.update()
+        self.assertTrue(rewritten)
+        self.assertEqual(rules, ['alert ip 10.0.0.7 any -> any any (msg:"G"; sid:10007;)'])
+
+    def test_replaced_file_reparses(self):
+        """A file replaced by another one (different inode) is parsed from the start."""
+        self.reader.update()
+        replacement = Path(self.tmp.name, "new.rules")
+        replacement.write_text(self.rules_file.read_text() + "alert ip 10.0.0.8 any -> any any (sid:10008;)\n")
+        os.replace(replacement, self.rules_file)
+
+        rules, rewritten = self.reader.update()
+        self.assertTrue(rewritten)
+        self.assertEqual(len(rules), 3)
+
+    def test_small_chunks(self):
+        """Lines and multi-line rules that span chunks are read as a whole."""
+        expected = self.reader.read()
+        reader = RuleReader(self.rules_file, keep_rules=False)
+        reader.CHUNK_BYTES = 7
+        self.assertEqual(list(reader.scan()), expected)
+        self.assertEqual(reader.rules, [])
+
+
+class TestStreamingRules(AgentTestCase):
+    RULES = "".join(f"alert ip 10.1.0.{i} any -> any any (sid:{10000 + i};)\n" for i in range(100))
+
+    def setUp(self):
+        super().setUp()
+        self.agent = self.make_agent()
+
+    def test_read_snort_rules_is_lazy(self):
+        """Rules are yielded as the lines are consumed, from any line iterator."""
+
+        def lines():
+            yield "# comment\n"
+            yield "alert ip 10.1.1.1 any -> any any (\n"
+            yield "    sid:1;\n"
+            yield ")\n"
+            raise AssertionError("Read past the first rule")
+
+        rules = self.agent.read_snort_rules(lines())
+        self.assertEqual(next(rules), "alert ip 10.1.1.1 any -> any any ( sid:1; )")
+
+        with open(self.rules_file) as file:
+            self.assertEqual(len(list(self.agent.read_snort_rules(file))), 100)
+
+    def test_iter_rules_from_file(self):
+        """The rules of the file can be streamed, and the stream stopped early."""
+        rules = self.agent.iter_rules_from_file()
+        self.assertEqual(next(rules), "alert ip 10.1.0.0 any -> any any (sid:10000;)")
+        rules.close()
+
+        self.assertEqual(
+            max(RuleIndex.rule_sid(rule) for rule in self.agent.iter_rules_from_file()), 10099
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
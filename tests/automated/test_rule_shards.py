@@ -0,0 +1,125 @@
+from agent_test_case import AgentTestCase
+import unittest
+from pathlib import Path
+from fastapi.testclient import TestClient
+
+
+class TestRuleShards(AgentTestCase):
+    HAND_RULE = 'alert tcp any any -> any 80 (msg:"Kept"; sid:100;)'
+    RULES = f"# Rules kept by hand\n{HAND_RULE}\n"
+    AGENT_OPTIONS = {"shard_rules": True}
+
+    def shard(self, family: str) -> Path:
+        return Path(self.tmp.name, f"local.{family}.rules")
+
+    def upload(self, client, command: str, target: str, status: int = 200, **extra) -> str:
+        response = client.post("/upload", json={"command": command, "target": target, **extra})
+        self.assertEqual(response.status_code, status, response.text)
+        return response.json().get("rule")
+
+    def test_rules_go_to_their_shard(self):
+        """Every command family has its own rules file, listed in the manifest, the rules
+        file keeps what it had and sids are unique across the files."""
+        agent = self.make_agent()
+        client = TestClient(agent.app)
+        uploads = {
+            "block_ip": [("block_ip", "10.1.0.1"), ("block_icmp", "10.1.0.2")],
+            "block_domain": [("block_domain", "shard.example")],
+            "alert": [("alert_ip", "10.1.0.3"), ("alert_domain", "alert.example")],
+            "custom": [("custom", 'alert udp any any -> any 53 (msg:"Custom";)')],
+        }
+        sids = []
+        for family, payloads in uploads.items():
+            for command, target in payloads:
+                rule = self.upload(client, command, target)
+                self.assertIn(rule, self.shard(family).read_text())
+                sids.append(agent.parse_rule(rule).sid)
+        # The custom rule has no sid of its own
+        sids = [sid for sid in sids if sid is not None]
+        self.assertEqual(len(set(sids)), 5)
+        self.assertEqual(self.rules_file.read_text(), f"# Rules kept by hand\n{self.HAND_RULE}\n")
+        self.assertEqual(len(agent.history_store.read()["history"]), 6)
+
+        manifest = Path(self.tmp.name, "local.include.rules").read_text().splitlines()
+        self.assertEqual(
+            [line for line in manifest if not line.startswith("#")],
+            [
+                "include local.rules",
+                "include local.block_ip.rules",
+                "include local.block_domain.rules",
+                "include local.alert.rules",
+                "include local.custom.rules",
+            ],
+        )
+
+        # Duplicates are found in the shard, and in the rules file
+        self.upload(client, "block_ip", "10.1.0.1", status=409)
+        self.upload(client, "custom", self.HAND_RULE, status=409)
+
+        # Only the shard that changed was backed up
+        backups = {path.name.partition("-")[0] for path in Path(self.tmp.name, "backup").iterdir()}
+        self.assertEqual(
+            backups,
+            {"local.block_ip", "local.block_domain", "local.alert", "local.custom"},
+        )
+
+        # The sids are not handed out again after a restart
+        restarted = self.make_agent()
+        rule = self.upload(TestClient(restarted.app), "block_ip", "10.1.0.9")
+        self.assertGreater(restarted.parse_rule(rule).sid, max(sids))
+        self.assertTrue(restarted.rule_exists(rule))
+
+    def test_edits_across_shards(self):
+        """Lookups, deletions, updates and compactions find the rules in their shard, and
+        only rewrite its file."""
+        agent = self.make_agent()
+        client = TestClient(agent.app)
+        block = self.upload(client, "block_ip", "10.2.0.1")
+        alert = self.upload(client, "alert_ip", "10.2.0.1")
+        self.upload(client, "block_domain", "www.edit.example")
+        self.upload(client, "alert_domain", "edit.example")
+
+        matches = client.get("/rules/lookup", params={"ip": "10.2.0.1"}).json()["matches"]
+        self.assertEqual(
+            sorted(match["sid"] for match in matches),
+            sorted(agent.parse_rule(rule).sid for rule in (block, alert)),
+        )
+        domains = client.get("/rules/lookup", params={"domain": "www.edit.example"}).json()["matches"]
+        self.assertEqual([match["domain"] for match in domains], ["www.edit.example", "edit.example"])
+
+        domain_shard = self.shard("block_domain").read_text()
+        sid = agent.parse_rule(alert).sid
+        response = client.patch(f"/rules/{sid}", json={"msg": "Patched"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('msg:"Patched"', self.shard("alert").read_text())
+
+        response = client.delete("/rules", params={"target": "10.2.0.1"})
+        self.assertEqual(response.json()["deleted"], 2)
+        self.assertNotIn("10.2.0.1", self.shard("block_ip").read_text())
+        self.assertNotIn("10.2.0.1", self.shard("alert").read_text())
+        self.assertEqual(self.shard("block_domain").read_text(), domain_shard)
+
+        # A shard is compacted on its own
+        before = {family: self.shard(family).stat().st_mtime_ns for family in ("alert", "custom")}
+        response = client.post("/rules/compact", params={"shard": "block_domain"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["rules_after"], 1)
+        self.assertEqual(self.shard("block_domain").read_text().count("\n"), 1)
+        self.assertEqual(
+            {family: self.shard(family).stat().st_mtime_ns for family in ("alert", "custom")}, before
+        )
+        self.assertEqual(client.post("/rules/compact", params={"shard": "nope"}).status_code, 400)
+        self.assertEqual(client.post("/rules/compact").json()["rules_after"], 3)
+
+    def test_expiry_in_a_shard(self):
+        """A temporary rule expires from the file of its shard."""
+        agent = self.make_agent(reap_window=0)
+        client = TestClient(agent.app)
+        self.upload(client, "block_domain", "short.example", ttl_seconds=1)
+        self.assertIn("short.example", self.shard("block_domain").read_text())
+        self.wait_for(lambda: "short.example" not in self.shard("block_domain").read_text())
+        self.assertEqual(agent.lookup_domain("short.example"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.rule_writer import RuleWriter
+import unittest
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+
+class TestRuleWriter(AgentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.agent = self.make_agent(commit_window=0.05)
+
+    def submit(self, target: str):
+        context = self.agent.prepare_rule({"command": "block_ip", "target": target})
+        return self.agent.rule_writer.submit([context]).result(timeout=5)[0]
+
+    def test_group_commit(self):
+        """Concurrent submissions are committed with a few writes, and all of them land."""
+        with patch.object(
+            self.agent, "append_rules", wraps=self.agent.append_rules
+        ) as mock_append:
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                contexts = list(pool.map(self.submit, [f"10.3.0.{i}" for i in range(64)]))
+
+        self.assertTrue(all(not context.duplicate for context in contexts))
+        self.assertLess(mock_append.call_count, 16)
+        self.assertEqual(len(self.agent.get_rules_from_file()), 64)
+        self.assertEqual(len(self.agent.read_history()["history"]), 64)
+
+    def test_duplicates_within_a_group(self):
+        """The same rule submitted twice in one group is written once."""
+        first = self.agent.prepare_rule({"command": "alert_ip", "target": "10.3.1.1"})
+        second = self.agent.prepare_rule({"command": "alert_ip", "target": "10.3.1.1"})
+        self.agent.rule_writer.submit([first, second]).result(timeout=5)
+
+        self.assertFalse(first.duplicate)
+        self.assertTrue(second.duplicate)
+        self.assertEqual(len(self.agent.get_rules_from_file()), 1)
+
+    def test_stop_drains_pending_writes(self):
+        """Stopping the writer commits what is still queued."""
+        committed = []
+
+        def slow_commit(items):
+            time.sleep(0.05)
+            committed.extend(items)
+
+        writer = RuleWriter(slow_commit, window=0.01)
+        futures = [writer.submit([i]) for i in range(20)]
+        writer.stop()
+
+        self.assertEqual(sorted(committed), list(range(20)))
+        self.assertTrue(all(future.done() for future in futures))
+
+
+if __name__ == "__main__":
+    unittest.main()
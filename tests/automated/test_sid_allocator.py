@@ -0,0 +1,94 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.sid_allocator import SidAllocator, SidRangeExhaustedError
+import unittest
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from fastapi.testclient import TestClient
+
+
+class TestSidAllocator(AgentTestCase):
+    # A rules file that already uses some sids
+    RULES = (
+        'alert ip 10.0.0.1 any -> any any (msg:"A"; sid:10041; rev:1;)\n'
+        'alert ip 10.0.0.2 any -> any any (msg:"B"; sid:28154103; rev:1;)\n'
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.state_file = Path(self.tmp.name, "local.rules.sid")
+
+    def test_warm_up_from_rules_file(self):
+        """The first sid follows the highest sid of the range found in the file."""
+        agent = self.make_agent()
+        with patch.object(agent, "get_rules_from_file") as mock_read:
+            self.assertEqual(agent.get_current_sid(), 10042)
+            self.assertEqual(agent.get_current_sid(), 10043)
+            mock_read.assert_not_called()
+
+    def test_high_water_mark_is_persisted(self):
+        """A restarted agent continues after the sids that were handed out before."""
+        self.make_agent().get_current_sid()
+        self.assertEqual(self.make_agent().get_current_sid(), 10043)
+
+    def test_concurrent_reservations_are_unique(self):
+        """Concurrent callers never receive the same sid."""
+        allocator = SidAllocator(self.state_file, start=1, end=1000)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            sids = list(pool.map(lambda _: allocator.reserve(), range(500)))
+        self.assertEqual(len(set(sids)), 500)
+
+    def test_exhaustion_is_reported(self):
+        """Running out of sids raises instead of leaving the range."""
+        agent = self.make_agent(sid_start=10040, sid_end=10042)
+        self.assertEqual(agent.get_current_sid(), 10042)
+        with self.assertRaises(SidRangeExhaustedError):
+            agent.get_current_sid()
+
+    def test_sids_are_reserved_on_commit(self):
+        """Only the rules that are written use up a sid: duplicates, covered targets and
+        rejected payloads do not."""
+        client = TestClient(self.make_agent().app)
+
+        def upload(command, target):
+            return client.post("/upload", json={"command": command, "target": target})
+
+        response = upload("block_ip", "10.3.0.0/24")
+        self.assertEqual(response.status_code, 200)
+        # The sid is where the builder puts it
+        self.assertIn(
+            'msg:"Block traffic From IP 10.3.0.0/24";\n    sid: 10042;', response.json()["rule"]
+        )
+        self.assertEqual(upload("block_ip", "10.3.0.0/24").status_code, 409)
+        self.assertEqual(upload("block_ip", "10.3.0.7").status_code, 409)
+        self.assertEqual(upload("unknown", "x").status_code, 422)
+
+        payloads = [
+            {"command": "block_domain", "target": "sids.example"},
+            {"command": "block_domain", "target": "sids.example"},
+            {"command": "block_icmp", "target": "10.5.0.1"},
+        ]
+        results = client.post("/upload/batch", json=payloads).json()["results"]
+        self.assertEqual([r["status"] for r in results], ["added", "duplicate", "added"])
+        self.assertEqual(SidAllocator(self.state_file).next_sid, 10045)
+
+    def test_exhaustion_on_upload(self):
+        """An upload that finds no free sid left is answered with 507, and writes nothing."""
+        client = TestClient(self.make_agent(sid_start=10040, sid_end=10042).app)
+        response = client.post("/upload", json={"command": "block_ip", "target": "10.4.0.1"})
+        self.assertEqual(response.status_code, 200)
+        response = client.post("/upload", json={"command": "block_ip", "target": "10.4.0.2"})
+        self.assertEqual(response.status_code, 507)
+        self.assertNotIn("10.4.0.2", self.rules_file.read_text())
+
+    def test_state_file_is_synced(self):
+        """The state file is synced, and its directory too, when it is replaced."""
+        allocator = SidAllocator(self.state_file)
+        with patch("os.fsync") as fsync:
+            allocator.reserve()
+        self.assertEqual(fsync.call_count, 2)
+        self.assertEqual(SidAllocator(self.state_file).next_sid, 10001)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.snort_reloader import ReloadSignal, SnortReloader
+import unittest
+from pathlib import Path
+from fastapi.testclient import TestClient
+import shlex
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+
+# Stands in for Snort: records every SIGHUP (and the time it came) in the file given
+# as argument, after writing its pid file
+STAND_IN = """
+import os, signal, sys, time
+log, pidfile = sys.argv[1], sys.argv[2]
+def reload(signum, frame):
+    with open(log, "a") as file:
+        file.write(f"{time.time()}\\n")
+signal.signal(signal.SIGHUP, reload)
+with open(pidfile + ".tmp", "w") as file:
+    file.write(f"{os.getpid()}\\n")
+os.replace(pidfile + ".tmp", pidfile)
+while True:
+    time.sleep(1)
+"""
+
+
+class TestSnortReload(AgentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.log = Path(self.tmp.name, "reloads.log")
+
+    def reloads(self) -> list[float]:
+        if not self.log.exists():
+            return []
+        return [float(line) for line in self.log.read_text().split()]
+
+    def start_stand_in(self) -> Path:
+        pidfile = Path(self.tmp.name, "snort.pid")
+        process = subprocess.Popen(
+            [sys.executable, "-c", STAND_IN, str(self.log), str(pidfile)]
+        )
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        self.wait_for(pidfile.exists)
+        return pidfile
+
+    def test_burst_is_folded(self):
+        """A burst of uploads costs one reload per window, every change is counted once."""
+        # Stands in for the reload command of Snort
+        script = "import sys, time; open(sys.argv[1], 'a').write(f'{time.time()}\\n')"
+        command = shlex.join([sys.executable, "-c", script, str(self.log)])
+        agent = self.make_agent(reload_command=command, reload_window=0.5)
+        client = TestClient(agent.app)
+        for i in range(20):
+            response = client.post("/upload", json={"command": "block_ip", "target": f"10.8.0.{i}"})
+            self.assertEqual(response.status_code, 200)
+        client.delete("/rules", params={"target": "10.8.0.0"})
+
+        self.wait_for(lambda: agent.snort_reloader.metrics()["pending_changes"] == 0)
+        metrics = client.get("/metrics/reload").json()
+        self.assertEqual(metrics["changes"], 21)
+        self.assertEqual(sum(metrics["folded"]), 21)
+        self.assertEqual(metrics["reloads"], len(self.reloads()))
+        self.assertLess(metrics["reloads"], 21)
+        self.assertEqual(metrics["max_folded"], max(metrics["folded"]))
+        self.assertIsNone(metrics["last_error"])
+        # At most one reload per window
+        reloads = self.reloads()
+        for before, after in zip(reloads, reloads[1:]):
+            self.assertGreaterEqual(after - before, 0.4)
+
+    def test_window_is_shared_by_agents(self):
+        """Two agents on one rules file reload Snort once for the changes of both, and
+        changes after that reload wait for the end of the window."""
+        script = "import sys, time; open(sys.argv[1], 'a').write(f'{time.time()}\\n')"
+        command = shlex.join([sys.executable, "-c", script, str(self.log)])
+        agents = [self.make_agent(reload_command=command, reload_window=0.5) for _ in range(2)]
+        clients = [TestClient(agent.app) for agent in agents]
+        for i, client in enumerate(clients):
+            response = client.post("/upload", json={"command": "block_ip", "target": f"10.11.0.{i}"})
+            self.assertEqual(response.status_code, 200)
+
+        self.wait_for(
+            lambda: all(agent.snort_reloader.metrics()["pending_changes"] == 0 for agent in agents)
+        )
+        self.assertEqual(len(self.reloads()), 1)
+        metrics = [agent.snort_reloader.metrics() for agent in agents]
+        self.assertEqual([m["reloads"] for m in metrics], [1, 0])
+        self.assertEqual([m["reloaded_elsewhere"] for m in metrics], [0, 1])
+
+        # A change after the reload of the first agent is reloaded a window after it
+        clients[1].post("/upload", json={"command": "block_ip", "target": "10.11.0.9"})
+        self.wait_for(lambda: agents[1].snort_reloader.metrics()["reloads"] == 1)
+        first, second = self.reloads()
+        self.assertGreaterEqual(second - first, 0.45)
+
+    def test_signal_to_pid_file(self):
+        """The stand-in gets a SIGHUP through its pid file after the rules changed."""
+        pidfile = self.start_stand_in()
+        agent = self.make_agent(reload_pid=str(pidfile), reload_window=0.1)
+        client = TestClient(agent.app)
+        client.post("/upload", json={"command": "block_ip", "target": "10.9.0.1"})
+        self.wait_for(lambda: len(self.reloads()) == 1)
+
+        sid = agent.parse_rule(agent.get_rules_from_file()[0]).sid
+        self.assertEqual(client.delete(f"/rules/{sid}").status_code, 200)
+        self.wait_for(lambda: len(self.reloads()) == 2)
+        self.assertEqual(agent.snort_reloader.metrics()["folded"], [1, 1])
+        self.assertEqual(str(agent.snort_reloader.trigger), f"signal SIGHUP to {pidfile}")
+
+    def test_control_socket(self):
+        """The reload command goes to the control socket as one line."""
+        received = []
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                received.append(self.rfile.readline().decode())
+
+        path = str(Path(self.tmp.name, "snort.sock"))
+        server = socketserver.UnixStreamServer(path, Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        agent = self.make_agent(reload_socket=path, reload_window=0)
+        client = TestClient(agent.app)
+        client.post("/upload", json={"command": "block_domain", "target": "reload.example"})
+        self.wait_for(lambda: received == ["snort.reload_config()\n"])
+        self.wait_for(lambda: agent.snort_reloader.metrics()["reloads"] == 1)
+
+    def test_ip_lists(self):
+        """The addresses that go to the IP lists are folded into the reload once the lists are written."""
+        agent = self.make_agent(
+            reload_pid=str(self.start_stand_in()), reload_window=0.1, aggregate_ips=True
+        )
+        client = TestClient(agent.app)
+        for i in range(4):
+            client.post("/upload", json={"command": "block_ip", "target": f"10.10.0.{i}"})
+        self.wait_for(lambda: agent.snort_reloader.metrics()["changes"] == 4)
+        self.assertEqual(self.rules_file.read_text(), "")
+
+    def test_failed_reload_is_retried(self):
+        """A failed reload keeps its changes pending and is retried after a window."""
+        calls = []
+
+        def trigger():
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise OSError("not running")
+
+        reloader = SnortReloader(trigger, window=0.1)
+        self.addCleanup(reloader.stop)
+        reloader.changed(3)
+        self.wait_for(lambda: reloader.metrics()["reloads"] == 1)
+        metrics = reloader.metrics()
+        self.assertEqual(metrics["failed_reloads"], 1)
+        self.assertEqual(metrics["folded"], [3])
+        self.assertEqual(metrics["pending_changes"], 0)
+        self.assertGreaterEqual(calls[1] - calls[0], 0.09)
+
+        # A signal is also given by name, a pid without a pid file
+        self.assertEqual(ReloadSignal.from_name(1234, "usr1").pid, 1234)
+
+    def test_no_trigger(self):
+        """Without a trigger nothing is reloaded, and there are no metrics."""
+        agent = self.make_agent()
+        self.assertIsNone(agent.snort_reloader)
+        self.assertEqual(TestClient(agent.app).get("/metrics/reload").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+from agent_test_case import AgentTestCase
+from fileagent.managers.snort_rule import SnortRule
+import unittest
+
+
+class TestSnortRule(AgentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.agent = self.make_agent()
+
+    def test_builder_round_trip(self):
+        """The rules of the builder are parsed and written back unchanged."""
+        rules = [
+            self.agent.building_rule_block("10.0.0.1"),
+            self.agent.building_rule_alert("10.0.0.2"),
+            self.agent.building_rule_block_icmp("10.0.0.3"),
+            self.agent.building_rule_block_domain("example.com"),
+            self.agent.building_rule_alert_domain("example.com"),
+        ]
+        for rule in rules:
+            parsed = self.agent.parse_rule(rule)
+            self.assertEqual(parsed.format(pretty=True), rule)
+            self.assertEqual(SnortRule.parse(parsed.format()), parsed)
+
+    def test_quoted_values(self):
+        """Semicolons and colons inside quoted values do not split the option."""
+        rule = SnortRule.parse(
+            'alert tcp any any -> any 80 (msg:"a; b: c"; content:"x;y"; '
+            "pcre:'/a;b/i'; nocase; sid:10001; rev:2;)"
+        )
+        self.assertEqual(rule.get("msg"), '"a; b: c"')
+        self.assertEqual(rule.get("content"), '"x;y"')
+        self.assertEqual(rule.get("pcre"), "'/a;b/i'")
+        self.assertIs(rule.get("nocase"), True)
+        self.assertEqual((rule.sid, rule.rev, rule.gid), (10001, 2, None))
+        self.assertEqual(
+            rule.format(),
+            'alert tcp any any -> any 80 (msg:"a; b: c"; content:"x;y"; '
+            "pcre:'/a;b/i'; nocase; sid:10001; rev:2;)",
+        )
+
+    def test_numeric_options(self):
+        """Changing the sid, rev or gid is reflected in the text of the rule."""
+        rule = SnortRule.parse('alert ip 10.0.0.1 any -> any any (msg:"A"; sid:10001;)')
+        rule.sid = 10002
+        rule.rev = 3
+        self.assertEqual(
+            rule.format(), 'alert ip 10.0.0.1 any -> any any (msg:"A"; sid: 10002; rev: 3;)'
+        )
+
+    def test_compact_and_interned(self):
+        """Rules use slots and share the strings of the repeated header fields."""
+        first = SnortRule.parse("alert ip 10.0.0.1 any -> any any (sid:1;)")
+        second = SnortRule.parse("alert ip 10.0.0.2 any -> any any (sid:2;)")
+        self.assertFalse(hasattr(first, "__dict__"))
+        for field in ("action", "protocol", "src_port", "direction", "dst_ip"):
+            self.assertIs(getattr(first, field), getattr(second, field))
+
+    def test_service_rule_and_invalid_header(self):
+        """Service rules have no addresses, and an incomplete header is rejected."""
+        rule = SnortRule.parse('alert http (msg:"HTTP"; sid:1;)')
+        self.assertEqual((rule.action, rule.protocol, rule.src_ip), ("alert", "http", None))
+        self.assertEqual(rule.format(), 'alert http (msg:"HTTP"; sid:1;)')
+        with self.assertRaises(ValueError):
+            SnortRule.parse("alert ip 10.0.0.1 (sid:1;)")
+
+    def test_rule_splitter_layout(self):
+        """rule_splitter keeps its dictionary layout."""
+        parsed = self.agent.rule_splitter(
+            'alert ip 10.0.0.1 any -> any any (msg:"a;b"; classtype:tcp-connection; sid:7;)'
+        )
+        self.assertEqual(parsed["src_ip"], "10.0.0.1")
+        self.assertEqual(
+            parsed["options"],
+            {"msg": '"a;b"', "classtype": "tcp-connection", "sid": "7"},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+from agent_test_case import AgentTestCase
+import builtins
+import unittest
+from unittest.mock import patch
+from collections import Counter
+from pathlib import Path
+from fastapi.testclient import TestClient
+import asyncio
+import threading
+import httpx
+
+
+class TestUploadPipeline(AgentTestCase):
+    RULES = "".join(
+        f'alert ip 10.0.1.{i} any -> any any (msg:"Rule {i}"; sid:{10000 + i}; rev:1;)\n'
+        for i in range(50)
+    )
+
+    def setUp(self):
+        """Set up an agent with a few rules in a temporary directory."""
+        super().setUp()
+        self.agent = self.make_agent()
+        self.client = TestClient(self.agent.app)
+
+    def count_opens(self, request):
+        """Run the request and count the files it opened, by (path, mode)."""
+        opens = Counter()
+        original_open = builtins.open
+
+        def counting_open(file, mode="r", *args, **kwargs):
+            opens[(Path(file).name, mode)] += 1
+            return original_open(file, mode, *args, **kwargs)
+
+        with patch("builtins.open", side_effect=counting_open):
+            response = request()
+        return response, opens
+
+    def test_upload_reads_rules_file_at_most_once(self):
+        """One upload translates once, allocates one sid and reads the rules file at most once."""
+        next_sid = self.agent.sid_allocator.next_sid
+
+        with patch.object(
+            self.agent, "rule_translator", wraps=self.agent.rule_translator
+        ) as mock_translator:
+            response, opens = self.count_opens(
+                lambda: self.client.post(
+                    "/upload", json={"command": "block_ip", "target": "10.0.2.1"}
+                )
+            )
+
+        self.assertEqual(response.status_code, 200)
+        mock_translator.assert_called_once()
+        self.assertEqual(self.agent.sid_allocator.next_sid, next_sid + 1)
+        self.assertLessEqual(opens[("local.rules", "r")] + opens[("local.rules", "rb")], 1)
+        self.assertEqual(opens[("local.rules", "a")], 1)
+        self.assertEqual(opens[("history.jsonl", "r")], 0)
+        self.assertEqual(opens[("history.jsonl", "a")], 1)
+
+    def test_duplicate_upload_does_not_touch_rules_file(self):
+        """A duplicate is rejected from the index, without opening the rules file."""
+        rule = self.agent.get_rules_from_file()[0]
+        response, opens = self.count_opens(
+            lambda: self.client.post("/upload", json={"command": "custom", "target": rule})
+        )
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            sum(count for (name, _), count in opens.items() if name == "local.rules"), 0
+        )
+
+    def test_file_work_runs_off_the_event_loop(self):
+        """The pipeline runs on the I/O threads, not on the thread of the event loop."""
+        threads = set()
+        prepare_rule = self.agent.prepare_rule
+
+        def recording_prepare_rule(data):
+            threads.add(threading.current_thread().name)
+            return prepare_rule(data)
+
+        with patch.object(self.agent, "prepare_rule", side_effect=recording_prepare_rule):
+            response = self.client.post(
+                "/upload", json={"command": "block_ip", "target": "10.0.2.2"}
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(name.startswith("fileagent-io") for name in threads))
+
+    def test_concurrent_identical_uploads(self):
+        """Two concurrent uploads of the same rule add it only once."""
+
+        async def upload_twice():
+            transport = httpx.ASGITransport(app=self.agent.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://agent") as client:
+                payload = {"command": "alert_ip", "target": "10.0.2.3"}
+                return await asyncio.gather(
+                    client.post("/upload", json=payload), client.post("/upload", json=payload)
+                )
+
+        responses = asyncio.run(upload_twice())
+        self.assertEqual(sorted(r.status_code for r in responses), [200, 409])
+
+
+if __name__ == "__main__":
+    unittest.main()
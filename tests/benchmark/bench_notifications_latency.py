@@ -0,0 +1,162 @@
+from fileagent import FileAgent
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import multiprocessing
+import socket
+import statistics
+import tempfile
+import time
+import httpx
+import uvicorn
+
+
+class NotificationsLatencyBenchmark:
+    """
+    Measures the latency of /notifications while a storm of uploads is running.
+
+    The agent runs in its own process, behind uvicorn, with an artificially slow disk
+    (every backup sleeps). The uploads are sent from another process, so only the server
+    shares its event loop with the file work. The `inline` mode does the file work of the
+    handlers on the event loop (the behaviour before the I/O executor), the `executor`
+    mode is the current behaviour.
+    """
+
+    def __init__(self, uploads: int, polls: int, disk_delay: float, concurrency: int):
+        self.uploads = uploads
+        self.polls = polls
+        self.disk_delay = disk_delay
+        self.concurrency = concurrency
+
+    @staticmethod
+    def free_port() -> int:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    @staticmethod
+    def serve(directory: str, port: int, inline: bool, disk_delay: float):
+        Path(directory, "local.rules").write_text("")
+        agent = FileAgent(port=port, host="127.0.0.1", directory=directory, file="local.rules")
+        agent.history_store.append(
+            [{"timestamp": "2026-01-01 00:00:00", "content": {"i": i}} for i in range(1000)]
+        )
+
+        file_backup = agent.file_backup
+
+        def slow_backup(*args):
+            time.sleep(disk_delay)
+            file_backup(*args)
+
+        agent.file_backup = slow_backup
+
+        if inline:
+
+            async def run_inline(func, *args, **kwargs):
+                return func(*args, **kwargs)
+
+            def commit_inline(items):
+                future = Future()
+                agent.commit_rules(items)
+                future.set_result(items)
+                return future
+
+            agent.run_io = run_inline
+            agent.rule_writer.submit = commit_inline
+
+        uvicorn.run(agent.app, host="127.0.0.1", port=port, log_level="warning")
+
+    @staticmethod
+    def storm(url: str, uploads: int, concurrency: int):
+        with httpx.Client(base_url=url, timeout=60) as client:
+
+            def upload(i):
+                client.post(
+                    "/upload",
+                    json={"command": "block_ip", "target": f"10.9.{i // 250}.{i % 250}"},
+                )
+
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(upload, range(uploads)))
+
+    def poll(self, client: httpx.Client, interval: float = 0.02) -> list[float]:
+        """
+        Poll at a fixed rate. The latency is measured from the time each poll was
+        scheduled, so time spent waiting for a blocked server is accounted for.
+        """
+        latencies = []
+        start = time.perf_counter()
+        for i in range(self.polls):
+            scheduled = start + i * interval
+            if (delay := scheduled - time.perf_counter()) > 0:
+                time.sleep(delay)
+            client.get("/notifications", params={"limit": 50})
+            latencies.append(time.perf_counter() - scheduled)
+        return latencies
+
+    def measure(self, inline: bool) -> dict:
+        port = self.free_port()
+        url = f"http://127.0.0.1:{port}"
+        with tempfile.TemporaryDirectory() as directory:
+            server = multiprocessing.Process(
+                target=self.serve, args=(directory, port, inline, self.disk_delay)
+            )
+            server.start()
+            try:
+                with httpx.Client(base_url=url, timeout=60) as client:
+                    self.wait_ready(client)
+                    idle = self.poll(client)
+
+                    storm = multiprocessing.Process(
+                        target=self.storm, args=(url, self.uploads, self.concurrency)
+                    )
+                    storm.start()
+                    busy = self.poll(client)
+                    storm.join()
+            finally:
+                server.terminate()
+                server.join()
+        return {"idle": idle, "storm": busy}
+
+    @staticmethod
+    def wait_ready(client: httpx.Client, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if client.get("/notifications", params={"limit": 1}).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError("The agent did not start")
+
+    @staticmethod
+    def percentile(values: list[float], q: int) -> float:
+        return statistics.quantiles(values, n=100)[q - 1] * 1000
+
+    def main(self):
+        print(
+            f"{self.uploads} uploads from {self.concurrency} clients, {self.polls} polls, "
+            f"{self.disk_delay * 1000:.0f} ms per backup"
+        )
+        print(f"{'mode':<10}{'phase':<8}{'p50 ms':>10}{'p99 ms':>10}")
+        for mode, inline in (("inline", True), ("executor", False)):
+            results = self.measure(inline)
+            for phase, latencies in results.items():
+                print(
+                    f"{mode:<10}{phase:<8}"
+                    f"{self.percentile(latencies, 50):>10.2f}"
+                    f"{self.percentile(latencies, 99):>10.2f}"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uploads", type=int, default=300)
+    parser.add_argument("--polls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--disk-delay", type=float, default=0.01)
+    args = parser.parse_args()
+    NotificationsLatencyBenchmark(
+        args.uploads, args.polls, args.disk_delay, args.concurrency
+    ).main()
@@ -0,0 +1,76 @@
+from fileagent.managers.parallel_loader import ParallelRuleLoader
+from fileagent.managers.rule_index import RuleIndex
+from fileagent.managers.rule_reader import RuleReader
+from pathlib import Path
+import argparse
+import os
+import tempfile
+import time
+
+
+class ParallelLoadBenchmark:
+    """
+    Compares the time to index a large rules file with a serial scan and with the
+    `ParallelRuleLoader`, for a few numbers of worker processes.
+    """
+
+    def __init__(self, rules: int, workers: list[int]):
+        self.rules = rules
+        self.workers = workers
+
+    def write_rules(self, path: Path):
+        with open(path, "w") as file:
+            for i in range(self.rules):
+                address = f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+                if i % 4 == 0:
+                    file.write(
+                        f"alert ip {address} any -> any any (\n"
+                        f'    msg:"IP Alert Incoming From IP {address}";\n'
+                        f"    sid: {1000000 + i};\n"
+                        ")\n"
+                    )
+                else:
+                    file.write(
+                        f'block ip {address} any -> any any (msg:"Block traffic From IP {address}"; '
+                        f"sid: {1000000 + i};)\n"
+                    )
+
+    @staticmethod
+    def serial(path: Path) -> RuleIndex:
+        index = RuleIndex(path)
+        reader = RuleReader(path, keep_rules=False)
+        signature = index.file_signature()
+        index.extend(reader.scan(located=True), signature)
+        return index
+
+    @staticmethod
+    def parallel(path: Path, workers: int) -> RuleIndex:
+        index = RuleIndex(path)
+        ParallelRuleLoader(path, workers).load(index, RuleReader(path, keep_rules=False))
+        return index
+
+    def main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp, "local.rules")
+            self.write_rules(path)
+            size = os.path.getsize(path) / (1 << 20)
+            print(f"{self.rules} rules, {size:.0f} MiB, {os.cpu_count()} CPU(s)")
+            print(f"{'mode':<12}{'seconds':>9}{'rules':>10}")
+
+            start = time.perf_counter()
+            index = self.serial(path)
+            print(f"{'serial':<12}{time.perf_counter() - start:>9.2f}{len(index):>10}")
+
+            for workers in self.workers:
+                start = time.perf_counter()
+                index = self.parallel(path, workers)
+                name = f"{workers} workers"
+                print(f"{name:<12}{time.perf_counter() - start:>9.2f}{len(index):>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+    ParallelLoadBenchmark(args.rules, args.workers).main()
@@ -0,0 +1,110 @@
+from fileagent import FileAgent
+from fileagent.managers.ip_aggregator import IpAggregator
+from fileagent.managers.reputation_lists import ReputationLists
+from pathlib import Path
+import argparse
+import itertools
+import os
+import random
+import tempfile
+import time
+
+
+class ReputationListsBenchmark:
+    """
+    Compares the size of the generated files and the time to generate them, for a
+    blocklist of N addresses written as one rule per address (the default), as IP-list
+    rules (`aggregate_ips`) and as reputation lists (`reputation_lists`).
+    """
+
+    def __init__(self, counts: list[int], clustered: float):
+        self.counts = counts
+        self.clustered = clustered
+
+    def addresses(self, count: int) -> list[str]:
+        """
+        A `clustered` share of the addresses fill whole /24 networks (e.g. the hosts of a
+        hostile network), the others are scattered.
+        """
+        generator = random.Random(count)
+        clustered = int(count * self.clustered)
+        addresses = [f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}" for n in range(clustered)]
+        addresses += [
+            f"172.{generator.randrange(16, 32)}.{generator.randrange(256)}.{generator.randrange(256)}"
+            for _ in range(count - clustered)
+        ]
+        generator.shuffle(addresses)
+        return addresses
+
+    @staticmethod
+    def size(paths) -> int:
+        return sum(os.path.getsize(path) for path in paths)
+
+    def per_rule(self, agent: FileAgent, addresses: list[str], directory: Path):
+        """One rule per address, as `building_rule_block` writes them (with a sid counter)."""
+        sids = itertools.count(1000000)
+        path = Path(directory, "per_rule.rules")
+        with open(path, "w") as file:
+            for address in addresses:
+                parts, opts = agent.builder(
+                    action="block",
+                    protocol="ip",
+                    src_ip=address,
+                    src_port="any",
+                    direction="->",
+                    dst_ip="any",
+                    dst_port="any",
+                    sid=next(sids),
+                    msg=f"Block traffic From IP {address}",
+                )
+                file.write(f"\n{agent.build_formatter(parts, opts, pretty=True)}\n")
+        return [path]
+
+    def ip_lists(self, agent: FileAgent, addresses: list[str], directory: Path):
+        sids = itertools.count(1000000)
+        path = Path(directory, "local.iplists.rules")
+        lists = IpAggregator(path, agent.building_rule_ip_list, lambda: next(sids), interval=60)
+        lists.add("block", addresses)
+        lists.stop()
+        return [path]
+
+    def reputation(self, agent: FileAgent, addresses: list[str], directory: Path):
+        lists = ReputationLists(Path(directory, "reputation"), interval=60)
+        lists.add("block", addresses)
+        lists.stop()
+        return list(Path(directory, "reputation").iterdir())
+
+    def main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            Path(tmp, "local.rules").write_text("")
+            agent = FileAgent(port=8000, host="127.0.0.1", directory=tmp, file="local.rules")
+            print(f"{'addresses':>10}  {'output':<12}{'seconds':>9}{'bytes':>12}{'rules':>8}")
+            for count in self.counts:
+                addresses = self.addresses(count)
+                for name, generate in (
+                    ("per rule", self.per_rule),
+                    ("IP lists", self.ip_lists),
+                    ("reputation", self.reputation),
+                ):
+                    with tempfile.TemporaryDirectory() as directory:
+                        start = time.perf_counter()
+                        paths = generate(agent, addresses, Path(directory))
+                        elapsed = time.perf_counter() - start
+                        rules = sum(
+                            path.read_text().count(" any -> any any (")
+                            for path in paths
+                            if path.suffix == ".rules"
+                        )
+                        print(
+                            f"{count:>10}  {name:<12}{elapsed:>9.2f}{self.size(paths):>12}{rules:>8}"
+                        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--addresses", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument(
+        "--clustered", type=float, default=0.5, help="Share of addresses in whole /24 networks"
+    )
+    args = parser.parse_args()
+    ReputationListsBenchmark(args.addresses, args.clustered).main()
@@ -0,0 +1,98 @@
+from fileagent import FileAgent
+from pathlib import Path
+import argparse
+import tempfile
+import time
+
+
+class RuleCompactionBenchmark:
+    """
+    Measures what the compact form of the rules file saves: a rules file of N rules written
+    the way the agent writes them by default (one option per line, an empty line before
+    each rule), with a share of duplicates, is compacted, and the time to parse it
+    (`read_snort_rules` over the lines of the file) and to build the rule index from it at
+    startup are compared before and after.
+    """
+
+    def __init__(self, rules: int, duplicates: float):
+        self.rules = rules
+        self.duplicates = duplicates
+
+    def write(self, path: Path):
+        agent_rules = []
+        for i in range(self.rules):
+            address = f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+            agent_rules.append(
+                f"block ip {address} any -> any any (\n"
+                f'    msg:"Block traffic From IP {address}";\n'
+                f"    sid: {1000000 + i};\n"
+                f")"
+            )
+        # Rules uploaded again with another sid, e.g. before the index existed
+        step = max(1, int(1 / self.duplicates)) if self.duplicates else 0
+        for i in range(0, self.rules, step) if step else ():
+            address = f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+            agent_rules.append(
+                f'block ip {address} any -> any any (msg:"Block traffic From IP {address}"; '
+                f"sid: {2000000 + i};)"
+            )
+        with open(path, "w") as file:
+            file.write("".join(f"\n{rule}\n" for rule in agent_rules))
+
+    def parse(self, agent: FileAgent, path: Path) -> tuple[int, float]:
+        start = time.perf_counter()
+        with open(path, "r") as file:
+            count = sum(1 for _ in agent.read_snort_rules(file))
+        return count, time.perf_counter() - start
+
+    def startup(self, directory: str) -> float:
+        for sidecar in Path(directory).glob("local.rules.*idx"):
+            sidecar.unlink()
+        start = time.perf_counter()
+        agent = FileAgent(port=8000, host="127.0.0.1", directory=directory, file="local.rules")
+        elapsed = time.perf_counter() - start
+        agent.backup_store.stop()
+        agent.rule_expiry.stop()
+        return elapsed
+
+    def main(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory, "local.rules")
+            self.write(path)
+            agent = FileAgent(port=8000, host="127.0.0.1", directory=directory, file="local.rules")
+
+            print(f"{'file':<10}{'rules':>9}{'lines':>10}{'bytes':>12}{'parse s':>9}{'startup s':>11}")
+            rows = []
+            count, parse = self.parse(agent, path)
+            with open(path, "rb") as file:
+                lines = sum(1 for _ in file)
+            rows.append(("before", count, lines, path.stat().st_size, parse))
+
+            start = time.perf_counter()
+            stats = agent.compact_rules_file()
+            compacted = time.perf_counter() - start
+            agent.backup_store.stop()
+            agent.rule_expiry.stop()
+
+            count, parse = self.parse(agent, path)
+            rows.append(("after", count, stats["lines_after"], stats["bytes_after"], parse))
+            startups = [None, self.startup(directory)]
+
+            # The startup before, on a copy of the original file
+            self.write(path)
+            startups[0] = self.startup(directory)
+
+            for (name, count, lines, size, parse), startup in zip(rows, startups):
+                print(f"{name:<10}{count:>9}{lines:>10}{size:>12}{parse:>9.2f}{startup:>11.2f}")
+            print(
+                f"compaction took {compacted:.2f} s, dropped {stats['exact_duplicates']} exact "
+                f"and {stats['semantic_duplicates']} semantic duplicates"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", type=int, default=100_000)
+    parser.add_argument("--duplicates", type=float, default=0.05)
+    args = parser.parse_args()
+    RuleCompactionBenchmark(args.rules, args.duplicates).main()
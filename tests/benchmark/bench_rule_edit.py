@@ -0,0 +1,79 @@
+from fileagent import FileAgent
+from pathlib import Path
+import argparse
+import tempfile
+import time
+
+
+class RuleEditBenchmark:
+    """
+    Measures deleting and updating single rules by sid, through the indexes and a spliced
+    rewrite of the rules file (the offset logs fill up and are applied along the way),
+    against reading the whole rules file back after each rewrite (what the indexes would
+    do without following the rewrite), for rules files of N rules.
+    """
+
+    def __init__(self, sizes: list[int], edits: int, reparsed_edits: int):
+        self.sizes = sizes
+        self.edits = edits
+        self.reparsed_edits = reparsed_edits
+
+    def agent(self, directory: Path, rules: int) -> FileAgent:
+        with open(Path(directory, "local.rules"), "w") as file:
+            for i in range(rules):
+                address = f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+                file.write(
+                    f'\nblock ip {address} any -> any any (msg:"Block traffic From IP {address}"; '
+                    f"sid: {1000000 + i};)\n"
+                )
+        return FileAgent(port=8000, host="127.0.0.1", directory=directory, file="local.rules")
+
+    def reparse(self, agent: FileAgent):
+        # Forget what the indexes know, as after a rewrite they cannot follow
+        agent.index_reader.reset()
+        agent.rule_index.clear()
+        agent.ip_index_reader.reset()
+        agent.ip_index.clear()
+        agent.domain_index.clear()
+        agent.get_rule_index()
+        agent.sync_target_indexes()
+        agent.rule_index.fingerprint_of(0)
+
+    def edit(self, agent: FileAgent, name: str, sid: int):
+        if name == "delete":
+            agent.delete_rules(sids=[sid])
+        else:
+            agent.update_rule(sid, msg=f"Edited {sid}")
+
+    def main(self):
+        print(f"{'rules':>9}  {'edit':<8}{'spliced':>10}{'reparsed':>10}")
+        for rules in self.sizes:
+            with tempfile.TemporaryDirectory() as directory:
+                agent = self.agent(directory, rules)
+                agent.rule_index.fingerprint_of(0)
+                sids = iter(1000000 + (i * 7919) % rules for i in range(rules))
+                for name in ("delete", "patch"):
+                    start = time.perf_counter()
+                    for _ in range(self.edits):
+                        self.edit(agent, name, next(sids))
+                    spliced = (time.perf_counter() - start) / self.edits
+
+                    reparsed = 0.0
+                    for _ in range(self.reparsed_edits):
+                        start = time.perf_counter()
+                        self.edit(agent, name, next(sids))
+                        self.reparse(agent)
+                        reparsed += time.perf_counter() - start
+                    reparsed /= self.reparsed_edits
+                    print(f"{rules:>9}  {name:<8}{spliced:>10.3f}{reparsed:>10.3f}")
+                agent.backup_store.stop()
+                agent.rule_expiry.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--edits", type=int, default=200)
+    parser.add_argument("--reparsed-edits", type=int, default=5)
+    args = parser.parse_args()
+    RuleEditBenchmark(args.sizes, args.edits, args.reparsed_edits).main()
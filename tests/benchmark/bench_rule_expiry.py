@@ -0,0 +1,83 @@
+from fileagent import FileAgent
+from fileagent.managers.rule_expiry import RuleExpiry
+from fileagent.managers.rule_index import rule_fingerprint
+from pathlib import Path
+import argparse
+import tempfile
+import time
+
+
+class RuleExpiryBenchmark:
+    """
+    Measures the expiry of temporary rules: the cost of the expiry heap itself, and the
+    time to remove E expired rules from a rules file of N rules with one batched rewrite
+    (what the reaper does) against one rewrite per rule.
+    """
+
+    def __init__(self, rules: int, expiring: int, scheduled: int):
+        self.rules = rules
+        self.expiring = expiring
+        self.scheduled = scheduled
+
+    def heap(self, directory: Path):
+        expiry = RuleExpiry(Path(directory, "heap.ttl"), reap=lambda expired: None)
+        now = time.time()
+        entries = [(f"{i:032x}", now + (i * 7919) % self.scheduled, None) for i in range(self.scheduled)]
+
+        start = time.perf_counter()
+        expiry.schedule(entries)
+        scheduled = time.perf_counter() - start
+        expiry.stop()
+
+        start = time.perf_counter()
+        due = expiry.due(now + self.scheduled)
+        popped = time.perf_counter() - start
+        print(f"heap: scheduled {self.scheduled} rules in {scheduled:.2f} s, popped {len(due)} in {popped:.2f} s")
+
+    def agent(self, directory: Path) -> tuple[FileAgent, list]:
+        path = Path(directory, "local.rules")
+        with open(path, "w") as file:
+            for i in range(self.rules):
+                address = f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+                file.write(
+                    f'\nblock ip {address} any -> any any (msg:"Block traffic From IP {address}"; '
+                    f"sid: {1000000 + i};)\n"
+                )
+        agent = FileAgent(port=8000, host="127.0.0.1", directory=directory, file="local.rules")
+        expired = []
+        step = max(1, self.rules // self.expiring)
+        with open(path, "r") as file:
+            rules = [line.strip() for line in file if line.strip()]
+        for rule in rules[::step][: self.expiring]:
+            expired.append((rule_fingerprint(rule), {"command": "custom", "target": rule}))
+        return agent, expired
+
+    def main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.heap(Path(tmp))
+
+            print(f"{'removal':<12}{'rules':>9}{'expired':>9}{'rewrites':>10}{'seconds':>9}")
+            for name in ("batched", "per rule"):
+                with tempfile.TemporaryDirectory() as directory:
+                    agent, expired = self.agent(directory)
+                    start = time.perf_counter()
+                    if name == "batched":
+                        agent.expire_rules(expired)
+                        rewrites = 1
+                    else:
+                        for entry in expired:
+                            agent.expire_rules([entry])
+                        rewrites = len(expired)
+                    elapsed = time.perf_counter() - start
+                    agent.backup_store.stop()
+                    agent.rule_expiry.stop()
+                    print(f"{name:<12}{self.rules:>9}{len(expired):>9}{rewrites:>10}{elapsed:>9.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", type=int, default=100_000)
+    parser.add_argument("--expiring", type=int, default=100)
+    parser.add_argument("--scheduled", type=int, default=1_000_000)
+    args = parser.parse_args()
+    RuleExpiryBenchmark(args.rules, args.expiring, args.scheduled).main()
@@ -0,0 +1,89 @@
+from fileagent.managers.snort_rule import SnortRule
+import argparse
+import gc
+import time
+import tracemalloc
+
+
+class RuleModelBenchmark:
+    """
+    Compares the parse time and the memory held by the parsed rules, between the
+    nested dictionaries of the old `rule_splitter` and the `SnortRule` model.
+    """
+
+    def __init__(self, counts: list[int]):
+        self.counts = counts
+
+    @staticmethod
+    def rules(count: int) -> list[str]:
+        templates = (
+            'block ip 10.{a}.{b}.{c} any -> any any (msg:"Block traffic From IP 10.{a}.{b}.{c}"; sid: {sid};)',
+            'alert ip 10.{a}.{b}.{c} any -> any any (msg:"IP Alert Incoming From IP 10.{a}.{b}.{c}"; '
+            "classtype:tcp-connection; sid: {sid}; rev: 1;)",
+            'alert ssl any any -> any 443 (msg:"alert domain with SNI d{sid}.example.com"; '
+            'sid: {sid}; ssl_state: client_hello; content:"|64 31 2e 65 78|";)',
+        )
+        return [
+            templates[i % 3].format(a=i >> 16 & 255, b=i >> 8 & 255, c=i & 255, sid=1000000 + i)
+            for i in range(count)
+        ]
+
+    @staticmethod
+    def legacy_splitter(rule: str) -> dict:
+        """The `rule_splitter` of the agent before the `SnortRule` model."""
+        parsed_rule = {}
+        header, options = rule.split("(", 1)
+        options = options.rstrip(")")
+        header_parts = header.strip().split()
+        if len(header_parts) >= 6:
+            parsed_rule["action"] = header_parts[0]
+            parsed_rule["protocol"] = header_parts[1]
+            parsed_rule["src_ip"] = header_parts[2]
+            parsed_rule["src_port"] = header_parts[3]
+            parsed_rule["direction"] = header_parts[4]
+            parsed_rule["dst_ip"] = header_parts[5]
+            parsed_rule["dst_port"] = header_parts[6] if len(header_parts) > 6 else "any"
+        options_dict = {}
+        for option in options.split(";"):
+            if ":" in option:
+                key, value = option.split(":", 1)
+                options_dict[key.strip()] = value.strip()
+            elif option.strip():
+                options_dict[option.strip()] = True
+        parsed_rule["options"] = options_dict
+        return parsed_rule
+
+    @staticmethod
+    def measure(parse, rules: list[str]) -> tuple[float, float]:
+        """
+        Returns:
+            tuple[float, float]: Seconds to parse the rules, and bytes held per parsed rule.
+        """
+        gc.collect()
+        start = time.perf_counter()
+        parsed = [parse(rule) for rule in rules]
+        elapsed = time.perf_counter() - start
+        del parsed
+
+        gc.collect()
+        tracemalloc.start()
+        parsed = [parse(rule) for rule in rules]
+        held, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del parsed
+        return elapsed, held / len(rules)
+
+    def main(self):
+        print(f"{'rules':>9}  {'model':<12}{'parse s':>9}{'bytes/rule':>12}")
+        for count in self.counts:
+            rules = self.rules(count)
+            for name, parse in (("dict", self.legacy_splitter), ("SnortRule", SnortRule.parse)):
+                elapsed, per_rule = self.measure(parse, rules)
+                print(f"{count:>9}  {name:<12}{elapsed:>9.2f}{per_rule:>12.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", type=int, nargs="+", default=[100_000, 1_000_000])
+    args = parser.parse_args()
+    RuleModelBenchmark(args.rules).main()
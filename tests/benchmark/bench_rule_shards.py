@@ -0,0 +1,90 @@
+from fileagent import FileAgent
+from pathlib import Path
+import argparse
+import tempfile
+import time
+
+
+class RuleShardsBenchmark:
+    """
+    Measures what sharding the rules by command family saves: N rules, of every family,
+    are written either to the single rules file or to the shards, and custom rules are
+    then uploaded one at a time (each upload is backed up with a full copy, the default
+    backup mode), and the custom rules are compacted. With shards both only touch the
+    small custom shard instead of the whole rules file.
+    """
+
+    # The share of every family in the rules
+    FAMILIES = {"block_ip": 0.4, "block_domain": 0.3, "alert": 0.2, "custom": 0.1}
+
+    def __init__(self, rules: int, uploads: int):
+        self.rules = rules
+        self.uploads = uploads
+
+    def family_rules(self, family: str, count: int) -> list[str]:
+        rules = []
+        for i in range(count):
+            address = f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+            if family == "block_ip":
+                rules.append(f'block ip {address} any -> any any (msg:"Block {address}"; sid:{1000000 + i};)')
+            elif family == "block_domain":
+                rules.append(
+                    f'block tcp any any -> any 443 (msg:"Block d{i}.example"; '
+                    f'ssl_state:client_hello; content:"d{i}.example"; sid:{2000000 + i};)'
+                )
+            elif family == "alert":
+                rules.append(f'alert ip {address} any -> any any (msg:"Alert {address}"; sid:{3000000 + i};)')
+            else:
+                rules.append(f'alert tcp any any -> {address} 80 (msg:"Custom {i}"; sid:{4000000 + i};)')
+        return rules
+
+    def write(self, directory: str, sharded: bool):
+        files = {}
+        for family, share in self.FAMILIES.items():
+            name = f"local.{family}.rules" if sharded else "local.rules"
+            files.setdefault(name, []).extend(self.family_rules(family, int(self.rules * share)))
+        Path(directory, "local.rules").touch()
+        for name, rules in files.items():
+            Path(directory, name).write_text("".join(f"\n{rule}\n" for rule in rules))
+
+    def run(self, sharded: bool) -> tuple[float, float, float]:
+        with tempfile.TemporaryDirectory() as directory:
+            self.write(directory, sharded)
+            start = time.perf_counter()
+            agent = FileAgent(
+                port=8000, host="127.0.0.1", directory=directory, file="local.rules", shard_rules=sharded
+            )
+            startup = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for i in range(self.uploads):
+                agent.append_rule(
+                    {"command": "custom", "target": f'alert tcp any any -> any {1000 + i} (msg:"Upload {i}";)'}
+                )
+                for store in agent.rule_stores():
+                    store.backup_store.flush()
+            upload = (time.perf_counter() - start) / self.uploads
+
+            start = time.perf_counter()
+            agent.compact_rules_file("custom" if sharded else None)
+            compaction = time.perf_counter() - start
+
+            for store in agent.rule_stores():
+                store.backup_store.stop()
+                store.rule_expiry.stop()
+        return startup, upload, compaction
+
+    def main(self):
+        print(f"{'layout':<10}{'startup s':>11}{'upload ms':>11}{'compact s':>11}")
+        for sharded in (False, True):
+            startup, upload, compaction = self.run(sharded)
+            name = "sharded" if sharded else "single"
+            print(f"{name:<10}{startup:>11.2f}{upload * 1000:>11.2f}{compaction:>11.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", type=int, default=100_000)
+    parser.add_argument("--uploads", type=int, default=100)
+    args = parser.parse_args()
+    RuleShardsBenchmark(args.rules, args.uploads).main()